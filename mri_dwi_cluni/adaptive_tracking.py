@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Tracking of the partial brain with a number of streamlines adapted
+to the size of the region:
+    - compute_track_density
+    - get_density_change
+    - run_adaptive_tckgen
+
+Streamlines are generated by increments (tckgen -select), the track
+density image (points by voxel of the mask grid) is updated with each
+increment, and the tracking stops when the normalized density changes
+less than the tolerance (between a minimum and a maximum number of
+streamlines). The increments are concatenated in one tck file.
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from mrtrix_io import get_voxel_to_scanner, read_mif_header
+from retry import execute_command_retry
+from tck_io import TckFile, concatenate_tck
+
+# Default parameters ("AdaptiveTracking" field of the configuration)
+TRACKING_INCREMENT = 250000
+TRACKING_TOLERANCE = 0.01
+TRACKING_MIN_STREAMLINES = 500000
+TRACKING_MAX_STREAMLINES = 5000000
+
+
+def compute_track_density(in_tck, shape, scanner_to_voxel):
+    """
+    Count the streamline points in each voxel
+
+    :param shape: dimensions of the grid (3 values)
+    :param scanner_to_voxel: 4 x 4 matrix of the grid
+    :returns: density (flat float64 array of the grid voxels,
+              Fortran order)
+    """
+    density = np.zeros(int(np.prod(shape)))
+    shape = np.array(shape)
+    for first, last, points, starts, ends in TckFile(in_tck).iter_blocks():
+        points = points[np.isfinite(points[:, 0])]
+        voxels = np.rint(
+            points @ scanner_to_voxel[:3, :3].T + scanner_to_voxel[:3, 3]
+        ).astype(np.int64)
+        inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+        voxels = voxels[inside]
+        index = voxels[:, 0] + shape[0] * (
+            voxels[:, 1] + shape[1] * voxels[:, 2]
+        )
+        density += np.bincount(index, minlength=len(density))
+    return density
+
+
+def get_density_change(previous, current):
+    """
+    Relative change of the normalized densities (L1 norm,
+    0: same distribution of the points in the voxels)
+    """
+    previous_total, current_total = previous.sum(), current.sum()
+    if previous_total == 0 or current_total == 0:
+        return 1.0
+    return float(
+        np.abs(current / current_total - previous / previous_total).sum()
+        / 2
+    )
+
+
+def run_adaptive_tckgen(
+    wm_fod,
+    brain_mask,
+    out_directory,
+    increment=TRACKING_INCREMENT,
+    tolerance=TRACKING_TOLERANCE,
+    min_streamlines=TRACKING_MIN_STREAMLINES,
+    max_streamlines=TRACKING_MAX_STREAMLINES,
+):
+    """
+    Generate streamlines by increments until the track density
+    converges (same tckgen options as the fixed count tracking)
+
+    :param tolerance: maximum density change of the last increment
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary with tracto (tck file), nb_streamlines,
+                density_change, duration_s and time_saved_s
+                (estimated time of the streamlines not generated
+                up to max_streamlines)
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    header = read_mif_header(brain_mask)
+    shape = header["dim"][:3]
+    scanner_to_voxel = np.linalg.inv(get_voxel_to_scanner(header))
+    density = np.zeros(int(np.prod(shape)))
+    increments = []
+    start = time.time()
+    nb_streamlines = 0
+    change = 1.0
+    while nb_streamlines < max_streamlines:
+        select = min(increment, max_streamlines - nb_streamlines)
+        tck_increment = os.path.join(
+            out_directory, f"tracto_increment_{len(increments)}.tck"
+        )
+        cmd = [
+            "tckgen", wm_fod, "-seed_dynamic", wm_fod, "-mask", brain_mask,
+            tck_increment, "-select", str(select), "-minlength", "20",
+            "-force",
+        ]
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
+        if result != 0:
+            msg = f"Can not launch tckgen (exit code {result})"
+            return 0, msg, info
+        nb_increment = len(TckFile(tck_increment))
+        if nb_increment == 0:
+            msg = "tckgen did not generate any streamline"
+            return 0, msg, info
+        new_density = density + compute_track_density(
+            tck_increment, shape, scanner_to_voxel
+        )
+        change = get_density_change(density, new_density)
+        density = new_density
+        nb_streamlines += nb_increment
+        increments.append({
+            "tck": tck_increment,
+            "nb_streamlines": nb_streamlines,
+            "density_change": change,
+            "elapsed_s": time.time() - start,
+        })
+        mylog.info(
+            "tckgen increment %d: %d streamlines, density change %.4f",
+            len(increments), nb_streamlines, change,
+        )
+        if nb_streamlines >= min_streamlines and change < tolerance:
+            break
+
+    tracto = os.path.join(out_directory, f"tracto_{nb_streamlines}.tck")
+    concatenate_tck([step["tck"] for step in increments], tracto)
+    for step in increments:
+        os.remove(step.pop("tck"))
+    duration = time.time() - start
+    info = {
+        "tracto": tracto,
+        "nb_streamlines": nb_streamlines,
+        "density_change": change,
+        "duration_s": duration,
+        "time_saved_s": (
+            duration / nb_streamlines * (max_streamlines - nb_streamlines)
+        ),
+    }
+    with open(
+        tracto.replace(".tck", ".json"), "w", encoding="utf-8"
+    ) as my_json:
+        json.dump(dict(info, increments=increments), my_json, indent=4)
+    msg = (
+        f"Adaptive tckgen done: {nb_streamlines} streamlines "
+        f"(density change {change:.4f}), about "
+        f"{info['time_saved_s'] / 60:.0f} min saved"
+    )
+    mylog.info(msg)
+    return 1, msg, info
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+Memory and disk aware admission control of the stages when
+several sessions are processed at the same time on a node:
+    - get_total_memory
+    - get_directory_size
+    - read_history
+    - record_history
+    - estimate_stage_footprint
+    - AdmissionController
+    - AdmissionListener
+    - add_admission_control
+
+The footprint of a stage (peak memory and disk space) is estimated
+from the size of the DWI (volumes x voxels x datatype, read in the
+NIfTI header) and refined with the footprints recorded for the
+previous sessions. A stage only starts when the memory and disk
+space reserved by all the running stages of the node leave room
+for it. Reservations are shared between processes in a ledger file
+locked with fcntl. The reservations of the jobs whose commands are
+paused by a higher priority job (see priority.py) are kept (a stopped
+process keeps its memory and its outputs), but a stage waiting only
+for paused jobs is started anyway, like a stage exceeding the
+resources of an empty node.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import resource
+import shutil
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from preflight import get_available_memory
+from stages import add_stage_listener
+
+GB = 1024**3
+# Default footprints of the stages:
+# fixed bytes + factor x bytes of the base (size of the
+# DWI in float32 or size of the DICOM zip)
+STAGE_FOOTPRINTS = {
+    "conversion": {
+        "base": "zip_bytes",
+        "memory_fixed": 1 * GB,
+        "memory_factor": 0,
+        "disk_fixed": 0,
+        "disk_factor": 4,
+    },
+    "preproc_dwi": {
+        "base": "dwi_bytes",
+        "memory_fixed": 1 * GB,
+        "memory_factor": 4,
+        "disk_fixed": 0,
+        "disk_factor": 10,
+    },
+    "fod": {
+        "base": "dwi_bytes",
+        "memory_fixed": 0.5 * GB,
+        "memory_factor": 3,
+        "disk_fixed": 0,
+        "disk_factor": 4,
+    },
+    "preproc_anat": {
+        "base": "dwi_bytes",
+        "memory_fixed": 3 * GB,
+        "memory_factor": 0,
+        "disk_fixed": 2 * GB,
+        "disk_factor": 0,
+    },
+    "coreg": {
+        "base": "dwi_bytes",
+        "memory_fixed": 1 * GB,
+        "memory_factor": 0,
+        "disk_fixed": 0.5 * GB,
+        "disk_factor": 0,
+    },
+    "tractseg": {
+        "base": "dwi_bytes",
+        "memory_fixed": 8 * GB,
+        "memory_factor": 0,
+        "disk_fixed": 3 * GB,
+        "disk_factor": 0,
+    },
+    "tractometry": {
+        "base": "dwi_bytes",
+        "memory_fixed": 1 * GB,
+        "memory_factor": 1,
+        "disk_fixed": 0,
+        "disk_factor": 0.5,
+    },
+}
+# Number of recorded footprints needed to use the history
+# instead of the default footprint and safety margin applied
+HISTORY_MIN_RUNS = 3
+HISTORY_MAX_RUNS = 50
+HISTORY_MARGIN = 1.2
+
+
+def get_total_memory():
+    """Get total memory in bytes (None if unknown)"""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as my_file:
+            for line in my_file:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_directory_size(directory):
+    """Get size of all the files of a directory (in bytes)"""
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            try:
+                size += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                continue
+    return size
+
+
+def read_history(history_file):
+    """Read recorded footprints (dictionary stage: list of records)"""
+    if not history_file or not os.path.exists(history_file):
+        return {}
+    try:
+        with open(history_file, encoding="utf-8") as my_json:
+            return json.load(my_json)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_history(history_file, stage, record):
+    """
+    Add the footprint measured for a stage to the history
+    (only the last HISTORY_MAX_RUNS records are kept)
+    """
+    with _file_lock(history_file + ".lock"):
+        history = read_history(history_file)
+        records = history.setdefault(stage, [])
+        records.append(record)
+        history[stage] = records[-HISTORY_MAX_RUNS:]
+        tmp_file = history_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as my_json:
+            json.dump(history, my_json, indent=4)
+        os.replace(tmp_file, history_file)
+
+
+def _scale_history(records, key, base_bytes, scaled):
+    """Get the maximum recorded value of key scaled to base_bytes"""
+    values = []
+    for record in records:
+        value = record.get(key)
+        if value is None:
+            continue
+        if scaled and record.get("base_bytes") and base_bytes:
+            value = value * base_bytes / record["base_bytes"]
+        values.append(value)
+    if len(values) < HISTORY_MIN_RUNS:
+        return None
+    return HISTORY_MARGIN * max(values)
+
+
+def estimate_stage_footprint(stage, stage_info, history=None):
+    """
+    Estimate peak memory and disk space (in bytes) of a stage
+
+    :param stage: stage name (a string, see STAGE_FOOTPRINTS)
+    :param stage_info: stage information with the base size
+                       (ex: {"dwi_bytes": 1e9})
+    :param history: recorded footprints (see read_history)
+    :returns: footprint: dictionary with the keys memory_bytes,
+              disk_bytes and base_bytes (None if the stage
+              is unknown)
+    """
+    default = STAGE_FOOTPRINTS.get(stage)
+    if default is None:
+        return None
+    base_bytes = stage_info.get(default["base"]) or 0
+    footprint = {
+        "base_bytes": base_bytes,
+        "memory_bytes": default["memory_fixed"]
+        + default["memory_factor"] * base_bytes,
+        "disk_bytes": default["disk_fixed"]
+        + default["disk_factor"] * base_bytes,
+    }
+    records = (history or {}).get(stage, [])
+    # Recorded memory is the real peak: it replaces the default
+    memory = _scale_history(
+        records, "memory_bytes", base_bytes, default["memory_factor"] > 0
+    )
+    if memory is not None:
+        footprint["memory_bytes"] = memory
+    # Recorded disk space is only the space left at the end
+    # of the stage (temporary files are removed): it can only
+    # increase the default
+    disk = _scale_history(
+        records, "disk_bytes", base_bytes, default["disk_factor"] > 0
+    )
+    if disk is not None:
+        footprint["disk_bytes"] = max(footprint["disk_bytes"], disk)
+    return footprint
+
+
+@contextmanager
+def _file_lock(lock_file):
+    """Exclusive lock on a file (shared between processes)"""
+    with open(lock_file, "a", encoding="utf-8") as my_lock:
+        fcntl.flock(my_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(my_lock, fcntl.LOCK_UN)
+
+
+def _is_process_alive(pid):
+    """Check if a process of the node is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _get_active(reservations):
+    """Reservations of the jobs that are not paused"""
+    return [res for res in reservations if not res.get("paused")]
+
+
+class AdmissionController:
+    """
+    Reservation of memory and disk space for the stages
+    running on this node
+    """
+
+    def __init__(self, ledger_directory, memory_fraction=0.9, poll_interval=30):
+        """
+        :param ledger_directory: directory of the ledger file
+                                 (one ledger by node)
+        :param memory_fraction: fraction of the total memory
+                                that can be reserved
+        :param poll_interval: waiting time (in seconds) before
+                              checking again if there is room
+        """
+        self.ledger_file = os.path.join(
+            ledger_directory, f"admission_{socket.gethostname()}.json"
+        )
+        self.memory_fraction = memory_fraction
+        self.poll_interval = poll_interval
+
+    def _read_ledger(self):
+        """Read reservations and remove the ones of dead processes"""
+        if not os.path.exists(self.ledger_file):
+            return []
+        try:
+            with open(self.ledger_file, encoding="utf-8") as my_json:
+                reservations = json.load(my_json)
+        except (OSError, ValueError):
+            return []
+        return [
+            reservation for reservation in reservations
+            if _is_process_alive(reservation["pid"])
+        ]
+
+    def _write_ledger(self, reservations):
+        """Write reservations"""
+        tmp_file = self.ledger_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as my_json:
+            json.dump(reservations, my_json, indent=4)
+        os.replace(tmp_file, self.ledger_file)
+
+    def _check_room(self, reservations, memory_bytes, disk_bytes, directory):
+        """Check if there is room for a stage (returns ok and reason)"""
+        reserved_memory = sum(res["memory_bytes"] for res in reservations)
+        total_memory = get_total_memory()
+        if total_memory is not None:
+            budget = self.memory_fraction * total_memory
+            if reserved_memory + memory_bytes > budget:
+                return False, (
+                    f"memory ({reserved_memory / GB:.1f} GB reserved, "
+                    f"{memory_bytes / GB:.1f} GB needed, "
+                    f"budget {budget / GB:.1f} GB)"
+                )
+        available_memory = get_available_memory()
+        if available_memory is not None and memory_bytes > available_memory:
+            return False, (
+                f"memory ({available_memory / GB:.1f} GB available, "
+                f"{memory_bytes / GB:.1f} GB needed)"
+            )
+        if directory and disk_bytes:
+            device = os.stat(directory).st_dev
+            reserved_disk = sum(
+                res["disk_bytes"] for res in reservations
+                if res.get("device") == device
+            )
+            free_disk = shutil.disk_usage(directory).free
+            if reserved_disk + disk_bytes > free_disk:
+                return False, (
+                    f"disk space in {directory} "
+                    f"({free_disk / GB:.1f} GB free, "
+                    f"{reserved_disk / GB:.1f} GB reserved, "
+                    f"{disk_bytes / GB:.1f} GB needed)"
+                )
+        return True, ""
+
+    def has_room(self, memory_bytes, disk_bytes, directory=None):
+        """Check without reservation if there is room for a stage"""
+        with _file_lock(self.ledger_file + ".lock"):
+            reservations = self._read_ledger()
+        return self._check_room(
+            reservations, memory_bytes, disk_bytes, directory
+        )
+
+    def reserve(self, job, stage, memory_bytes, disk_bytes, directory=None):
+        """
+        Wait until there is room for the stage and reserve
+        its memory and disk space
+
+        :returns: reservation id (a string)
+        """
+        mylog = logging.getLogger("custom_logger")
+        reservation = {
+            "id": uuid.uuid4().hex,
+            "pid": os.getpid(),
+            "job": job,
+            "stage": stage,
+            "memory_bytes": memory_bytes,
+            "disk_bytes": disk_bytes,
+            "device": os.stat(directory).st_dev if directory else None,
+            "time": time.time(),
+        }
+        waiting_since = None
+        while True:
+            with _file_lock(self.ledger_file + ".lock"):
+                reservations = self._read_ledger()
+                ok, reason = self._check_room(
+                    reservations, memory_bytes, disk_bytes, directory
+                )
+                if not ok and not _get_active(reservations):
+                    # Nothing else running (or only paused jobs, that
+                    # would wait for this stage), do not wait forever
+                    mylog.warning(
+                        "Stage %s of %s exceeds node resources (%s), "
+                        "started anyway",
+                        stage, job, reason,
+                    )
+                    ok = True
+                if ok:
+                    reservations.append(reservation)
+                    self._write_ledger(reservations)
+                    break
+            if waiting_since is None:
+                waiting_since = time.time()
+                mylog.info(
+                    "Stage %s of %s waiting for %s", stage, job, reason
+                )
+            time.sleep(self.poll_interval)
+        if waiting_since is not None:
+            mylog.info(
+                "Stage %s of %s admitted after %.0f s",
+                stage, job, time.time() - waiting_since,
+            )
+        return reservation["id"]
+
+    def set_paused(self, pid, jobs):
+        """
+        Mark the reservations of a process paused (jobs whose commands
+        are paused) or active (other jobs)
+        """
+        if not os.path.exists(self.ledger_file):
+            return
+        with _file_lock(self.ledger_file + ".lock"):
+            reservations = self._read_ledger()
+            for reservation in reservations:
+                if reservation["pid"] == pid:
+                    reservation["paused"] = reservation["job"] in jobs
+            self._write_ledger(reservations)
+
+    def release(self, reservation_id):
+        """Release a reservation"""
+        with _file_lock(self.ledger_file + ".lock"):
+            reservations = [
+                res for res in self._read_ledger()
+                if res["id"] != reservation_id
+            ]
+            self._write_ledger(reservations)
+
+
+class AdmissionListener:
+    """
+    Stage listener (see stages.py) reserving resources at the start
+    of each stage, releasing them at the end and recording the
+    measured footprint in the history
+    """
+
+    def __init__(self, controller, history_file=None):
+        self.controller = controller
+        self.history_file = history_file
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event, stage_info):
+        stage = stage_info["stage"]
+        key = (threading.get_ident(), stage)
+        if event == "start":
+            footprint = estimate_stage_footprint(
+                stage, stage_info, read_history(self.history_file)
+            )
+            if footprint is None:
+                return
+            # Disk space is reserved on the output directory, the
+            # footprint is measured on the analysis directory
+            directory = stage_info.get("analysis_directory")
+            if directory and not os.path.exists(directory):
+                directory = None
+            disk_directory = directory or stage_info.get("out_directory")
+            reservation_id = self.controller.reserve(
+                stage_info.get("job", str(os.getpid())),
+                stage,
+                footprint["memory_bytes"],
+                footprint["disk_bytes"],
+                disk_directory,
+            )
+            with self._lock:
+                self._running[key] = {
+                    "reservation_id": reservation_id,
+                    "base_bytes": footprint["base_bytes"],
+                    "maxrss": _get_children_maxrss(),
+                    "directory": directory,
+                    "directory_size": (
+                        get_directory_size(directory) if directory else None
+                    ),
+                }
+        elif event == "end":
+            with self._lock:
+                running = self._running.pop(key, None)
+            if running is None:
+                return
+            self.controller.release(running["reservation_id"])
+            if self.history_file and stage_info.get("result") == 1:
+                self._record(stage, running)
+
+    def _record(self, stage, running):
+        """Record footprint measured during the stage"""
+        record = {"base_bytes": running["base_bytes"]}
+        # Peak RSS of the children is a maximum over all the
+        # children already finished: it is the peak of this stage
+        # only if it increased during the stage
+        maxrss = _get_children_maxrss()
+        if maxrss > running["maxrss"]:
+            record["memory_bytes"] = maxrss
+        if running["directory"]:
+            record["disk_bytes"] = max(
+                0,
+                get_directory_size(running["directory"])
+                - running["directory_size"],
+            )
+        record_history(self.history_file, stage, record)
+
+
+def _get_children_maxrss():
+    """Get peak RSS of the finished children processes (in bytes)"""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def add_admission_control(config):
+    """
+    Add admission control to the stages of the current process
+    (from "Admission" field of the configuration file)
+    """
+    admission = config.get("Admission", {})
+    controller = AdmissionController(
+        config["WorkingDirectory"],
+        memory_fraction=admission.get("MemoryFraction", 0.9),
+        poll_interval=admission.get("PollInterval", 30),
+    )
+    history_file = admission.get(
+        "HistoryFile",
+        os.path.join(config["WorkingDirectory"], "admission_history.json"),
+    )
+    listener = AdmissionListener(controller, history_file)
+    add_stage_listener(listener)
+    return listener
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Subject-level cache of the anatomical derivatives that only depend
+on the anatomical image (5ttgen, grey matter ROI), so that they are
+computed once and reused by all the sessions and re-runs with an
+identical T1w / FLAIR:
+    - get_image_hash
+    - get_anat_cache_directory
+    - get_cached_anat
+    - store_anat_cache
+
+Cache layout:
+    derivatives/sub-*/anat_cache/<hash>/5tt.nii.gz
+    derivatives/sub-*/anat_cache/<hash>/5tt_gm.nii.gz
+    derivatives/sub-*/anat_cache/<hash>/cache.json
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from publish import publish_file
+
+# Change it when the cached outputs are computed differently
+CACHE_VERSION = "5ttgen_fsl_1"
+CACHED_FILES = {"tissue_type": "5tt.nii.gz", "grey_matter": "5tt_gm.nii.gz"}
+
+
+def get_image_hash(in_file, block_size=1024 * 1024):
+    """
+    Get sha256 of the image content (decompressed for .gz: the
+    gzip header changes at each conversion)
+    """
+    opener = gzip.open if in_file.endswith(".gz") else open
+    image_hash = hashlib.sha256(CACHE_VERSION.encode())
+    with opener(in_file, "rb") as my_file:
+        for block in iter(lambda: my_file.read(block_size), b""):
+            image_hash.update(block)
+    return image_hash.hexdigest()
+
+
+def get_anat_cache_directory(out_directory, patient_name):
+    """Get anatomical cache directory of a subject"""
+    return os.path.join(
+        out_directory, "derivatives", "sub-" + patient_name, "anat_cache"
+    )
+
+
+def get_cached_anat(cache_directory, image_hash):
+    """
+    Get cached outputs of an anatomical image
+
+    :returns: dictionary output name: file (None if not in cache)
+    """
+    entry_directory = os.path.join(cache_directory, image_hash)
+    if not os.path.exists(os.path.join(entry_directory, "cache.json")):
+        return None
+    cached = {
+        name: os.path.join(entry_directory, file_name)
+        for name, file_name in CACHED_FILES.items()
+    }
+    if not all(os.path.exists(cached_file) for cached_file in cached.values()):
+        return None
+    return cached
+
+
+def store_anat_cache(cache_directory, image_hash, in_anat, outputs):
+    """
+    Store outputs of an anatomical image in the cache. The entry is
+    written in a temporary directory and renamed, so a concurrent
+    session never reads an incomplete entry.
+
+    :param outputs: dictionary output name: file (keys of CACHED_FILES)
+    """
+    entry_directory = os.path.join(cache_directory, image_hash)
+    if os.path.exists(entry_directory):
+        return entry_directory
+    os.makedirs(cache_directory, exist_ok=True)
+    tmp_directory = tempfile.mkdtemp(prefix="tmp_", dir=cache_directory)
+    for name, file_name in CACHED_FILES.items():
+        publish_file(outputs[name], os.path.join(tmp_directory, file_name))
+    with open(
+        os.path.join(tmp_directory, "cache.json"), "w", encoding="utf-8"
+    ) as my_json:
+        json.dump(
+            {
+                "source": in_anat,
+                "version": CACHE_VERSION,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            },
+            my_json,
+            indent=4,
+        )
+    try:
+        os.rename(tmp_directory, entry_directory)
+    except OSError:
+        # Stored meanwhile by another session
+        shutil.rmtree(tmp_directory)
+    return entry_directory
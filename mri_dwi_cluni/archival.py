@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+"""
+Archival of the derivatives of the processed sessions (uncompressed
+images recompressed with gzip, read directly by MRtrix):
+    - get_archival_rules
+    - find_frozen_candidates
+    - freeze_session
+    - thaw_session
+    - run_freeze_derivatives
+    - format_size
+    - mark_session_active
+    - is_session_active
+
+An image is frozen (image.mif -> image.mif.gz, image.nii ->
+image.nii.gz) when it matches a pattern of the policy and has not
+been modified for the minimum age of the pattern. The compression
+uses pigz (multi-threaded) if it is available, otherwise the files
+are compressed in parallel with gzip. Files with several hard links
+(shared with a cache, see publish.py) are not frozen: no space would
+be reclaimed.
+
+The frozen files of a session are written in
+<session>/archival.json, so that thaw only restores them (not the
+images delivered compressed). A frozen image keeps its modification
+time, a thawed image gets the time of the thaw: it is frozen again
+only after the minimum age of its pattern.
+
+A session being processed (by any process of any node sharing the
+output directory) holds a marker file <session>/processing.lock:
+its images are not frozen. The marker of a dead process of the node
+is ignored.
+"""
+
+import argparse
+import fnmatch
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Minimum age (days) of the images by pattern ("Archival" field
+# of the configuration: Rules)
+ARCHIVAL_RULES = {"*.mif": 30, "*.nii": 30}
+ARCHIVAL_THREADS = 4
+ARCHIVAL_LEVEL = 6
+MANIFEST_NAME = "archival.json"
+ACTIVE_MARKER_NAME = "processing.lock"
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_archival_rules(config):
+    """
+    Get archival policy from the configuration ("Archival" field:
+    Rules, Threads, Level)
+
+    :returns: rules (dictionary pattern: minimum age in days),
+              threads and compression level
+    """
+    archival = config.get("Archival", {})
+    return (
+        archival.get("Rules", ARCHIVAL_RULES),
+        archival.get("Threads", ARCHIVAL_THREADS),
+        archival.get("Level", ARCHIVAL_LEVEL),
+    )
+
+
+def format_size(nb_bytes):
+    """Format a size (ex: 1.5 GB)"""
+    for unit in ["B", "kB", "MB", "GB"]:
+        if abs(nb_bytes) < 1000:
+            return f"{nb_bytes:.1f} {unit}"
+        nb_bytes /= 1000
+    return f"{nb_bytes:.1f} TB"
+
+
+def _is_process_alive(pid):
+    """Check if a process of the node is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def mark_session_active(session_directory):
+    """Mark a session as being processed (not frozen meanwhile)"""
+    marker_file = os.path.join(session_directory, ACTIVE_MARKER_NAME)
+    with open(marker_file, "w", encoding="utf-8") as my_json:
+        json.dump(
+            {
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "time": time.time(),
+            },
+            my_json,
+            indent=4,
+        )
+    try:
+        yield
+    finally:
+        try:
+            os.remove(marker_file)
+        except FileNotFoundError:
+            pass
+
+
+def is_session_active(session_directory):
+    """
+    Check if a session is being processed (marker of a running
+    process, or of a process of another node)
+    """
+    marker_file = os.path.join(session_directory, ACTIVE_MARKER_NAME)
+    try:
+        with open(marker_file, encoding="utf-8") as my_json:
+            marker = json.load(my_json)
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # Marker being written
+        return True
+    if marker.get("host") == socket.gethostname():
+        return _is_process_alive(marker["pid"])
+    return True
+
+
+def _read_manifest(session_directory):
+    """Read frozen files of a session (dictionary path: record)"""
+    manifest_file = os.path.join(session_directory, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, encoding="utf-8") as my_json:
+        return json.load(my_json)
+
+
+def _write_manifest(session_directory, manifest):
+    """Write (or remove if empty) frozen files of a session"""
+    manifest_file = os.path.join(session_directory, MANIFEST_NAME)
+    if not manifest:
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        return
+    tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as my_json:
+        json.dump(manifest, my_json, indent=4)
+    os.replace(tmp_file, manifest_file)
+
+
+def find_frozen_candidates(session_directory, rules=None, now=None):
+    """
+    Find images of a session to freeze
+
+    :param rules: dictionary pattern: minimum age in days
+    :returns: candidates (list of paths) and shared (list of the
+              paths not frozen because of several hard links)
+    """
+    rules = ARCHIVAL_RULES if rules is None else rules
+    now = now or time.time()
+    candidates, shared = [], []
+    for root, dirs, files in os.walk(session_directory):
+        dirs.sort()
+        for name in sorted(files):
+            ages = [
+                min_age for pattern, min_age in rules.items()
+                if fnmatch.fnmatch(name, pattern)
+            ]
+            if not ages:
+                continue
+            in_file = os.path.join(root, name)
+            stat = os.lstat(in_file)
+            if not os.path.isfile(in_file) or os.path.islink(in_file):
+                continue
+            if now - stat.st_mtime < min(ages) * 86400:
+                continue
+            if stat.st_nlink > 1:
+                shared.append(in_file)
+            else:
+                candidates.append(in_file)
+    return candidates, shared
+
+
+def _copy_stream(in_stream, out_stream):
+    """Copy a stream by chunks"""
+    shutil.copyfileobj(in_stream, out_stream, CHUNK_SIZE)
+
+
+def _convert_file(in_file, out_file, compress, threads, level):
+    """
+    Compress (or decompress) a file, the output replaces the input
+    when it is complete (same permissions, same modification time
+    if compressed, time of the decompression otherwise)
+    """
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    pigz = shutil.which("pigz")
+    try:
+        if pigz:
+            cmd = [pigz, "-p", str(threads), "-c"]
+            cmd += [f"-{level}"] if compress else ["-d"]
+            with open(tmp_file, "wb") as out_stream:
+                subprocess.run(
+                    cmd + [in_file], stdout=out_stream,
+                    stderr=subprocess.PIPE, check=True,
+                )
+        elif compress:
+            with open(in_file, "rb") as in_stream, gzip.open(
+                tmp_file, "wb", compresslevel=level
+            ) as out_stream:
+                _copy_stream(in_stream, out_stream)
+        else:
+            with gzip.open(in_file, "rb") as in_stream, open(
+                tmp_file, "wb"
+            ) as out_stream:
+                _copy_stream(in_stream, out_stream)
+        stat = os.stat(in_file)
+        shutil.copymode(in_file, tmp_file)
+        if compress:
+            os.utime(tmp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.remove(in_file)
+    return os.path.getsize(out_file)
+
+
+def _convert_files(jobs, compress, threads, level):
+    """
+    Compress (or decompress) files: one at a time with all the
+    threads if pigz is available, otherwise several at once
+
+    :param jobs: list of (in_file, out_file)
+    :returns: list of (in_file, out_file, out size or error)
+    """
+    def convert(job, job_threads):
+        try:
+            size = _convert_file(job[0], job[1], compress, job_threads, level)
+        except (OSError, subprocess.CalledProcessError) as error:
+            size = error
+        return job[0], job[1], size
+
+    if shutil.which("pigz"):
+        return [convert(job, threads) for job in jobs]
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        return list(executor.map(lambda job: convert(job, 1), jobs))
+
+
+def freeze_session(session_directory, rules=None, threads=ARCHIVAL_THREADS,
+                   level=ARCHIVAL_LEVEL, dry_run=False):
+    """
+    Compress the images of a session selected by the policy
+
+    :param rules: dictionary pattern: minimum age in days
+    :param dry_run: only report the images to freeze
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary with files (frozen), shared (not frozen,
+                several hard links), bytes_before, bytes_after
+                and reclaimed_bytes
+    """
+    mylog = logging.getLogger("custom_logger")
+    candidates, shared = find_frozen_candidates(session_directory, rules)
+    info = {
+        "files": [],
+        "shared": shared,
+        "bytes_before": sum(os.path.getsize(path) for path in candidates),
+        "bytes_after": 0,
+    }
+    if dry_run:
+        info["files"] = candidates
+        info["reclaimed_bytes"] = 0
+        msg = (
+            f"{session_directory}: {len(candidates)} images to freeze "
+            f"({format_size(info['bytes_before'])})"
+        )
+        return 1, msg, info
+    manifest = _read_manifest(session_directory)
+    errors = []
+    jobs = [(path, path + ".gz") for path in candidates]
+    for in_file, out_file, size in _convert_files(jobs, True, threads, level):
+        if isinstance(size, Exception):
+            errors.append(f"{in_file}: {size}")
+            info["bytes_before"] -= os.path.getsize(in_file)
+            continue
+        info["files"].append(out_file)
+        info["bytes_after"] += size
+        manifest[os.path.relpath(out_file, session_directory)] = {
+            "frozen": time.time(),
+            "size": size,
+        }
+    _write_manifest(session_directory, manifest)
+    info["reclaimed_bytes"] = info["bytes_before"] - info["bytes_after"]
+    msg = (
+        f"{session_directory}: {len(info['files'])} images frozen, "
+        f"{format_size(info['reclaimed_bytes'])} reclaimed"
+    )
+    if shared:
+        msg += f" ({len(shared)} images with several hard links kept)"
+    if errors:
+        msg += "\n" + "\n".join(errors)
+        mylog.error(msg)
+        return 0, msg, info
+    mylog.info(msg)
+    return 1, msg, info
+
+
+def thaw_session(session_directory, threads=ARCHIVAL_THREADS):
+    """
+    Decompress the images frozen in a session (ex: session reopened)
+
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary with files (restored), bytes_before,
+                bytes_after and used_bytes
+    """
+    mylog = logging.getLogger("custom_logger")
+    manifest = _read_manifest(session_directory)
+    jobs = []
+    for relative_path in list(manifest):
+        in_file = os.path.join(session_directory, relative_path)
+        if os.path.exists(in_file):
+            jobs.append((in_file, in_file[:-len(".gz")]))
+        else:
+            # Removed since the freeze
+            manifest.pop(relative_path)
+    info = {
+        "files": [],
+        "bytes_before": sum(os.path.getsize(job[0]) for job in jobs),
+        "bytes_after": 0,
+    }
+    errors = []
+    for in_file, out_file, size in _convert_files(
+        jobs, False, threads, ARCHIVAL_LEVEL
+    ):
+        if isinstance(size, Exception):
+            errors.append(f"{in_file}: {size}")
+            info["bytes_before"] -= os.path.getsize(in_file)
+            continue
+        info["files"].append(out_file)
+        info["bytes_after"] += size
+        manifest.pop(os.path.relpath(in_file, session_directory))
+    _write_manifest(session_directory, manifest)
+    info["used_bytes"] = info["bytes_after"] - info["bytes_before"]
+    msg = (
+        f"{session_directory}: {len(info['files'])} images restored, "
+        f"{format_size(info['used_bytes'])} used"
+    )
+    if errors:
+        msg += "\n" + "\n".join(errors)
+        mylog.error(msg)
+        return 0, msg, info
+    mylog.info(msg)
+    return 1, msg, info
+
+
+def _find_sessions(directory):
+    """Find session directories (sub-*/ses-*) in or at a directory"""
+    if os.path.basename(os.path.normpath(directory)).startswith("ses-"):
+        return [directory]
+    for pattern in ["sub-*/ses-*", "derivatives/sub-*/ses-*"]:
+        sessions = sorted(glob.glob(os.path.join(directory, pattern)))
+        if sessions:
+            return sessions
+    return []
+
+
+def run_freeze_derivatives(out_directory, config, exclude=None,
+                           dry_run=False):
+    """
+    Freeze the processed sessions of the derivatives (archival stage
+    run after a session, "Archival" field of the configuration)
+
+    :param out_directory: output directory (BIDS root) or derivatives
+    :param exclude: session directories not frozen (ex: session
+                    of the caller)
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary with sessions (info of each session, see
+                freeze_session) and reclaimed_bytes
+    """
+    rules, threads, level = get_archival_rules(config)
+    exclude = {os.path.realpath(path) for path in exclude or []}
+    info = {"sessions": {}, "reclaimed_bytes": 0}
+    errors = []
+    mylog = logging.getLogger("custom_logger")
+    for session_directory in _find_sessions(out_directory):
+        if os.path.realpath(session_directory) in exclude:
+            continue
+        # Sessions never processed are skipped
+        preproc_directory = os.path.join(session_directory, "preprocessing")
+        if not os.path.isdir(preproc_directory):
+            continue
+        # Sessions being processed (marker) are skipped: their images
+        # can be read by another process
+        if is_session_active(session_directory):
+            mylog.info("Archival: %s skipped (being processed)",
+                       session_directory)
+            continue
+        result, msg, session_info = freeze_session(
+            session_directory, rules, threads, level, dry_run
+        )
+        if result == 0:
+            errors.append(msg)
+        info["sessions"][session_directory] = session_info
+        info["reclaimed_bytes"] += session_info["reclaimed_bytes"]
+    nb_files = sum(
+        len(session_info["files"])
+        for session_info in info["sessions"].values()
+    )
+    msg = (
+        f"Archival: {nb_files} images "
+        f"{'to freeze' if dry_run else 'frozen'} in "
+        f"{len(info['sessions'])} sessions, "
+        f"{format_size(info['reclaimed_bytes'])} reclaimed"
+    )
+    if errors:
+        return 0, msg + "\n" + "\n".join(errors), info
+    return 1, msg, info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Freeze (compress) or thaw (decompress) the "
+        "derivatives of the processed sessions"
+    )
+    parser.add_argument("command", choices=["freeze", "thaw"])
+    parser.add_argument(
+        "directories", nargs="+",
+        help="session directories (sub-*/ses-*), derivatives "
+        "or output directories",
+    )
+    parser.add_argument(
+        "--min-age-days", type=float,
+        help="minimum age of the images frozen (default: policy)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=ARCHIVAL_THREADS,
+        help="compression threads",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="only print the images to freeze",
+    )
+    args = parser.parse_args()
+    rules = ARCHIVAL_RULES
+    if args.min_age_days is not None:
+        rules = {pattern: args.min_age_days for pattern in rules}
+    total = 0
+    nb_failed = 0
+    for directory in args.directories:
+        for session in _find_sessions(directory):
+            if args.command == "freeze":
+                if is_session_active(session):
+                    print(f"{session}: skipped (being processed)")
+                    continue
+                result, msg, info = freeze_session(
+                    session, rules, args.threads, ARCHIVAL_LEVEL,
+                    args.dry_run,
+                )
+                total += info["reclaimed_bytes"]
+            else:
+                result, msg, info = thaw_session(session, args.threads)
+                total += info["used_bytes"]
+            nb_failed += result == 0
+            print(msg)
+    if args.command == "freeze":
+        print(f"Total space reclaimed: {format_size(total)}")
+    else:
+        print(f"Total space used: {format_size(total)}")
+    sys.exit(1 if nb_failed else 0)
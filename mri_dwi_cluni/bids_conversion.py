@@ -3,13 +3,50 @@
 Convert to BIDS format:
 - get_info_subject
 - convert_to_bids
+- get_dicom_series
+- get_series_datatype
+- run_dcm2niix_series
+- convert_series_to_bids
+
+With convert_series_to_bids, the series are converted by groups:
+the diffusion series (dwi and fmap of the dcm2bids configuration)
+first, so that the DWI preprocessing can start, then the other
+series (anat...) in background. Each group is converted by dcm2bids
+on a directory with links to its DICOM files: the description of a
+datatype is always in one group (same run numbers as the
+conversion of the whole exam).
+
+With nb_processes, the series are converted by dcm2niix in parallel
+(one process by series) in the temporary directory of dcm2bids, then
+dcm2bids only applies the matching and the naming of the
+configuration (it reuses the dcm2niix output found in its temporary
+directory): the BIDS files and sidecars are the same as with the
+conversion of the whole exam.
 """
 
+import fnmatch
+import glob
+import json
+import logging
+import os
+import shlex
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
 import pydicom
 import unidecode
 from pydicom.tag import Tag
+from stages import get_job_info, notify_file, use_job_info
 from useful import execute_command, find_dicom_tag_value, get_all_dicom_files
 
+# Default options of dcm2niix in dcm2bids ("dcm2niixOptions" field
+# of the dcm2bids configuration)
+DCM2NIIX_OPTIONS = "-b y -ba y -z y -f '%3s_%f_%p_%t'"
+# Datatypes needed by the DWI preprocessing (converted first)
+DIFFUSION_DATATYPES = ["dwi", "fmap"]
+# Conversions of the other series run in background
+_CONVERSION_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
 
 def get_info_subject(dicom_directory):
     """Get some info in DICOM tag"""
@@ -32,9 +69,13 @@ def get_info_subject(dicom_directory):
     return info_subject
 
 
-def convert_to_bids(dicom_directory, config_file, out_directory):
+def convert_to_bids(dicom_directory, config_file, out_directory,
+                    nb_processes=None):
     """
     Convert to BIDS format (ie convert to NIfTI/json and do the BIDS hierarchy)
+
+    :param nb_processes: number of series converted at the same time
+                         (None: dcm2niix on the whole exam)
     """
     info = {}
     # Get subject name / session
@@ -45,6 +86,16 @@ def convert_to_bids(dicom_directory, config_file, out_directory):
     print("Session ", sess_name)
     info = {"sub_name": sub_name, "sess_name": sess_name}
 
+    if nb_processes:
+        result, msg = _prepare_dcm2bids(
+            get_dicom_series(dicom_directory),
+            os.path.join(os.path.dirname(dicom_directory), "series"),
+            config_file, out_directory, info, nb_processes,
+            os.path.basename(dicom_directory),
+        )
+        if result == 0:
+            return 0, msg, info
+
     # Launch dcm2bids
     cmd = [
         "dcm2bids",
@@ -65,3 +116,264 @@ def convert_to_bids(dicom_directory, config_file, out_directory):
         return 0, msg, info
     msg = "Conversion BIDS done"
     return 1, msg, info
+
+
+def get_dicom_series(dicom_directory):
+    """
+    Group DICOM files by series (headers only, without pixel data)
+
+    :returns: list of series (dictionaries with uid, number,
+              description and files), sorted by series number
+    """
+    series = {}
+    for dicom_file in get_all_dicom_files(dicom_directory):
+        dataset = pydicom.dcmread(
+            dicom_file,
+            stop_before_pixels=True,
+            specific_tags=["SeriesInstanceUID", "SeriesNumber",
+                           "SeriesDescription"],
+        )
+        uid = str(dataset.get("SeriesInstanceUID", ""))
+        if uid not in series:
+            series[uid] = {
+                "uid": uid,
+                "number": int(dataset.get("SeriesNumber", 0) or 0),
+                "description": str(dataset.get("SeriesDescription", "")),
+                "files": [],
+            }
+        series[uid]["files"].append(dicom_file)
+    return sorted(series.values(), key=lambda item: item["number"])
+
+
+def get_series_datatype(series, descriptions):
+    """
+    Get datatype of a series from the descriptions of the dcm2bids
+    configuration (SeriesDescription criteria only, the other
+    criteria are checked by dcm2bids)
+
+    :returns: datatype of the first description matching the
+              series (a string), None if no description matches
+    """
+    for description in descriptions:
+        pattern = description.get("criteria", {}).get("SeriesDescription")
+        if pattern and fnmatch.fnmatch(series["description"], pattern):
+            return description.get("datatype")
+    return None
+
+
+def run_dcm2niix_series(series_list, tmp_directory, work_directory,
+                        options=DCM2NIIX_OPTIONS, nb_processes=None,
+                        folder_name=None):
+    """
+    Convert each series with dcm2niix, several series at the same time
+
+    :param tmp_directory: output directory (temporary directory of
+                          dcm2bids)
+    :param work_directory: directory of the links to the DICOM files
+                           of each series
+    :param options: dcm2niix options (a string)
+    :param folder_name: name of the directory of the links (%f of the
+                        file names)
+    :returns: result (1 if ok, else 0) and msg
+    """
+    os.makedirs(tmp_directory, exist_ok=True)
+    series_directories = []
+    for index, series in enumerate(series_list):
+        series_directories.append(os.path.join(
+            work_directory, f"series_{index:03d}", folder_name or "dicom"
+        ))
+        _link_files(series["files"], series_directories[-1])
+
+    job_info = get_job_info()
+
+    def convert(series_directory):
+        cmd = ["dcm2niix"] + shlex.split(options)
+        cmd += ["-o", tmp_directory, series_directory]
+        with use_job_info(job_info):
+            result, stderrl, sdtoutl = execute_command(cmd)
+        return result
+
+    nb_workers = min(
+        len(series_directories), nb_processes or os.cpu_count() or 1
+    )
+    with ThreadPoolExecutor(max_workers=max(nb_workers, 1)) as executor:
+        results = list(executor.map(convert, series_directories))
+    errors = [
+        f"{series['description']} (exit code {result})"
+        for series, result in zip(series_list, results) if result != 0
+    ]
+    if errors:
+        msg = f"Can not convert series with dcm2niix: {', '.join(errors)}"
+        return 0, msg
+    msg = f"{len(series_list)} series converted with dcm2niix"
+    return 1, msg
+
+
+def _prepare_dcm2bids(series_list, work_directory, config_file,
+                      out_directory, info, nb_processes=None,
+                      folder_name=None):
+    """
+    Prepare the temporary directory of dcm2bids: removed (dcm2bids
+    reuses the dcm2niix output of a previous conversion) and filled
+    with the series converted in parallel if nb_processes is given
+    """
+    tmp_directory = os.path.join(
+        out_directory, "tmp_dcm2bids",
+        f"sub-{info['sub_name']}_ses-{info['sess_name']}",
+    )
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    if not nb_processes:
+        return 1, "dcm2bids temporary directory removed"
+    with open(config_file, encoding="utf-8") as my_json:
+        options = json.load(my_json).get("dcm2niixOptions", DCM2NIIX_OPTIONS)
+    return run_dcm2niix_series(
+        series_list, tmp_directory, work_directory, options, nb_processes,
+        folder_name,
+    )
+
+
+def _link_files(files, directory):
+    """Link files in a directory (hard link, copy on another filesystem)"""
+    os.makedirs(directory)
+    for index, in_file in enumerate(files):
+        out_file = os.path.join(
+            directory, f"{index:06d}_{os.path.basename(in_file)}"
+        )
+        try:
+            os.link(in_file, out_file)
+        except OSError:
+            shutil.copy2(in_file, out_file)
+
+
+def _convert_group(series_list, group_directory, config_file, out_directory,
+                   info, nb_processes=None):
+    """
+    Convert a group of series with dcm2bids and announce the BIDS
+    files created (event "file" of the conversion stage, see stages.py)
+
+    :param group_directory: directory of the links to the DICOM files
+    """
+    mylog = logging.getLogger("custom_logger")
+    sub_name, sess_name = info["sub_name"], info["sess_name"]
+    session_path = os.path.join(
+        out_directory, "sub-" + sub_name, "ses-" + sess_name
+    )
+    before = set(glob.glob(os.path.join(session_path, "*", "*.nii.gz")))
+    group_files = [
+        dicom_file for series in series_list for dicom_file in series["files"]
+    ]
+    _link_files(group_files, group_directory)
+    result, msg = _prepare_dcm2bids(
+        series_list, group_directory + "_series", config_file,
+        out_directory, info, nb_processes, os.path.basename(group_directory),
+    )
+    if result == 0:
+        return 0, msg
+    cmd = [
+        "dcm2bids", "-d", group_directory, "-p", sub_name, "-s", sess_name,
+        "-c", config_file, "-o", out_directory,
+    ]
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        msg = f"Can not lunch dcm2bids (exit code {result})"
+        return 0, msg
+    after = set(glob.glob(os.path.join(session_path, "*", "*.nii.gz")))
+    for bids_file in sorted(after - before):
+        mylog.info("BIDS file converted: %s", bids_file)
+        notify_file("conversion", bids_file)
+    return 1, "Conversion BIDS done"
+
+
+def _convert_groups(groups, config_file, out_directory, info,
+                    nb_processes=None, remove_directory=None):
+    """
+    Convert groups one after the other (background conversion)
+
+    :param groups: list of (series list, group directory)
+    """
+    try:
+        for series_list, group_directory in groups:
+            result, msg = _convert_group(
+                series_list, group_directory, config_file, out_directory,
+                info, nb_processes,
+            )
+            if result == 0:
+                return 0, msg
+        return 1, "Conversion BIDS done"
+    finally:
+        if remove_directory:
+            shutil.rmtree(remove_directory, ignore_errors=True)
+
+
+def convert_series_to_bids(dicom_directory, config_file, out_directory,
+                           remove_directory=None, nb_processes=None):
+    """
+    Convert to BIDS format the diffusion series, then the other
+    series in background
+
+    :param nb_processes: number of series converted at the same time
+                         (None: dcm2niix on each group)
+    :param remove_directory: directory removed when the conversion
+                             is done (ex: unzipped DICOM)
+    :returns:
+        - result: 1 if the diffusion series are converted, else 0
+        - msg: message
+        - info: dictionary with sub_name, sess_name and pending
+                (future of the conversion of the other series,
+                future.result() gives result and msg, None if
+                there is no other series)
+    """
+    info = {}
+    info_subject = get_info_subject(dicom_directory)
+    info = {
+        "sub_name": info_subject["PatientName"]
+        + info_subject["PatientBirthDate"],
+        "sess_name": info_subject["StudyDate"],
+        "pending": None,
+    }
+    print("\nSubject ", info["sub_name"])
+    print("Session ", info["sess_name"])
+    with open(config_file, encoding="utf-8") as my_json:
+        descriptions = json.load(my_json).get("descriptions", [])
+    diffusion_series, other_series = [], []
+    for series in get_dicom_series(dicom_directory):
+        if get_series_datatype(series, descriptions) in DIFFUSION_DATATYPES:
+            diffusion_series.append(series)
+        else:
+            other_series.append(series)
+    series_groups = [diffusion_series, other_series]
+    if not diffusion_series:
+        # Diffusion series not recognized: all the series at once
+        series_groups = [other_series]
+    if not series_groups[0]:
+        if remove_directory:
+            shutil.rmtree(remove_directory, ignore_errors=True)
+        msg = f"No DICOM series found in {dicom_directory}"
+        return 0, msg, info
+    groups = [
+        (series_list, os.path.join(os.path.dirname(dicom_directory),
+                                   f"series_group_{index}"))
+        for index, series_list in enumerate(series_groups) if series_list
+    ]
+    result, msg = _convert_group(
+        groups[0][0], groups[0][1], config_file, out_directory, info,
+        nb_processes,
+    )
+    if result == 0 or len(groups) == 1:
+        if remove_directory:
+            shutil.rmtree(remove_directory, ignore_errors=True)
+        return result, msg, info
+    job_info = get_job_info()
+
+    def convert_others():
+        # Commands of the background thread keep the job priority
+        with use_job_info(job_info):
+            return _convert_groups(
+                groups[1:], config_file, out_directory, info,
+                nb_processes, remove_directory,
+            )
+
+    info["pending"] = _CONVERSION_EXECUTOR.submit(convert_others)
+    msg = "Conversion BIDS of the diffusion series done"
+    return 1, msg, info
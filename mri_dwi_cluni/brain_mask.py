@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Brain mask of the partial brain processing (dwi2mask is not ok
+for the optic nerve): mean of the DWI volumes, absolute threshold
+and two median filters, computed in-process with numpy on the
+memory-mapped DWI or with the MRtrix commands:
+    - compute_mean_image
+    - median_filter_binary
+    - run_partial_brain_mask
+    - run_partial_brain_mask_mrtrix
+    - benchmark_partial_brain_mask
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from mrtrix_io import load_mif, save_mif
+from useful import execute_command
+
+MASK_THRESHOLD = 2
+MEDIAN_EXTENT = 3
+# Size of the DWI slabs read at once to compute the mean
+CHUNK_BYTES = 256 * 1024 * 1024
+
+
+def compute_mean_image(data, chunk_bytes=CHUNK_BYTES):
+    """
+    Mean of a 4D image along the volumes, computed by slabs of
+    slices so that the memory-mapped DWI is never loaded entirely
+
+    :param data: 4D array indexed [x, y, z, volume]
+    :returns: mean (3D float32 array, as written by mrmath)
+    """
+    if data.ndim == 3:
+        return np.asarray(data, dtype=np.float32)
+    slice_bytes = data.shape[0] * data.shape[1] * data.shape[3] * 8
+    nb_slices = max(1, chunk_bytes // slice_bytes)
+    mean = np.empty(data.shape[:3], dtype=np.float32)
+    for start in range(0, data.shape[2], nb_slices):
+        slab = np.asarray(data[:, :, start:start + nb_slices, :])
+        mean[:, :, start:start + nb_slices] = slab.mean(
+            axis=3, dtype=np.float64
+        )
+    return mean
+
+
+def _box_sum(volume, extent):
+    """Sum over a box of extent^3 voxels (zero outside the image)"""
+    radius = extent // 2
+    total = volume
+    for axis in range(volume.ndim):
+        pad = [(0, 0)] * volume.ndim
+        pad[axis] = (radius, radius)
+        padded = np.pad(total, pad)
+        size = total.shape[axis]
+        total = sum(
+            padded[(slice(None),) * axis + (slice(offset, offset + size),)]
+            for offset in range(extent)
+        )
+    return total
+
+
+def median_filter_binary(mask, extent=MEDIAN_EXTENT):
+    """
+    Median filter of a binary mask (same as mrfilter median): the
+    median of 0 / 1 values is 1 when at least half of the neighbours
+    inside the image are 1 (median of an even number of values is
+    0.5, stored as 1 in a mask)
+
+    :returns: filtered mask (a boolean array)
+    """
+    ones = _box_sum(mask.astype(np.int16), extent)
+    # Number of neighbours inside the image (smaller on the borders)
+    valid = np.ones((1,) * mask.ndim, dtype=np.int16)
+    for axis, size in enumerate(mask.shape):
+        count = _box_sum(np.ones(size, dtype=np.int16), extent)
+        shape = [1] * mask.ndim
+        shape[axis] = size
+        valid = valid * count.reshape(shape)
+    return 2 * ones >= valid
+
+
+def run_partial_brain_mask(in_dwi, out_mask, threshold=MASK_THRESHOLD):
+    """
+    Build the partial brain mask in-process with numpy
+
+    :param in_dwi: DWI in MIF format (memory-mapped)
+    :param out_mask: mask in MIF format (UInt8)
+    """
+    info = {}
+    try:
+        header, data = load_mif(in_dwi)
+        mean = compute_mean_image(data)
+        del data
+        # Same comparison as mrthreshold -abs (NaN are excluded)
+        mask = mean >= threshold
+        for _ in range(2):
+            mask = median_filter_binary(mask)
+        header["dim"] = header["dim"][:3]
+        header["vox"] = header["vox"][:3]
+        header["keyvals"] = {}
+        save_mif(out_mask, mask, header, np.uint8)
+    except (OSError, ValueError, KeyError) as error:
+        msg = f"Can not build mask of {in_dwi} ({error})"
+        return 0, msg, info
+    info = {"brain_mask": out_mask, "nb_voxels": int(mask.sum())}
+    msg = "Brain mask done"
+    return 1, msg, info
+
+
+def run_partial_brain_mask_mrtrix(
+    in_dwi, out_mask, threshold=MASK_THRESHOLD, tmp_directory=None
+):
+    """
+    Build the partial brain mask with mrmath, mrthreshold
+    and mrfilter (intermediate images in tmp_directory,
+    next to the DWI by default)
+    """
+    info = {}
+    if tmp_directory is None:
+        in_base = in_dwi.replace(".mif", "")
+    else:
+        in_base = os.path.join(
+            tmp_directory, os.path.basename(in_dwi).replace(".mif", "")
+        )
+    dwi_mean = in_base + "_mean.mif"
+    dwi_mean_thres = in_base + "_mean_thres.mif"
+    dwi_mean_thres_filt = in_base + "_mean_thres_filt.mif"
+    commands = [
+        ["mrmath", in_dwi, "mean", "-axis", "3", dwi_mean],
+        ["mrthreshold", dwi_mean, "-abs", str(threshold), dwi_mean_thres],
+        ["mrfilter", dwi_mean_thres, "median", dwi_mean_thres_filt],
+        ["mrfilter", dwi_mean_thres_filt, "median", out_mask],
+    ]
+    for cmd in commands:
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"Can not launch {cmd[0]} (exit code {result})"
+            return 0, msg, info
+    info = {"brain_mask": out_mask}
+    msg = "Brain mask done"
+    return 1, msg, info
+
+
+def benchmark_partial_brain_mask(in_dwi, work_directory=None, repeat=1):
+    """
+    Compare duration and output of the numpy mask and the MRtrix
+    commands on the same DWI
+
+    :returns: dictionary with the best duration of each engine (s),
+              number of voxels that differ and Dice coefficient
+    """
+    tmp_directory = tempfile.mkdtemp(prefix="tmp_mask_", dir=work_directory)
+    timings = {"numpy": [], "mrtrix": []}
+    try:
+        masks = {}
+        for _ in range(repeat):
+            for engine in timings:
+                engine_directory = os.path.join(tmp_directory, engine)
+                if os.path.exists(engine_directory):
+                    shutil.rmtree(engine_directory)
+                os.mkdir(engine_directory)
+                masks[engine] = os.path.join(engine_directory, "mask.mif")
+                start = time.time()
+                if engine == "numpy":
+                    result, msg, info = run_partial_brain_mask(
+                        in_dwi, masks[engine]
+                    )
+                else:
+                    result, msg, info = run_partial_brain_mask_mrtrix(
+                        in_dwi, masks[engine], tmp_directory=engine_directory
+                    )
+                if result == 0:
+                    raise RuntimeError(msg)
+                timings[engine].append(time.time() - start)
+        mask_1 = np.asarray(load_mif(masks["numpy"])[1]) > 0
+        mask_2 = np.asarray(load_mif(masks["mrtrix"])[1]) > 0
+        nb_voxels = int(mask_1.sum() + mask_2.sum())
+        benchmark = {
+            "numpy_s": min(timings["numpy"]),
+            "mrtrix_s": min(timings["mrtrix"]),
+            "voxels_differing": int((mask_1 != mask_2).sum()),
+            "dice": (
+                2 * float((mask_1 & mask_2).sum()) / nb_voxels
+                if nb_voxels else 1.0
+            ),
+        }
+    finally:
+        shutil.rmtree(tmp_directory)
+    mylog = logging.getLogger("custom_logger")
+    mylog.info(
+        "Mask benchmark: numpy %.2f s, MRtrix %.2f s, %d voxels differ",
+        benchmark["numpy_s"], benchmark["mrtrix_s"],
+        benchmark["voxels_differing"],
+    )
+    return benchmark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the partial brain mask engines"
+    )
+    parser.add_argument("dwi", help="DWI in MIF format")
+    parser.add_argument("--work-directory", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(benchmark_partial_brain_mask(
+        args.dwi, args.work_directory, args.repeat
+    ))
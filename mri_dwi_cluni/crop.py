@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Crop of the preprocessed DWI to the brain mask bounding box, so
+that the stages after the preprocessing (response, FOD, peaks,
+TractSeg, tractometry) do not process the background:
+    - get_crop_settings
+    - get_mask_bounding_box
+    - run_crop_to_mask
+    - run_restore_grid
+
+The crop keeps the voxel grid (mrgrid crop): the images on the
+cropped grid are put back on the original grid without
+interpolation (mrtransform -template, nearest).
+"""
+
+import logging
+
+import numpy as np
+from mrtrix_io import load_mif
+from useful import execute_command
+
+CROP_MARGIN = 5
+
+
+def get_crop_settings(config):
+    """
+    Get settings of the crop ("CropToMask" field of the configuration:
+    true, false or a dictionary with Margin)
+
+    :returns: settings (a dictionary), None if there is no crop
+    """
+    settings = config.get("CropToMask", False)
+    if settings is True:
+        return {}
+    if settings is False or settings is None:
+        return None
+    if not isinstance(settings, dict):
+        raise ValueError(
+            "CropToMask must be true, false or a dictionary "
+            f"(not {settings!r})"
+        )
+    return settings
+
+
+def get_mask_bounding_box(in_mask, margin=CROP_MARGIN):
+    """
+    Get bounding box of a mask (memory-mapped, read by slices)
+
+    :param margin: number of voxels added on each side
+    :returns: dimensions of the mask (a list) and bounding box
+              (list of [first, last] voxel index of the 3 axes,
+              None if the mask is empty)
+    """
+    header, data = load_mif(in_mask)
+    if data.ndim > 3:
+        data = data[..., 0]
+    dim = list(data.shape)
+    # Slices of the last axis which contain the mask
+    slices = np.zeros(dim[2], dtype=bool)
+    in_plane = np.zeros(dim[:2], dtype=bool)
+    for index in range(dim[2]):
+        mask = np.asarray(data[:, :, index]) > 0
+        if mask.any():
+            slices[index] = True
+            in_plane |= mask
+    if not slices.any():
+        return dim, None
+    bounding_box = []
+    for axis, used in enumerate(
+        [in_plane.any(axis=1), in_plane.any(axis=0), slices]
+    ):
+        used = np.flatnonzero(used)
+        bounding_box.append([
+            max(int(used[0]) - margin, 0),
+            min(int(used[-1]) + margin, dim[axis] - 1),
+        ])
+    return dim, bounding_box
+
+
+def run_crop_to_mask(in_dwi, in_mask, margin=CROP_MARGIN):
+    """
+    Crop the DWI and the brain mask to the mask bounding box
+
+    :param margin: number of voxels kept around the mask
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary with dwi_preproc and brain_mask (cropped
+                images), voxels_before, voxels_after and
+                bounding_box
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    try:
+        dim, bounding_box = get_mask_bounding_box(in_mask, margin)
+    except (OSError, ValueError, KeyError) as error:
+        msg = f"Can not read mask {in_mask} ({error})"
+        return 0, msg, info
+    if bounding_box is None:
+        msg = f"Brain mask {in_mask} is empty, crop not done"
+        return 0, msg, info
+    options = []
+    for axis, (first, last) in enumerate(bounding_box):
+        options += ["-axis", str(axis), f"{first}:{last}"]
+    info = {
+        "bounding_box": bounding_box,
+        "voxels_before": int(np.prod(dim[:3])),
+        "voxels_after": int(
+            np.prod([last - first + 1 for first, last in bounding_box])
+        ),
+    }
+    for key, in_image in [("dwi_preproc", in_dwi), ("brain_mask", in_mask)]:
+        out_image = in_image.replace(".mif", "_crop.mif")
+        cmd = ["mrgrid", in_image, "crop", out_image, "-force"] + options
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"Can not launch mrgrid crop (exit code {result})"
+            return 0, msg, info
+        info[key] = out_image
+    msg = (
+        f"Crop to brain mask done: {info['voxels_after']} voxels instead "
+        f"of {info['voxels_before']} "
+        f"({100 * (1 - info['voxels_after'] / info['voxels_before']):.0f}% "
+        "less)"
+    )
+    mylog.info(msg)
+    return 1, msg, info
+
+
+def run_restore_grid(in_image, template, out_image=None):
+    """
+    Put an image computed on the cropped grid back on the original
+    grid (voxels outside the crop are 0)
+
+    :param template: image on the original grid (ex: DWI before crop)
+    :param out_image: default: in_image with suffix _full
+    """
+    info = {}
+    if out_image is None:
+        out_image = in_image.replace(".mif", "_full.mif")
+    cmd = [
+        "mrtransform", in_image, out_image,
+        "-template", template, "-interp", "nearest", "-force",
+    ]
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        msg = f"Can not launch mrtransform (exit code {result})"
+        return 0, msg, info
+    info["out_image"] = out_image
+    msg = "Restore grid done"
+    return 1, msg, info
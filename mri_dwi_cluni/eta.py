@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Estimated time of arrival (ETA) of the sessions, predicted from
+the runtime of the previous runs:
+    - get_planned_stages
+    - predict_stage_duration
+    - estimate_job
+    - format_duration
+    - EtaListener
+    - get_eta_directory
+    - get_history_file
+    - add_eta
+    - read_etas
+    - estimate_queue
+
+The duration of each stage is recorded (runtime history, shared by
+the processes through a locked file, see admission.record_history)
+with the characteristics of the session: number of DWI values
+(voxels x volumes), number of volumes and shells, pepolar image,
+anatomical image, partial brain, number of TractSeg bundles tracked
+and voxel fraction kept by the crop.
+The duration of a stage is predicted with a least-squares fit on
+these characteristics when enough runs are recorded, scaled from
+the median of the runs otherwise, and a default value without
+history.
+
+The ETA of each job is updated at each stage boundary and written
+in <eta directory>/<job>.json (read by the batch mode and for the
+shared queue, see read_etas and estimate_queue).
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from admission import read_history, record_history
+from priority import get_priority_rank
+from stages import add_stage_listener, get_job_info
+
+# Stages of a session in order, with the condition on the session
+STAGE_SEQUENCE = [
+    ("conversion", None),
+    ("preflight", None),
+    ("preproc_dwi", None),
+    ("crop", "crop"),
+    ("fod", None),
+    ("preproc_anat", "with_anat"),
+    ("coreg", "with_anat"),
+    ("tractseg", "whole_brain"),
+    ("tractometry", "whole_brain"),
+    ("qc", None),
+    ("archival", "archival"),
+]
+# Durations without history (seconds, whole brain, ~100 volumes)
+DEFAULT_DURATIONS = {
+    "session": 4 * 3600,
+    "conversion": 120,
+    "preflight": 5,
+    "preproc_dwi": 5400,
+    "crop": 30,
+    "fod": 900,
+    "preproc_anat": 1800,
+    "coreg": 300,
+    "tractseg": 2400,
+    "tractometry": 300,
+    "qc": 30,
+    "archival": 300,
+}
+# Stages run on the cropped DWI (size scaled by the voxel fraction)
+CROPPED_STAGES = ["fod", "tractometry"]
+FEATURES = [
+    "nb_shells", "pepolar", "with_anat", "partial_brain", "nb_bundles"
+]
+# Number of runs (more than the number of coefficients) needed
+# to fit the predictor instead of scaling the median
+FIT_MIN_RUNS = len(FEATURES) + 4
+
+
+def _get_size(stage, features):
+    """Size of the input of a stage (None if unknown)"""
+    if stage in ["conversion", "session"] or not features.get("nb_values"):
+        return features.get("zip_bytes")
+    size = features["nb_values"]
+    if stage in CROPPED_STAGES:
+        size *= features.get("voxel_fraction", 1)
+    return size
+
+
+def get_planned_stages(features):
+    """
+    Get stages of a session from its characteristics
+
+    :param features: job information (see stages.get_job_info),
+                     all the optional stages are planned while
+                     the characteristics are not known
+    """
+    conditions = {
+        "crop": features.get("crop", False),
+        "archival": features.get("archival", False),
+        "with_anat": features.get("with_anat", True)
+        and not features.get("partial_brain", False),
+        "whole_brain": not features.get("partial_brain", False),
+    }
+    return [
+        stage for stage, condition in STAGE_SEQUENCE
+        if condition is None or conditions[condition]
+    ]
+
+
+def predict_stage_duration(stage, features, history=None):
+    """
+    Predict duration of a stage (seconds)
+
+    :param features: job information (see stages.get_job_info)
+    :param history: runtime history (see admission.read_history)
+    """
+    records = [
+        record for record in (history or {}).get(stage, [])
+        if record.get("duration") is not None
+    ]
+    size = _get_size(stage, features)
+    if size is not None:
+        sized = [record for record in records if _get_size(stage, record)]
+        if len(sized) >= FIT_MIN_RUNS:
+            # Least squares on the size and the characteristics
+            # (minimum norm if some characteristics never change)
+            matrix = np.array([
+                [1.0, _get_size(stage, record)]
+                + [float(record.get(name, 0)) for name in FEATURES]
+                for record in sized
+            ])
+            durations = np.array([record["duration"] for record in sized])
+            scale = np.abs(matrix).max(axis=0)
+            scale[scale == 0] = 1
+            coefficients = np.linalg.lstsq(
+                matrix / scale, durations, rcond=None
+            )[0]
+            row = np.array(
+                [1.0, size] + [float(features.get(name, 0))
+                               for name in FEATURES]
+            )
+            prediction = float(row / scale @ coefficients)
+            # Never below the fastest recorded run of a smaller size
+            smaller = [
+                record["duration"] for record in sized
+                if _get_size(stage, record) <= size
+            ]
+            return max(prediction, min(smaller) if smaller else 0.0)
+        if sized:
+            return float(np.median([
+                record["duration"] * size / _get_size(stage, record)
+                for record in sized
+            ]))
+    if records:
+        return float(np.median([record["duration"] for record in records]))
+    return float(DEFAULT_DURATIONS.get(stage, 60))
+
+
+def estimate_job(features, done, running=None, history=None, now=None):
+    """
+    Estimate the remaining time of a job
+
+    :param features: job information (see stages.get_job_info)
+    :param done: dictionary stage: measured duration (stages done)
+    :param running: (stage, start time) of the running stage
+    :returns: eta: dictionary with stages (list of dictionaries
+              stage, status, duration or predicted and elapsed),
+              elapsed_s, remaining_s, fraction (0 to 1) and
+              eta (timestamp)
+    """
+    now = now or time.time()
+    stages = []
+    elapsed = sum(done.values())
+    remaining = 0.0
+    planned = get_planned_stages(features)
+    for stage in planned + [stage for stage in done if stage not in planned]:
+        if stage in done:
+            stages.append(
+                {"stage": stage, "status": "done", "duration": done[stage]}
+            )
+            continue
+        predicted = predict_stage_duration(stage, features, history)
+        if running and running[0] == stage:
+            stage_elapsed = now - running[1]
+            elapsed += stage_elapsed
+            # A stage longer than predicted ends soon, not now
+            remaining += max(predicted - stage_elapsed, 0.1 * predicted)
+            stages.append({"stage": stage, "status": "running",
+                           "predicted": predicted, "elapsed": stage_elapsed})
+        else:
+            remaining += predicted
+            stages.append(
+                {"stage": stage, "status": "planned", "predicted": predicted}
+            )
+    total = elapsed + remaining
+    return {
+        "stages": stages,
+        "elapsed_s": elapsed,
+        "remaining_s": remaining,
+        "fraction": elapsed / total if total else 0.0,
+        "eta": now + remaining,
+    }
+
+
+def format_duration(seconds):
+    """Format a duration (ex: 1 h 05 min)"""
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60:02d} min"
+
+
+class EtaListener:
+    """
+    Stage listener (see stages.py) recording the duration of the
+    stages in the runtime history and updating the ETA of the jobs
+
+    :param callback: called with (job, eta) at each stage
+                     boundary (ex: progress bar of the GUI)
+    """
+
+    def __init__(self, history_file, eta_directory=None, callback=None):
+        self.history_file = history_file
+        self.eta_directory = eta_directory
+        self.callback = callback
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if eta_directory:
+            os.makedirs(eta_directory, exist_ok=True)
+
+    def __call__(self, event, stage_info):
+        if event == "file":
+            return
+        stage = stage_info["stage"]
+        job = stage_info.get("job", str(os.getpid()))
+        # Characteristics known at the end of the stage (the session
+        # stage starts before they are known)
+        features = dict(get_job_info(), **stage_info)
+        features.pop("duration", None)
+        with self._lock:
+            if stage == STAGE_SEQUENCE[0][0] and event == "start":
+                # New session of the job (ex: next session in the GUI)
+                self._jobs.pop(job, None)
+            state = self._jobs.setdefault(job, {"done": {}, "running": None})
+            if stage == "session":
+                if event == "end":
+                    self._jobs.pop(job, None)
+            elif event == "start":
+                state["running"] = (stage, time.time())
+            else:
+                state["done"][stage] = stage_info["duration"]
+                state["running"] = None
+        if event == "end" and stage_info.get("result") == 1:
+            record = {
+                name: features[name]
+                for name in ["zip_bytes", "nb_values", "nb_volumes",
+                             "voxel_fraction"] + FEATURES
+                if name in features
+            }
+            record.update(duration=stage_info["duration"], time=time.time())
+            record_history(self.history_file, stage, record)
+        if stage == "session" and event == "end":
+            self._write(job, None)
+            return
+        eta = estimate_job(
+            features, dict(state["done"]), state["running"],
+            read_history(self.history_file),
+        )
+        eta.update(job=job, stage=stage, event=event)
+        self._write(job, eta)
+        if self.callback is not None:
+            self.callback(job, eta)
+
+    def _write(self, job, eta):
+        """Write (or remove at the end of the job) ETA file of a job"""
+        if not self.eta_directory:
+            return
+        eta_file = os.path.join(self.eta_directory, f"{job}.json")
+        if eta is None:
+            if os.path.exists(eta_file):
+                os.remove(eta_file)
+            return
+        tmp_file = f"{eta_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as my_json:
+            json.dump(eta, my_json, indent=4)
+        os.replace(tmp_file, eta_file)
+
+
+def get_eta_directory(config):
+    """Get directory of the ETA files of the batch mode"""
+    return config.get("Eta", {}).get(
+        "Directory", os.path.join(config["WorkingDirectory"], "eta")
+    )
+
+
+def get_history_file(config):
+    """Get runtime history file of the stages"""
+    return config.get("Eta", {}).get(
+        "HistoryFile",
+        os.path.join(config["WorkingDirectory"], "runtime_history.json"),
+    )
+
+
+def add_eta(config, eta_directory=None, history_file=None, callback=None):
+    """
+    Add ETA to the stages of the current process ("Eta" field of the
+    configuration file: HistoryFile, default
+    WorkingDirectory/runtime_history.json)
+
+    :param eta_directory: directory of the ETA files (None: not written)
+    :param history_file: runtime history (default: from the configuration)
+    """
+    listener = EtaListener(
+        history_file or get_history_file(config), eta_directory, callback
+    )
+    add_stage_listener(listener)
+    return listener
+
+
+def read_etas(eta_directory):
+    """Read ETA of the running jobs (dictionary job: eta)"""
+    etas = {}
+    for eta_file in glob.glob(os.path.join(eta_directory, "*.json")):
+        try:
+            with open(eta_file, encoding="utf-8") as my_json:
+                eta = json.load(my_json)
+        except (OSError, ValueError):
+            continue
+        etas[eta.get("job", os.path.basename(eta_file)[:-5])] = eta
+    return etas
+
+
+def estimate_queue(queue_directory, history=None, nb_workers=None):
+    """
+    Estimate when the sessions of a shared queue will be done: each
+    pending session (by priority, then submission) is given to the
+    first worker free (the running sessions end at their ETA)
+
+    :param nb_workers: number of workers (default: workers running
+                       a task, at least 1)
+    :returns: dictionary task_id: {"status", "remaining_s"} and
+              "remaining_s" of the whole queue
+    """
+    now = time.time()
+    etas = read_etas(os.path.join(queue_directory, "eta"))
+    tasks = {}
+    free_times = []
+    for name in os.listdir(os.path.join(queue_directory, "claimed")):
+        task_id = name.split("__")[0]
+        remaining = (
+            etas[task_id]["eta"] - now if task_id in etas
+            else DEFAULT_DURATIONS["session"]
+        )
+        tasks[task_id] = {
+            "status": "claimed", "remaining_s": max(remaining, 0)
+        }
+        free_times.append(tasks[task_id]["remaining_s"])
+    nb_workers = nb_workers or max(len(free_times), 1)
+    free_times = sorted(free_times + [0.0] * (nb_workers - len(free_times)))
+    pending = []
+    for pending_file in glob.glob(
+        os.path.join(queue_directory, "pending", "*.json")
+    ):
+        try:
+            with open(pending_file, encoding="utf-8") as my_json:
+                pending.append(json.load(my_json))
+        except (OSError, ValueError):
+            continue
+    for task in sorted(pending, key=lambda task: (
+        get_priority_rank(task.get("priority")), task.get("submitted", 0)
+    )):
+        features = {}
+        if task.get("zip_file") and os.path.exists(task["zip_file"]):
+            features["zip_bytes"] = os.path.getsize(task["zip_file"])
+        duration = predict_stage_duration("session", features, history)
+        start = free_times.pop(0)
+        tasks[task["id"]] = {"status": "pending",
+                             "remaining_s": start + duration}
+        free_times = sorted(free_times + [start + duration])
+    return {
+        "tasks": tasks,
+        "remaining_s": max(
+            [task["remaining_s"] for task in tasks.values()] or [0.0]
+        ),
+    }
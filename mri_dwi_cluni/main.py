@@ -7,7 +7,6 @@ TracSeg: https://github.com/MIC-DKFZ/TractSeg
 """
 
 import glob
-import json
 import logging
 import os
 import shutil
@@ -15,13 +14,21 @@ import sys
 import time
 from datetime import datetime
 
-from bids_conversion import convert_to_bids
+from archival import mark_session_active
+from bids_conversion import convert_series_to_bids, convert_to_bids
+from eta import add_eta, format_duration
 from main_white_matter_bundle import run_white_matter_bundle
+from preflight import CONVERSION_EXECUTABLES, check_executables
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import QDir
 from PyQt5.QtWidgets import QApplication, QFileDialog, QMainWindow, QMessageBox
 from PyQt5.uic import loadUi
-from useful import check_file_ext, execute_command
+from scratch import job_scratch
+from session import (add_log_handlers, clean_dcm2bids_tmp,
+                     create_analysis_directories, get_analysis_directories,
+                     is_session_processed, read_config, start_archive_dicom,
+                     unzip_dicom)
+from stages import run_stage, set_job_info
 
 
 class App(QMainWindow):
@@ -45,16 +52,32 @@ class App(QMainWindow):
         # Init variable
         self.dicom_directory = ""
         self.partial_brain = False
+        self.eta_listener = None
         self.reset_progress_bar()
 
     def reset_progress_bar(self):
         """Reset progress bar"""
         self.progressBar_run.setRange(0, 100)
         self.progressBar_run.setValue(0)
+        self.progressBar_run.setFormat("%p%")
         self.progressBar_run.setStyleSheet(
             "QProgressBar::chunk { background-color: blue; }"
         )
 
+    def update_progress(self, job, eta):
+        """
+        Update progress bar with the ETA of the processing
+        (called at each stage boundary, see eta.py)
+        """
+        # The prediction can change: the bar never goes backwards
+        value = max(self.progressBar_run.value(), int(100 * eta["fraction"]))
+        self.progressBar_run.setValue(min(value, 99))
+        self.progressBar_run.setFormat(
+            f"%p% - {eta['stage']} - about "
+            f"{format_duration(eta['remaining_s'])} left"
+        )
+        QApplication.processEvents()
+
     def browse_directory(self):
         """Browse DICOM directory"""
         # directory = QFileDialog.getExistingDirectory(
@@ -73,8 +96,29 @@ class App(QMainWindow):
                 self.pushButton_run.setEnabled(True)
                 self.reset_progress_bar()
 
+    def set_controls_enabled(self, enabled):
+        """Enable / disable the buttons and the checkbox of the window"""
+        for widget in [
+            self.pushButton_run,
+            self.pushButton_browser,
+            self.pushButton_mrview,
+            self.checkBox_partial,
+        ]:
+            widget.setEnabled(enabled)
+
     def launch_processing(self):
-        """Launch processing"""
+        """
+        Launch processing (the controls are disabled during the run:
+        the events of the window are processed by update_progress)
+        """
+        self.set_controls_enabled(False)
+        try:
+            self.run_processing()
+        finally:
+            self.set_controls_enabled(True)
+
+    def run_processing(self):
+        """Run processing of the selected DICOM zip"""
         if self.checkBox_partial.isChecked():
             self.partial_brain = True
         if self.dicom_directory:
@@ -86,158 +130,131 @@ class App(QMainWindow):
                     "config",
                     "config.json",
                 )
-                with open(config_file, encoding="utf-8") as my_json:
-                    data = json.load(my_json)
-                    bids_config_file = data["BidsConfigFile"]
-                    out_directory = data["OutputDirectory"]
-                    working_directory = data["WorkingDirectory"]
-                self.progressBar_run.setValue(5)
-
-                # Unzip dicom directory in temporary folder
-                valid_bool, in_ext, file_name = check_file_ext(
-                    self.dicom_directory, {"ZIP": "zip"}
+                data = read_config(config_file)
+                bids_config_file = data["BidsConfigFile"]
+                out_directory = data["OutputDirectory"]
+                working_directory = data["WorkingDirectory"]
+                # Progress bar driven by the ETA of the stages
+                if self.eta_listener is None:
+                    self.eta_listener = add_eta(
+                        data, callback=self.update_progress
+                    )
+                set_job_info(
+                    job=os.path.basename(self.dicom_directory),
+                    out_directory=out_directory,
+                    zip_bytes=os.path.getsize(self.dicom_directory),
                 )
-                if not valid_bool:
-                    msg = "DICOM directory is not a zip folder"
-                    self.error(msg)
-                    raise Exception(msg)
 
-                working_directory_tmp = os.path.join(working_directory, "tmp")
-                if not os.path.exists(working_directory_tmp):
-                    os.makedirs(working_directory_tmp)
-                cmd = [
-                    "unzip",
-                    self.dicom_directory,
-                    "-d",
-                    working_directory_tmp,
-                ]
-                dicom_directory = os.path.join(
-                    working_directory_tmp, file_name
-                )
-                result, stderrl, sdtoutl = execute_command(cmd)
-                while not os.path.exists(dicom_directory):
-                    time.sleep(2)
-
-                # BIDS conversion
-                print("\n----------CONVERSION----------")
-                result, msg, info = convert_to_bids(
-                    dicom_directory, bids_config_file, out_directory
-                )
-                if result == 0:
+                missing = check_executables(CONVERSION_EXECUTABLES)
+                if missing:
+                    msg = f"Executables not found: {', '.join(missing)}"
                     self.error(msg)
                     raise Exception(msg)
+
+                with run_stage("conversion"):
+                    # Unzip dicom directory in temporary folder
+                    result, msg, info = unzip_dicom(
+                        self.dicom_directory, working_directory
+                    )
+                    if result == 0:
+                        self.error(msg)
+                        raise Exception(msg)
+                    dicom_directory = info["dicom_directory"]
+                    working_directory_tmp = info["working_directory_tmp"]
+
+                    # BIDS conversion
+                    print("\n----------CONVERSION----------")
+                    if data.get("SpeculativeStart", False):
+                        # Diffusion series first, the others (and the
+                        # removal of the tmp folder) in background
+                        result, msg, info = convert_series_to_bids(
+                            dicom_directory, bids_config_file, out_directory,
+                            remove_directory=working_directory_tmp,
+                            nb_processes=data.get("ConversionProcesses"),
+                        )
+                    else:
+                        result, msg, info = convert_to_bids(
+                            dicom_directory, bids_config_file, out_directory,
+                            nb_processes=data.get("ConversionProcesses"),
+                        )
+                    if result == 0:
+                        self.error(msg)
+                        raise Exception(msg)
                 patient_name = info["sub_name"]
                 sess_name = info["sess_name"]
-                # Copy DICOM directory in sourcedata
-                sourcedata_directory = os.path.join(
-                    out_directory,
-                    "sourcedata",
-                    "sub-" + patient_name + "_ses-" + sess_name,
+                anat_conversion = info.get("pending")
+                # Archive DICOM zip in sourcedata (in background)
+                archive = start_archive_dicom(
+                    self.dicom_directory, out_directory, patient_name,
+                    sess_name, data.get("DicomArchive", "tar"),
                 )
-                if not os.path.exists(sourcedata_directory):
-                    os.makedirs(sourcedata_directory)
-                    shutil.copytree(
-                        dicom_directory,
-                        os.path.join(sourcedata_directory, "DICOM"),
-                    )
-                    os.chdir(sourcedata_directory)
-                    cmd = ["tar", "czvf", "DICOM.tar.gz", "DICOM"]
-                    result, stderrl, sdtoutl = execute_command(cmd)
-                    while not os.path.exists(
-                        os.path.join(sourcedata_directory, "DICOM.tar.gz")
-                    ):
-                        time.sleep(2)
-
-                    cmd = ["rm", "-rf", "DICOM"]
-                    result, stderrl, sdtoutl = execute_command(cmd)
 
                 # Remove tpm folder
-                shutil.rmtree(working_directory_tmp)
-
-                self.progressBar_run.setValue(15)
+                if os.path.exists(working_directory_tmp) and (
+                    anat_conversion is None
+                ):
+                    shutil.rmtree(working_directory_tmp)
 
                 # Create analysis directories
-                analysis_directory = os.path.join(
-                    out_directory,
-                    "derivatives",
-                    "sub-" + patient_name,
-                    "ses-" + sess_name,
-                )
-                preproc_directory = os.path.join(
-                    analysis_directory, "preprocessing"
+                analysis_directory, preproc_directory = (
+                    get_analysis_directories(
+                        out_directory, patient_name, sess_name
+                    )
                 )
 
-                if os.path.exists(preproc_directory):
-                    # Check if subject / session already processed
-                    if len(os.listdir(preproc_directory)) > 1:
-                        msg = (
-                            "Data already processed for this subject/session,"
-                            "would you like to repeat the analysis"
-                        )
-                        response = self.show_confirmation_box(msg)
-                        if response == QMessageBox.Cancel:
-                            print("Processing cancelled")
-                            self.reset_progress_bar()
-                            return
-                        else:
-                            # Remove old data
-                            shutil.rmtree(analysis_directory)
-
-                if not os.path.exists(analysis_directory):
-                    os.makedirs(analysis_directory)
-                if not os.path.exists(preproc_directory):
-                    os.mkdir(preproc_directory)
-
-                self.progressBar_run.setValue(10)
-
-                # Change working directory
-                # (mrtriw will create temp directory in it)
-                os.chdir(working_directory)
+                if is_session_processed(preproc_directory):
+                    msg = (
+                        "Data already processed for this subject/session,"
+                        "would you like to repeat the analysis"
+                    )
+                    response = self.show_confirmation_box(msg)
+                    if response == QMessageBox.Cancel:
+                        print("Processing cancelled")
+                        self.reset_progress_bar()
+                        return
+                    else:
+                        # Remove old data
+                        shutil.rmtree(analysis_directory)
+
+                create_analysis_directories(
+                    analysis_directory, preproc_directory
+                )
 
                 # Add log
                 now = datetime.now()
-                log_file = os.path.join(
-                    analysis_directory,
-                    now.strftime("%Y%m%d") + "_processing.log",
-                )
+                add_log_handlers(analysis_directory)
                 mylog = logging.getLogger("custom_logger")
-                mylog.setLevel(logging.INFO)
-                handler = logging.FileHandler(log_file)
-                handler.setLevel(logging.INFO)
-                handler.setFormatter(
-                    logging.Formatter(
-                        "%(asctime)s:%(levelname)s:%(message)s",
-                        datefmt="%H:%M:%S",
-                    )
-                )
-                mylog.addHandler(handler)
-                # Print also into terminal
-                handler_print = logging.StreamHandler()
-                handler_print.setLevel(logging.INFO)
-                handler_print.setFormatter(
-                    logging.Formatter(
-                        "%(asctime)s:%(levelname)s:%(message)s",
-                        datefmt="%H:%M:%S",
-                    )
-                )
-                mylog.addHandler(handler_print)
 
                 start = time.time()
                 mylog.info("Started at %s", now.strftime("%d/%m/%Y %H:%M:%S"))
 
                 # Launch processing
-                result, msg = run_white_matter_bundle(
-                    out_directory, patient_name, sess_name,
-                    self.partial_brain
-                )
+                # (in a scratch directory, see scratch.py, and not
+                # frozen by the archival of other sessions meanwhile)
+                with mark_session_active(analysis_directory), job_scratch(
+                    data, f"sub-{patient_name}_ses-{sess_name}"
+                ) as scratch:
+                    result, msg = run_white_matter_bundle(
+                        out_directory, patient_name, sess_name,
+                        self.partial_brain, data, anat_conversion
+                    )
+                    scratch["result"] = result
+                if anat_conversion is not None and result == 1:
+                    result, msg = anat_conversion.result()
+                if result == 0:
+                    mylog.error(msg)
+                    self.error(msg)
+                    raise Exception(msg)
+                result, msg = archive.result()
                 if result == 0:
                     mylog.error(msg)
                     self.error(msg)
                     raise Exception(msg)
 
                 # Clean tmp folder
-                shutil.rmtree(os.path.join(out_directory, "tmp_dcm2bids"))
+                clean_dcm2bids_tmp(out_directory, patient_name, sess_name)
                 self.progressBar_run.setValue(100)
+                self.progressBar_run.setFormat("%p%")
                 self.progressBar_run.setStyleSheet(
                     "QProgressBar::chunk { background-color: green; }"
                 )
@@ -267,7 +284,11 @@ class App(QMainWindow):
                     "TOM_trackings",
                     "CST_right.tck",
                 )
-                tracks = [tck_cst_left, tck_cst_right]
+                # Bundles not tracked (see TractSegBundles) are not shown
+                tracks = [
+                    tck for tck in [tck_cst_left, tck_cst_right]
+                    if os.path.exists(tck)
+                ]
                 if image and tracks:
                     self.launch_mrview(image=image, tracks=tracks)
             except Exception as e:
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Launch DWI preprocessing and TractSeg processing for several
+zipped DICOM directories without the GUI:
+
+    python ./mri_dwi_cluni/main_batch.py exam1.zip exam2.zip -j 2
+
+Sessions are processed in separate processes. When several sessions
+run at the same time, each stage waits until the node has enough
+memory and disk space for it (see admission.py). The remaining time
+of the sessions is printed at each stage boundary (see eta.py).
+
+With --queue, sessions are written as tasks in a shared queue
+directory and processed by the workers of all the nodes
+(see shared_executor.py).
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from admission import add_admission_control, read_history
+from eta import (add_eta, estimate_queue, format_duration, get_eta_directory,
+                 read_etas)
+from metrics import add_metrics, start_metrics_server
+from priority import DEFAULT_PRIORITY, PRIORITIES, add_priority_scheduling
+from session import process_dicom_zip, read_config, set_tractseg_options
+from shared_executor import submit_task, wait_for_tasks
+from stages import set_job_info
+
+DEFAULT_CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "config",
+    "config.json",
+)
+# Seconds between two checks of the ETA files
+ETA_POLL_INTERVAL = 10
+
+
+def init_batch_worker(config_file):
+    """
+    Add priority scheduling, admission control, metrics and ETA to
+    the stages of a worker process
+    """
+    config = read_config(config_file)
+    add_priority_scheduling(config)
+    add_admission_control(config)
+    add_metrics(config)
+    add_eta(config, get_eta_directory(config))
+
+
+def run_batch_job(
+    zip_file, config_file, partial_brain, overwrite, bundles=None,
+    uncertainty=False, priority=DEFAULT_PRIORITY, submitted=None,
+):
+    """
+    Process one zipped DICOM directory (in a worker process)
+
+    :param priority: priority class of the session (see priority.py)
+    :param submitted: submission time of the session (queue wait)
+    """
+    config = read_config(config_file)
+    set_tractseg_options(config, bundles, uncertainty)
+    set_job_info(
+        job=os.path.basename(zip_file),
+        out_directory=config["OutputDirectory"],
+        priority=priority,
+        submitted=submitted,
+    )
+    try:
+        result, msg = process_dicom_zip(
+            zip_file, config, partial_brain=partial_brain, overwrite=overwrite
+        )
+    except Exception as e:
+        result, msg = 0, str(e)
+    return result, msg
+
+
+def run_shared(
+    zip_files, config_file, partial_brain, overwrite, queue_directory, wait,
+    bundles=None, uncertainty=False, priority=DEFAULT_PRIORITY,
+):
+    """Submit sessions to a shared queue and wait for them"""
+    task_ids = {}
+    for zip_file in zip_files:
+        task = {
+            "kind": "session",
+            "zip_file": zip_file,
+            "config_file": config_file,
+            "partial_brain": partial_brain,
+            "overwrite": overwrite,
+            "bundles": bundles,
+            "uncertainty": uncertainty,
+            "priority": priority,
+        }
+        task_ids[zip_file] = submit_task(queue_directory, task)
+        print(f"{zip_file}: submitted (task {task_ids[zip_file]})")
+    if not wait:
+        return 0
+    last_eta = {}
+
+    def print_queue_eta(markers):
+        """Print remaining time of the tasks when it changes"""
+        history_file = os.path.join(queue_directory, "runtime_history.json")
+        eta = estimate_queue(queue_directory, read_history(history_file))
+        for zip_file, task_id in task_ids.items():
+            task_eta = eta["tasks"].get(task_id)
+            if task_id in markers or task_eta is None:
+                continue
+            status = (task_eta["status"],
+                      format_duration(task_eta["remaining_s"]))
+            if last_eta.get(task_id) != status:
+                last_eta[task_id] = status
+                print(f"{zip_file}: {status[0]}, about {status[1]} left")
+
+    markers = wait_for_tasks(
+        queue_directory, list(task_ids.values()), progress=print_queue_eta
+    )
+    nb_failed = 0
+    for zip_file, task_id in task_ids.items():
+        marker = markers[task_id]
+        status = "done" if marker["result"] == 1 else "failed"
+        if marker["result"] != 1:
+            nb_failed += 1
+        print(
+            f"{zip_file}: {status} on {marker['worker']} "
+            f"({marker['msg'].strip()})"
+        )
+    return 1 if nb_failed else 0
+
+
+def main(argv=None):
+    """Parse arguments and process all the zipped DICOM directories"""
+    parser = argparse.ArgumentParser(
+        description="Process several zipped DICOM directories"
+    )
+    parser.add_argument("zip_files", nargs="+", help="zipped DICOM directories")
+    parser.add_argument(
+        "-c", "--config", default=DEFAULT_CONFIG_FILE,
+        help="configuration file (default: config/config.json)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="maximum number of sessions processed at the same time",
+    )
+    parser.add_argument(
+        "--partial", action="store_true",
+        help="partial brain (optic nerve, trigeminal nerve...)",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true",
+        help="repeat the analysis of sessions already processed",
+    )
+    parser.add_argument(
+        "--bundles",
+        help="TractSeg bundles tracked, comma separated (ex: "
+        "CST_left,CST_right), default: TractSegBundles of the "
+        "configuration file or all the bundles",
+    )
+    parser.add_argument(
+        "--uncertainty", action="store_true",
+        help="compute the TractSeg uncertainty maps",
+    )
+    parser.add_argument(
+        "--priority", choices=PRIORITIES, default=DEFAULT_PRIORITY,
+        help="priority class of the sessions (ex: urgent for a "
+        "pre-surgical case, low for a research batch)",
+    )
+    parser.add_argument(
+        "--queue",
+        help="shared queue directory: sessions are processed by the "
+        "workers of shared_executor.py instead of local processes",
+    )
+    parser.add_argument(
+        "--no-wait", action="store_true",
+        help="with --queue, exit after the submission of the sessions",
+    )
+    args = parser.parse_args(argv)
+    config_file = os.path.realpath(args.config)
+    zip_files = [os.path.realpath(zip_file) for zip_file in args.zip_files]
+    bundles = [
+        bundle.strip() for bundle in (args.bundles or "").split(",")
+        if bundle.strip()
+    ] or None
+
+    # Local HTTP endpoint of the metrics
+    config = read_config(config_file)
+    metrics = config.get("Metrics", {})
+    if metrics.get("Port"):
+        start_metrics_server(
+            metrics.get(
+                "Directory",
+                os.path.join(config["WorkingDirectory"], "metrics"),
+            ),
+            metrics["Port"],
+            args.queue,
+        )
+
+    if args.queue:
+        return run_shared(
+            zip_files, config_file, args.partial, args.overwrite,
+            args.queue, not args.no_wait, bundles, args.uncertainty,
+            args.priority,
+        )
+
+    submitted = time.time()
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        initializer=init_batch_worker,
+        initargs=(config_file,),
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_batch_job, zip_file, config_file, args.partial,
+                args.overwrite, bundles, args.uncertainty, args.priority,
+                submitted,
+            ): zip_file
+            for zip_file in zip_files
+        }
+        nb_failed = 0
+        running = set(futures)
+        # Job names of the sessions (see run_batch_job)
+        jobs = {os.path.basename(zip_file) for zip_file in zip_files}
+        last_eta = {}
+        while running:
+            done, running = wait(
+                running, timeout=ETA_POLL_INTERVAL,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                result, msg = future.result()
+                status = "done" if result == 1 else "failed"
+                if result != 1:
+                    nb_failed += 1
+                print(f"{futures[future]}: {status} ({msg.strip()})")
+            # Remaining time updated at each stage boundary
+            for job, eta in read_etas(get_eta_directory(config)).items():
+                if job not in jobs or last_eta.get(job) == (
+                    eta["stage"], eta["event"]
+                ):
+                    continue
+                last_eta[job] = (eta["stage"], eta["event"])
+                print(
+                    f"{job}: {eta['stage']} {eta['event']}, "
+                    f"{100 * eta['fraction']:.0f}% done, about "
+                    f"{format_duration(eta['remaining_s'])} left"
+                )
+    return 1 if nb_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,48 +7,40 @@ import glob
 import json
 import logging
 import os
-import shutil
 
-from preprocessing import run_preproc_dwi, run_preproc_anat, run_coreg_to_diff
+from admission import read_history
+from anat_cache import get_anat_cache_directory
+from crop import (CROP_MARGIN, get_crop_settings, run_crop_to_mask,
+                  run_restore_grid)
+from eta import get_history_file, predict_stage_duration
+from preflight import run_preflight
+from preprocessing import (run_coreg_to_diff_batch, run_preproc_anat,
+                           run_preproc_dwi)
 from processing_fod import run_processing_fod
-from processing_tractseg import run_tractseg
+from processing_tractseg import TRACTSEG_NB_BUNDLES, run_tractseg
+from publish import publish_file
+from qc_report import QC_BUNDLES, run_qc_report, start_qc_snapshots
+from response_library import (BVALUE_ROUNDING, add_subject_responses,
+                              build_average_response,
+                              get_acquisition_fingerprint,
+                              get_library_response)
+from scratch import get_scratch_directory
+from stages import get_job_info, run_stage, update_job_info
+from tractometry import run_tensor_metrics, run_tractometry
 from useful import convert_mif_to_nifti, convert_nifti_to_mif, get_shell
 
 
-def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brain=False):
+def _find_anat_sequences(session_path, preproc_directory, sequences_found):
     """
-    Get all data and run preprocessing and processing
+    Find the anatomical sequences of a session and publish them in
+    the preprocessing directory
+
+    :param sequences_found: names of the sequences found (a list,
+                            updated)
+    :returns: result, msg and anat (dictionary with in_flair_nifti,
+              in_main_anat_nifti and in_t2w_nifti_list)
     """
-    mylog = logging.getLogger("custom_logger")
-    analysis_directory = os.path.join(
-        out_directory, "derivatives", "sub-" + patient_name, "ses-" + sess_name
-    )
-    preproc_directory = os.path.join(analysis_directory, "preprocessing")
-    # Get diffusion, fmap and T1w
-    session_path = os.path.join(
-        out_directory, "sub-" + patient_name, "ses-" + sess_name
-    )
     all_sequences = glob.glob(os.path.join(session_path, "*", "*.nii.gz"))
-    sequences_found = []
-
-    all_sequences_dwi = [
-        seq for seq in all_sequences if "dwi" in seq.split("/")[-1]
-    ]
-    if len(all_sequences_dwi) == 0:
-        msg = (
-            "Diffusion image not found, "
-            "please use a DICOM directory with diffusion image"
-        )
-        return 0, msg
-    if len(all_sequences_dwi) != 1:
-        msg = (
-            "Too many diffusion sequences in DICOM directoty, "
-            "please select only one"
-        )
-        return 0, msg
-    in_dwi_nifti = all_sequences_dwi[0]
-    sequences_found.append("DWI")
-
     all_sequences_flair= [
         seq for seq in all_sequences if "FLAIR" in seq.split("/")[-1]
     ]
@@ -56,10 +48,9 @@ def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brai
         in_flair_nifti = None
     else:
         in_flair_nifti = all_sequences_flair[0]
-        shutil.copy(in_flair_nifti, preproc_directory)
-        in_flair_nifti = os.path.join(
-            preproc_directory, in_flair_nifti.split("/")[-1]
-        )
+        in_flair_nifti = publish_file(
+            in_flair_nifti, preproc_directory
+        )["out_file"]
         sequences_found.append("FLAIR")
 
     all_sequences_t1 = [
@@ -70,7 +61,7 @@ def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brai
             "Too many anat sequences in DICOM directoty, "
             "please select only one"
         )
-        return 0, msg
+        return 0, msg, {}
     if len(all_sequences_t1) == 0:
         # Check if there is other "anat":
         if in_flair_nifti:
@@ -83,10 +74,9 @@ def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brai
     else:
         in_main_anat_nifti = all_sequences_t1[0]
         sequences_found.append("T1w")
-        shutil.copy(in_main_anat_nifti, preproc_directory)
-        in_main_anat_nifti = os.path.join(
-            preproc_directory, in_main_anat_nifti.split("/")[-1]
-        )
+        in_main_anat_nifti = publish_file(
+            in_main_anat_nifti, preproc_directory
+        )["out_file"]
     all_sequences_t2w = [
         seq for seq in all_sequences if "T2w" in seq.split("/")[-1]
     ]
@@ -95,11 +85,100 @@ def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brai
     else:
         in_t2w_nifti_list = []
         for seq in all_sequences_t2w:
-            shutil.copy(seq, preproc_directory)
-            in_t2w_nifti_list.append(os.path.join(
-                preproc_directory, seq.split("/")[-1]
-            ))
+            in_t2w_nifti_list.append(
+                publish_file(seq, preproc_directory)["out_file"]
+            )
         sequences_found.append("T2w")
+    anat = {
+        "in_flair_nifti": in_flair_nifti,
+        "in_main_anat_nifti": in_main_anat_nifti,
+        "in_t2w_nifti_list": in_t2w_nifti_list,
+    }
+    return 1, "Anatomical sequences found", anat
+
+
+def _log_crop_savings(durations, config):
+    """
+    Log the duration of the stages done on the cropped DWI against
+    their duration predicted on the uncropped grid (see eta.py)
+
+    :param durations: dictionary stage: measured duration (s)
+    """
+    mylog = logging.getLogger("custom_logger")
+    history = (
+        read_history(get_history_file(config))
+        if "WorkingDirectory" in config else {}
+    )
+    features = dict(get_job_info(), voxel_fraction=1)
+    predicted = sum(
+        predict_stage_duration(stage, features, history)
+        for stage in durations
+    )
+    measured = sum(durations.values())
+    mylog.info(
+        "Crop: %s done in %.0f s on the cropped DWI, %.0f s predicted "
+        "on the uncropped grid (%.0f s saved)",
+        ", ".join(durations), measured, predicted, predicted - measured,
+    )
+
+
+def run_white_matter_bundle(
+    out_directory, patient_name, sess_name, partial_brain=False, config=None,
+    anat_conversion=None,
+):
+    """
+    Get all data and run preprocessing and processing
+
+    :param config: configuration (a dictionary, see session.read_config)
+                   for the optional fields
+    :param anat_conversion: future of the conversion of the anatomical
+                            series still running (see
+                            bids_conversion.convert_series_to_bids), the
+                            DWI preprocessing starts without them
+    """
+    mylog = logging.getLogger("custom_logger")
+    config = config or {}
+    try:
+        crop_settings = get_crop_settings(config)
+    except ValueError as error:
+        return 0, str(error)
+    analysis_directory = os.path.join(
+        out_directory, "derivatives", "sub-" + patient_name, "ses-" + sess_name
+    )
+    preproc_directory = os.path.join(analysis_directory, "preprocessing")
+    # Get diffusion, fmap and T1w
+    session_path = os.path.join(
+        out_directory, "sub-" + patient_name, "ses-" + sess_name
+    )
+    all_sequences = glob.glob(os.path.join(session_path, "*", "*.nii.gz"))
+    sequences_found = []
+
+    all_sequences_dwi = [
+        seq for seq in all_sequences if "dwi" in seq.split("/")[-1]
+    ]
+    if len(all_sequences_dwi) == 0:
+        msg = (
+            "Diffusion image not found, "
+            "please use a DICOM directory with diffusion image"
+        )
+        return 0, msg
+    # Several runs are denoised separately then concatenated
+    in_dwi_nifti_list = sorted(all_sequences_dwi)
+    sequences_found.append("DWI")
+    if len(in_dwi_nifti_list) > 1:
+        sequences_found.append(f"{len(in_dwi_nifti_list)} DWI runs")
+
+    anat = {
+        "in_flair_nifti": None,
+        "in_main_anat_nifti": None,
+        "in_t2w_nifti_list": None,
+    }
+    if anat_conversion is None:
+        result, msg, anat = _find_anat_sequences(
+            session_path, preproc_directory, sequences_found
+        )
+        if result == 0:
+            return 0, msg
 
     all_sequences_pepolar = [
         seq for seq in all_sequences if "epi" in seq.split("/")[-1]
@@ -116,37 +195,93 @@ def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brai
         in_pepolar_nifti = all_sequences_pepolar[0]
         sequences_found.append("pepolar")
 
-    # Conversion into mif format (mrtrix format) and get info
-    result, msg, in_dwi = convert_nifti_to_mif(
-        in_dwi_nifti, preproc_directory, diff=True
+    # Characteristics of the session (runtime prediction, see eta.py)
+    # Anatomical image expected while its conversion is running
+    with_anat = (
+        anat_conversion is not None or anat["in_main_anat_nifti"] is not None
+    )
+    update_job_info(
+        pepolar=in_pepolar_nifti is not None,
+        with_anat=with_anat,
+        partial_brain=partial_brain,
+        crop=crop_settings is not None,
     )
+
+    # Check executables, sidecars and resources before processing
+    # (MRtrix temporary directories are created in the scratch directory)
+    with run_stage("preflight") as stage:
+        result, msg, info = run_preflight(
+            in_dwi_nifti_list,
+            [preproc_directory, get_scratch_directory() or os.getcwd()],
+            in_pepolar_nifti=in_pepolar_nifti,
+            with_anat=with_anat,
+            partial_brain=partial_brain,
+        )
+        stage["result"] = result
     if result == 0:
+        print("\nIssue during pre-flight checks")
         return 0, msg
+    # Size of the DWI used to estimate the resources of the next stages
+    update_job_info(
+        dwi_bytes=info["estimate"]["dwi_bytes"],
+        nb_values=info["estimate"]["nb_values"],
+        nb_volumes=info["estimate"]["nb_volumes"],
+        analysis_directory=analysis_directory,
+    )
 
-    in_dwi_json = in_dwi_nifti.replace("nii.gz", "json")
-    with open(in_dwi_json, encoding="utf-8") as my_json:
-        data = json.load(my_json)
-        try:
-            readout_time = str(data["TotalReadoutTime"])
-        except Exception:
-            # For Philips data
-            readout_time = str(data["EstimatedTotalReadoutTime"])
-        pe_dir = str(data["PhaseEncodingDirection"])
-
-    result, msg, shell = get_shell(in_dwi)
-    shell = [bval for bval in shell if bval != "0" and bval != ""]
-    if len(shell) > 1:
-        SHELL = True
-    else:
-        SHELL = False
-    in_main_anat = None
-    if in_main_anat_nifti:
-        result, msg, in_main_anat = convert_nifti_to_mif(
-            in_main_anat_nifti, preproc_directory, diff=False
+    # Conversion into mif format (mrtrix format) and get info
+    in_dwi_list = []
+    all_shell = set()
+    for in_dwi_nifti in in_dwi_nifti_list:
+        result, msg, in_dwi = convert_nifti_to_mif(
+            in_dwi_nifti, preproc_directory, diff=True
         )
         if result == 0:
             return 0, msg
+        in_dwi_list.append(in_dwi)
+
+        in_dwi_json = in_dwi_nifti.replace("nii.gz", "json")
+        with open(in_dwi_json, encoding="utf-8") as my_json:
+            data = json.load(my_json)
+            try:
+                run_readout_time = str(data["TotalReadoutTime"])
+            except Exception:
+                # For Philips data
+                run_readout_time = str(data["EstimatedTotalReadoutTime"])
+            run_pe_dir = str(data["PhaseEncodingDirection"])
+        if in_dwi_nifti == in_dwi_nifti_list[0]:
+            readout_time, pe_dir = run_readout_time, run_pe_dir
+        elif (run_readout_time, run_pe_dir) != (readout_time, pe_dir):
+            msg = (
+                "DWI runs with different phase encoding direction or "
+                "readout time can not be concatenated"
+            )
+            return 0, msg
 
+        result, msg, shell = get_shell(in_dwi)
+        if result == 0:
+            return 0, msg
+        # Shell b-values are the means of each run (ex: 995.3 and
+        # 997.1 for the same shell): rounded before merging the runs
+        all_shell.update(
+            round(float(bval) / BVALUE_ROUNDING) * BVALUE_ROUNDING
+            for bval in shell
+        )
+    # Runs with separate shells are processed as one multi-shell DWI
+    shell = [bval for bval in all_shell if bval != 0]
+    if len(in_dwi_list) == 1:
+        in_dwi = in_dwi_list[0]
+    else:
+        in_dwi = in_dwi_list
+    update_job_info(
+        nb_shells=len(shell),
+        nb_bundles=len(config.get("TractSegBundles") or [])
+        or TRACTSEG_NB_BUNDLES,
+    )
+    if len(shell) > 1:
+        SHELL = True
+    else:
+        SHELL = False
     in_pepolar = None
     if in_pepolar_nifti:
         # Sometime the fmap could be a dwi reverse with all shell
@@ -175,74 +310,241 @@ def run_white_matter_bundle(out_directory, patient_name, sess_name, partial_brai
     mylog.info("\n----------Start PROCESSING----------")
     print("It will take time...")
     # Preprocessing
-    if in_pepolar:
-        RPE = "pair"
-        result, msg, info = run_preproc_dwi(
-            in_dwi,
-            pe_dir,
-            readout_time,
-            rpe=RPE,
-            shell=SHELL,
-            in_pepolar=in_pepolar,
-            partial_brain=partial_brain
-        )
-    else:
-        result, msg, info = run_preproc_dwi(
-            in_dwi, pe_dir, readout_time, shell=SHELL,
-            partial_brain=partial_brain
-        )
+    with run_stage("preproc_dwi") as stage:
+        if in_pepolar:
+            RPE = "pair"
+            result, msg, info = run_preproc_dwi(
+                in_dwi,
+                pe_dir,
+                readout_time,
+                rpe=RPE,
+                shell=SHELL,
+                in_pepolar=in_pepolar,
+                partial_brain=partial_brain,
+                mask_engine=config.get("MaskEngine", "numpy"),
+                slabs=config.get("SlabDenoise"),
+            )
+        else:
+            result, msg, info = run_preproc_dwi(
+                in_dwi, pe_dir, readout_time, shell=SHELL,
+                partial_brain=partial_brain,
+                mask_engine=config.get("MaskEngine", "numpy"),
+                slabs=config.get("SlabDenoise"),
+            )
+        stage["result"] = result
     if result == 0:
         print("\nIssue during preprocessing")
         return 0, msg
     dwi_preproc = info["dwi_preproc"]
     brain_mask = info["brain_mask"]
 
+    # Crop to the brain mask (optional): the next stages are done
+    # on the cropped DWI, delivered images are on the original grid
+    dwi_crop, brain_mask_crop = dwi_preproc, brain_mask
+    # Duration of the stages done on the cropped DWI
+    cropped_durations = {}
+    if crop_settings is not None:
+        with run_stage("crop") as stage:
+            result, msg_crop, info = run_crop_to_mask(
+                dwi_preproc,
+                brain_mask,
+                crop_settings.get("Margin", CROP_MARGIN),
+            )
+            stage["result"] = result
+        if result == 1:
+            dwi_crop, brain_mask_crop = info["dwi_preproc"], info["brain_mask"]
+            # Footprints of the next stages scale with the voxel count
+            voxel_fraction = info["voxels_after"] / info["voxels_before"]
+            update_job_info(
+                dwi_bytes=get_job_info().get("dwi_bytes", 0) * voxel_fraction,
+                voxel_fraction=round(voxel_fraction, 3),
+            )
+        else:
+            mylog.warning(msg_crop)
+
+    # Response function library of the protocol
+    library = config.get("ResponseLibrary", {})
+    library_directory = library.get("Directory")
+    library_mode = library.get("Mode", "record") if library_directory else "off"
+    responses = None
+    if library_mode != "off":
+        fingerprint, description = get_acquisition_fingerprint(
+            in_dwi_nifti_list[0].replace("nii.gz", "json"),
+            [seq.replace("nii.gz", "bval") for seq in in_dwi_nifti_list],
+        )
+        if library_mode == "use":
+            responses = get_library_response(library_directory, fingerprint)
+
     # DWI response and FOD
-    result, msg, info = run_processing_fod(dwi_preproc, brain_mask, partial_brain)
+    with run_stage("fod") as stage:
+        result, msg, info = run_processing_fod(
+            dwi_crop, brain_mask_crop, partial_brain, responses=responses,
+            tracking=config.get("AdaptiveTracking"),
+        )
+        stage["result"] = result
     if result == 0:
         print("\nIssue during FOD estimation")
         return 0, msg
+    if dwi_crop != dwi_preproc:
+        cropped_durations["fod"] = stage["duration"]
+    if library_mode != "off" and info["responses_estimated"]:
+        add_subject_responses(
+            library_directory,
+            fingerprint,
+            description,
+            "sub-" + patient_name + "_ses-" + sess_name,
+            info["responses"],
+        )
+        result, msg_library, info_library = build_average_response(
+            library_directory, fingerprint, library.get("MinSubjects", 1)
+        )
+        mylog.info(msg_library)
     peaks = info["peaks"]
+    tracto = info.get("tracto")
+    if dwi_crop != dwi_preproc:
+        # Delivered peaks (and TractSeg outputs) on the original grid
+        peaks_crop = peaks.replace(".mif", "_crop.mif")
+        os.replace(peaks, peaks_crop)
+        result, msg, info = run_restore_grid(peaks_crop, dwi_preproc, peaks)
+        if result == 0:
+            return 0, msg
     result, msg, peaks_nii = convert_mif_to_nifti(
         peaks, analysis_directory, diff=False
     )
 
+    # Anatomical sequences (conversion done during the DWI processing)
+    if anat_conversion is not None:
+        result, msg = anat_conversion.result()
+        if result == 0:
+            return 0, msg
+        result, msg, anat = _find_anat_sequences(
+            session_path, preproc_directory, sequences_found
+        )
+        if result == 0:
+            return 0, msg
+        update_job_info(with_anat=anat["in_main_anat_nifti"] is not None)
+        mylog.info(
+            "Anatomical conversion done, the following sequences have "
+            "been found: %s", sequences_found,
+        )
+    in_flair_nifti = anat["in_flair_nifti"]
+    in_t2w_nifti_list = anat["in_t2w_nifti_list"]
+    in_main_anat = None
+    if anat["in_main_anat_nifti"]:
+        result, msg, in_main_anat = convert_nifti_to_mif(
+            anat["in_main_anat_nifti"], preproc_directory, diff=False
+        )
+        if result == 0:
+            return 0, msg
+
     # T1 coregistration
+    in_t1_coreg = None
     if in_main_anat and not partial_brain:
-        result, msg, info = run_preproc_anat(
-            in_main_anat.replace("mif", "nii.gz"), dwi_preproc
-        )
+        with run_stage("preproc_anat") as stage:
+            result, msg, info = run_preproc_anat(
+                in_main_anat.replace("mif", "nii.gz"),
+                dwi_preproc,
+                cache_directory=get_anat_cache_directory(
+                    out_directory, patient_name
+                ),
+            )
+            stage["result"] = result
         in_t1_coreg = info["in_anat_coreg"]
         diff2struct = info["diff2struct"]
-        shutil.copy(in_t1_coreg, analysis_directory)
+        publish_file(in_t1_coreg, analysis_directory)
 
-        # Coregister others seq to DWI
+        # Coregister others seq to DWI (at the same time)
+        in_seq_list = []
         if in_flair_nifti:
-            result, msg, info = run_coreg_to_diff(
-                in_flair_nifti, in_main_anat.replace("mif", "nii.gz"), diff2struct
-            )
-            in_flair_coreg = info["in_seq_coreg"]
-            shutil.copy(in_flair_coreg, analysis_directory)
-
+            in_seq_list.append(in_flair_nifti)
         if in_t2w_nifti_list:
-            for seq in in_t2w_nifti_list:
-                result, msg, info = run_coreg_to_diff(
-                seq, in_main_anat.replace("mif", "nii.gz"), diff2struct
-                )
-                in_seq_coreg = info["in_seq_coreg"]
-                shutil.copy(in_seq_coreg, analysis_directory)
+            in_seq_list += in_t2w_nifti_list
+        with run_stage("coreg") as stage:
+            result, msg, info = run_coreg_to_diff_batch(
+                in_seq_list, in_main_anat.replace("mif", "nii.gz"), diff2struct
+            )
+            stage["result"] = result
+        for seq_info in info.values():
+            if seq_info["result"] == 1:
+                publish_file(seq_info["in_seq_coreg"], analysis_directory)
+        if result == 0:
+            # Other sequences are optional: continue the processing
+            mylog.warning(msg)
 
-    # Copy DWI preproc into TractSeg folder
+    # Publish DWI preproc into TractSeg folder
     # to have all the useful data in one folder
-    shutil.copy(dwi_preproc, analysis_directory)
+    publish_file(dwi_preproc, analysis_directory)
+
+    # QC snapshots rendered during TractSeg
+    qc_directory = os.path.join(analysis_directory, "qc")
+    qc_snapshots = start_qc_snapshots(
+        qc_directory,
+        {
+            "dwi": dwi_preproc,
+            "brain_mask": brain_mask,
+            "peaks": peaks,
+            "t1": in_t1_coreg,
+        },
+    )
 
     # Tractseg
     if not partial_brain:
         mylog.info("\n----------Start TractSeg----------")
-        result, msg = run_tractseg(peaks_nii)
+        with run_stage("tractseg") as stage:
+            result, msg = run_tractseg(
+                peaks_nii,
+                bundles=config.get("TractSegBundles"),
+                uncertainty=config.get("TractSegUncertainty", False),
+            )
+            stage["result"] = result
         if result == 0:
             print("\nIssue during TracSeg")
             return 0, msg
+        tck_directory = os.path.join(
+            os.path.dirname(peaks_nii), "tractseg_output", "TOM_trackings"
+        )
+        # Bundles shown in the QC report (if they are tracked)
+        tck_files = [
+            os.path.join(tck_directory, f"{bundle}.tck")
+            for bundle in QC_BUNDLES
+            if os.path.exists(os.path.join(tck_directory, f"{bundle}.tck"))
+        ]
+
+        # Tractometry (optional: the processing is done even if it fails)
+        tractometry_directory = os.path.join(analysis_directory, "tractometry")
+        with run_stage("tractometry") as stage:
+            result, msg_tractometry, info = run_tensor_metrics(
+                dwi_crop, brain_mask_crop, tractometry_directory
+            )
+            if result == 1:
+                result, msg_tractometry, info = run_tractometry(
+                    sorted(glob.glob(os.path.join(tck_directory, "*.tck"))),
+                    info,
+                    tractometry_directory,
+                )
+            stage["result"] = result
+        if result == 0:
+            mylog.warning(msg_tractometry)
+        elif dwi_crop != dwi_preproc:
+            cropped_durations["tractometry"] = stage["duration"]
+    else:
+        tck_files = [tracto] if tracto else []
+
+    if cropped_durations:
+        _log_crop_savings(cropped_durations, config)
+
+    # QC report (optional: the processing is done even if it fails)
+    with run_stage("qc") as stage:
+        result, msg_qc, info = run_qc_report(
+            qc_directory,
+            f"sub-{patient_name} ses-{sess_name}",
+            qc_snapshots,
+            background=dwi_preproc,
+            tck_files=tck_files,
+        )
+        stage["result"] = result
+    if result == 0:
+        mylog.warning(msg_qc)
     msg = "\nProcessing done"
     mylog.info(msg)
     return 1, msg
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of the processing (throughput, stage latency, failures,
+CPU time) updated at each stage boundary, exported in Prometheus
+text format, and structured events (JSON lines):
+    - read_metrics_state
+    - update_metrics_state
+    - get_queue_depth
+    - format_prometheus
+    - write_prometheus_file
+    - MetricsListener
+    - add_metrics
+    - start_metrics_server
+
+Metrics directory layout (one state by node, shared by all the
+processes of the node through a file locked with fcntl):
+    metrics_<host>.json     counters, gauges and histograms
+    metrics_<host>.prom     Prometheus text file (node_exporter
+                            textfile collector)
+    events_<host>.jsonl     one event by stage start / end
+
+Usage (HTTP endpoint of all the nodes writing in the directory):
+
+    python ./mri_dwi_cluni/metrics.py /shared/metrics --port 9400
+"""
+
+import argparse
+import fcntl
+import glob
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from stages import add_stage_listener
+
+METRIC_PREFIX = "mri_dwi_cluni"
+# Upper bounds of the histogram buckets (seconds)
+DURATION_BUCKETS = [60, 300, 600, 1800, 3600, 7200, 14400, 28800]
+CPU_BUCKETS = [60, 300, 900, 1800, 3600, 7200, 14400, 28800, 57600, 115200]
+METRICS_HELP = {
+    "stage_runs_total": ("counter", "Stages run, by result"),
+    "stage_duration_seconds": ("histogram", "Wall time of the stages"),
+    "stage_cpu_seconds": (
+        "histogram",
+        "CPU time of the stages (process and children, the session "
+        "stage gives the CPU time by subject)",
+    ),
+    "stages_running": ("gauge", "Stages running"),
+    "last_stage_end_timestamp_seconds": ("gauge", "End of the last stage"),
+    "queue_tasks": ("gauge", "Tasks of the shared queue, by state"),
+    "queue_wait_seconds": (
+        "histogram",
+        "Waiting time of the jobs by priority class (queue: before the "
+        "session, deferred: stages deferred, paused: commands paused, "
+        "see priority.py)",
+    ),
+}
+# Waiting times given by the priority listener (see priority.py)
+WAIT_REASONS = {
+    "queue_wait_s": "queue",
+    "deferred_s": "deferred",
+    "paused_s": "paused",
+}
+
+
+@contextmanager
+def _file_lock(lock_file):
+    """Exclusive lock on a file (shared between processes)"""
+    with open(lock_file, "a", encoding="utf-8") as my_lock:
+        fcntl.flock(my_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(my_lock, fcntl.LOCK_UN)
+
+
+def _get_labels(**labels):
+    """Get Prometheus labels text (ex: stage="fod",result="ok")"""
+    return ",".join(
+        f'{key}="{str(value)}"' for key, value in sorted(labels.items())
+    )
+
+
+def read_metrics_state(state_file):
+    """Read metrics state of a node (empty if it does not exist)"""
+    state = {"counters": {}, "gauges": {}, "histograms": {}}
+    if os.path.exists(state_file):
+        with open(state_file, encoding="utf-8") as my_json:
+            state.update(json.load(my_json))
+    return state
+
+
+def update_metrics_state(state_file, updates):
+    """
+    Apply updates to the metrics state of a node
+
+    :param updates: list of (kind, name, labels, value) with kind
+                    "inc" (counter or gauge), "set" (gauge) or
+                    "observe" (histogram, value in seconds)
+    :returns: the new state
+    """
+    with _file_lock(state_file + ".lock"):
+        state = read_metrics_state(state_file)
+        for kind, name, labels, value in updates:
+            if kind == "observe":
+                series = state["histograms"].setdefault(name, {})
+                buckets = (
+                    CPU_BUCKETS if name == "stage_cpu_seconds"
+                    else DURATION_BUCKETS
+                )
+                histogram = series.setdefault(
+                    labels,
+                    {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0},
+                )
+                for i, bound in enumerate(buckets):
+                    if value <= bound:
+                        histogram["buckets"][i] += 1
+                histogram["sum"] += value
+                histogram["count"] += 1
+            else:
+                kind_key = "counters" if name.endswith("_total") else "gauges"
+                series = state[kind_key].setdefault(name, {})
+                if kind == "inc":
+                    series[labels] = series.get(labels, 0) + value
+                else:
+                    series[labels] = value
+        tmp_file = f"{state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as my_json:
+            json.dump(state, my_json)
+        os.replace(tmp_file, state_file)
+    return state
+
+
+def get_queue_depth(queue_directory):
+    """Get number of tasks by state of a shared queue"""
+    depth = {}
+    for state in ["pending", "claimed", "done", "failed"]:
+        directory = os.path.join(queue_directory, state)
+        depth[state] = (
+            len(glob.glob(os.path.join(directory, "*.json")))
+            if os.path.isdir(directory) else 0
+        )
+    return depth
+
+
+def _add_host(labels, host):
+    """Add host label to labels text"""
+    return f'host="{host}"' + ("," + labels if labels else "")
+
+
+def format_prometheus(states, queue_directory=None):
+    """
+    Format metrics in Prometheus text format
+
+    :param states: dictionary host: metrics state
+    :param queue_directory: shared queue (queue depth is added)
+    """
+    samples = {name: [] for name in METRICS_HELP}
+    for host, state in sorted(states.items()):
+        for kind in ["counters", "gauges"]:
+            for name, series in state[kind].items():
+                for labels, value in sorted(series.items()):
+                    samples.setdefault(name, []).append(
+                        f"{METRIC_PREFIX}_{name}{{{_add_host(labels, host)}}} "
+                        f"{value:.15g}"
+                    )
+        for name, series in state["histograms"].items():
+            buckets = (
+                CPU_BUCKETS if name == "stage_cpu_seconds"
+                else DURATION_BUCKETS
+            )
+            for labels, histogram in sorted(series.items()):
+                labels = _add_host(labels, host)
+                full_name = f"{METRIC_PREFIX}_{name}"
+                for bound, count in zip(buckets, histogram["buckets"]):
+                    samples[name].append(
+                        f'{full_name}_bucket{{{labels},le="{bound}"}} {count}'
+                    )
+                samples[name].append(
+                    f'{full_name}_bucket{{{labels},le="+Inf"}} '
+                    f"{histogram['count']}"
+                )
+                samples[name].append(
+                    f"{full_name}_sum{{{labels}}} {histogram['sum']:.15g}"
+                )
+                samples[name].append(
+                    f"{full_name}_count{{{labels}}} {histogram['count']}"
+                )
+    if queue_directory:
+        for state, count in get_queue_depth(queue_directory).items():
+            samples["queue_tasks"].append(
+                f"{METRIC_PREFIX}_queue_tasks{{{_get_labels(state=state)}}} "
+                f"{count}"
+            )
+    lines = []
+    for name, name_samples in samples.items():
+        if not name_samples:
+            continue
+        metric_type, help_text = METRICS_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+        lines += name_samples
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(state, prom_file, host=None):
+    """Write metrics state of a node as a Prometheus text file"""
+    tmp_file = f"{prom_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as my_file:
+        my_file.write(format_prometheus({host or socket.gethostname(): state}))
+    os.replace(tmp_file, prom_file)
+
+
+def _get_cpu_seconds():
+    """CPU time (user + system) of the process and its finished children"""
+    cpu = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        cpu += usage.ru_utime + usage.ru_stime
+    return cpu
+
+
+class MetricsListener:
+    """
+    Stage listener (see stages.py) updating the metrics of the node
+    and writing the events at each stage boundary
+    """
+
+    def __init__(self, metrics_directory):
+        os.makedirs(metrics_directory, exist_ok=True)
+        self.host = socket.gethostname()
+        self.state_file = os.path.join(
+            metrics_directory, f"metrics_{self.host}.json"
+        )
+        self.prom_file = os.path.join(
+            metrics_directory, f"metrics_{self.host}.prom"
+        )
+        self.events_file = os.path.join(
+            metrics_directory, f"events_{self.host}.jsonl"
+        )
+        self._cpu_start = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event, stage_info):
+        stage = stage_info["stage"]
+        key = (threading.get_ident(), stage)
+        labels = _get_labels(stage=stage)
+        event_info = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "host": self.host,
+            "pid": os.getpid(),
+            "event": event,
+            "stage": stage,
+        }
+        for name in ["job", "patient_name", "sess_name", "voxel_fraction",
+                     "priority"]:
+            if name in stage_info:
+                event_info[name] = stage_info[name]
+        if event == "file":
+            # File created by the stage: event only
+            event_info["file"] = stage_info["file"]
+            self._write_event(
+                event_info, stage_info.get("analysis_directory")
+            )
+            return
+        wait_updates = []
+        for name, reason in WAIT_REASONS.items():
+            if name in stage_info:
+                event_info[name] = round(stage_info[name], 3)
+                wait_updates.append((
+                    "observe", "queue_wait_seconds",
+                    _get_labels(
+                        priority=stage_info.get("priority", "normal"),
+                        reason=reason,
+                    ),
+                    stage_info[name],
+                ))
+        if event == "start":
+            with self._lock:
+                self._cpu_start[key] = _get_cpu_seconds()
+            updates = [("inc", "stages_running", labels, 1)]
+        else:
+            with self._lock:
+                cpu_start = self._cpu_start.pop(key, None)
+            cpu_seconds = (
+                _get_cpu_seconds() - cpu_start if cpu_start is not None
+                else 0.0
+            )
+            result = "ok" if stage_info.get("result") == 1 else "failed"
+            updates = [
+                ("inc", "stages_running", labels, -1),
+                ("inc", "stage_runs_total",
+                 _get_labels(stage=stage, result=result), 1),
+                ("observe", "stage_duration_seconds", labels,
+                 stage_info["duration"]),
+                ("observe", "stage_cpu_seconds", labels, cpu_seconds),
+                ("set", "last_stage_end_timestamp_seconds", "", time.time()),
+            ]
+            event_info.update(
+                duration=round(stage_info["duration"], 3),
+                cpu_seconds=round(cpu_seconds, 3),
+                result=stage_info.get("result"),
+            )
+        state = update_metrics_state(
+            self.state_file, updates + wait_updates
+        )
+        write_prometheus_file(state, self.prom_file, self.host)
+        self._write_event(event_info, stage_info.get("analysis_directory"))
+
+    def _write_event(self, event_info, analysis_directory=None):
+        """
+        Append event to the events of the node and next to the
+        processing log of the session
+        """
+        line = json.dumps(event_info) + "\n"
+        events_files = [self.events_file]
+        if analysis_directory and os.path.isdir(analysis_directory):
+            events_files.append(
+                os.path.join(analysis_directory, "events.jsonl")
+            )
+        for events_file in events_files:
+            # One write in append mode: lines of several
+            # processes are not interleaved
+            with open(events_file, "a", encoding="utf-8") as my_file:
+                my_file.write(line)
+
+
+def add_metrics(config):
+    """
+    Add metrics to the stages of the current process (from "Metrics"
+    field of the configuration file, None if not configured)
+    """
+    metrics = config.get("Metrics")
+    if metrics is None:
+        return None
+    listener = MetricsListener(
+        metrics.get(
+            "Directory", os.path.join(config["WorkingDirectory"], "metrics")
+        )
+    )
+    add_stage_listener(listener)
+    return listener
+
+
+def _read_all_states(metrics_directory):
+    """Read metrics states of all the nodes"""
+    states = {}
+    for state_file in glob.glob(
+        os.path.join(metrics_directory, "metrics_*.json")
+    ):
+        host = os.path.basename(state_file)[len("metrics_"):-len(".json")]
+        try:
+            states[host] = read_metrics_state(state_file)
+        except (OSError, ValueError):
+            continue
+    return states
+
+
+def start_metrics_server(
+    metrics_directory, port, queue_directory=None, address=""
+):
+    """
+    Serve metrics of all the nodes (and queue depth) on
+    http://<address>:<port>/metrics in a background thread
+
+    :returns: server (stop it with server.shutdown())
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Handler of the /metrics requests"""
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = format_prometheus(
+                _read_all_states(metrics_directory), queue_directory
+            ).encode()
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    """Serve the metrics of a metrics directory"""
+    parser = argparse.ArgumentParser(
+        description="Serve the processing metrics in Prometheus format"
+    )
+    parser.add_argument("metrics_directory", help="metrics directory")
+    parser.add_argument("--port", type=int, default=9400)
+    parser.add_argument("--address", default="")
+    parser.add_argument(
+        "--queue", help="shared queue directory (queue depth is added)"
+    )
+    args = parser.parse_args(argv)
+    server = start_metrics_server(
+        args.metrics_directory, args.port, args.queue, args.address
+    )
+    print(f"Metrics served on port {args.port}/metrics")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
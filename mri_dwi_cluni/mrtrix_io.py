@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Read / write MRtrix images (.mif) with numpy, without loading the
+data in memory (memory-mapped):
+    - read_mif_header
+    - get_numpy_dtype
+    - load_mif
+    - create_mif
+    - save_mif
+    - get_voxel_to_scanner
+
+Only the header fields needed by the pipeline are interpreted (dim,
+vox, layout, datatype, transform, scaling, file), the others are kept
+as text. Compressed images (.mif.gz) are read in memory.
+"""
+
+import gzip
+import os
+
+import numpy as np
+
+MIF_DATATYPES = {
+    "Int8": "i1",
+    "UInt8": "u1",
+    "Int16": "i2",
+    "UInt16": "u2",
+    "Int32": "i4",
+    "UInt32": "u4",
+    "Int64": "i8",
+    "UInt64": "u8",
+    "Float32": "f4",
+    "Float64": "f8",
+}
+NUMPY_DATATYPES = {
+    "i1": "Int8",
+    "u1": "UInt8",
+    "i2": "Int16LE",
+    "u2": "UInt16LE",
+    "i4": "Int32LE",
+    "u4": "UInt32LE",
+    "i8": "Int64LE",
+    "u8": "UInt64LE",
+    "f4": "Float32LE",
+    "f8": "Float64LE",
+    "b1": "UInt8",
+}
+HEADER_ALIGNMENT = 16
+
+
+def read_mif_header(in_file):
+    """
+    Read header of a MIF image
+
+    :returns: header: dictionary with dim (a list), vox (a list),
+              layout (a list of signed strides order), datatype,
+              transform (3 x 4 list), file, offset and keyvals
+              (other fields, dictionary key: list of values)
+    """
+    opener = gzip.open if in_file.endswith(".gz") else open
+    header = {"keyvals": {}}
+    with opener(in_file, "rb") as my_file:
+        if my_file.readline().strip() != b"mrtrix image":
+            raise ValueError(f"{in_file} is not a MIF image")
+        transform = []
+        for line in my_file:
+            line = line.decode("utf-8", errors="replace").rstrip("\n")
+            if line.strip() == "END":
+                break
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            key, value = key.strip(), value.strip()
+            if key == "dim":
+                header["dim"] = [int(size) for size in value.split(",")]
+            elif key == "vox":
+                header["vox"] = [float(size) for size in value.split(",")]
+            elif key == "layout":
+                header["layout"] = [axis.strip() for axis in value.split(",")]
+            elif key == "datatype":
+                header["datatype"] = value
+            elif key == "transform":
+                transform.append([float(item) for item in value.split(",")])
+            elif key == "scaling":
+                header["scaling"] = [float(item) for item in value.split(",")]
+            elif key == "file":
+                file_name, offset = (value.split() + ["0"])[:2]
+                header["file"] = file_name
+                header["offset"] = int(offset)
+            else:
+                header["keyvals"].setdefault(key, []).append(value)
+    header["transform"] = transform or [
+        [1.0, 0.0, 0.0, 0.0],
+        [0.0, 1.0, 0.0, 0.0],
+        [0.0, 0.0, 1.0, 0.0],
+    ]
+    return header
+
+
+def get_numpy_dtype(datatype):
+    """
+    Get numpy dtype of a MIF / tck datatype (ex: Float32LE),
+    Bit is not supported
+    """
+    endian = ">" if datatype.endswith("BE") else "<"
+    name = datatype[:-2] if datatype[-2:] in ["LE", "BE"] else datatype
+    if name not in MIF_DATATYPES:
+        raise ValueError(f"MIF datatype {datatype} not supported")
+    return np.dtype(endian + MIF_DATATYPES[name])
+
+
+def _order_axes(data, header):
+    """
+    Get array indexed by image axes from raw array stored with
+    slowest axis first (following the layout)
+    """
+    layout = header["layout"]
+    ranks = [int(axis[1:]) if axis[0] in "+-" else int(axis)
+             for axis in layout]
+    stored_axes = sorted(range(len(ranks)), key=lambda i: -ranks[i])
+    data = data.transpose([stored_axes.index(i) for i in range(len(ranks))])
+    for axis, stride in enumerate(layout):
+        if stride.startswith("-"):
+            data = np.flip(data, axis)
+    return data
+
+
+def load_mif(in_file, mode="r"):
+    """
+    Load MIF image data, memory-mapped for uncompressed images
+
+    :param mode: "r" (read only) or "r+" (read / write)
+    :returns: header (see read_mif_header) and data (array indexed
+              by image axes [x, y, z, volume], data is a view on the
+              file, it is not contiguous in general)
+    """
+    header = read_mif_header(in_file)
+    dim = header["dim"]
+    ranks = [int(axis[1:]) if axis[0] in "+-" else int(axis)
+             for axis in header["layout"]]
+    stored_shape = [dim[i] for i in sorted(range(len(dim)),
+                                           key=lambda i: -ranks[i])]
+    if header["file"] == ".":
+        data_file = in_file
+    else:
+        data_file = os.path.join(os.path.dirname(in_file), header["file"])
+
+    if header["datatype"] == "Bit":
+        # Bits packed from the least significant bit
+        nb_values = int(np.prod(dim))
+        opener = gzip.open if data_file.endswith(".gz") else open
+        with opener(data_file, "rb") as my_file:
+            my_file.seek(header["offset"])
+            packed = np.frombuffer(
+                my_file.read((nb_values + 7) // 8), dtype=np.uint8
+            )
+        raw = np.unpackbits(packed, bitorder="little")[:nb_values]
+        data = raw.astype(bool).reshape(stored_shape)
+    elif data_file.endswith(".gz"):
+        dtype = get_numpy_dtype(header["datatype"])
+        with gzip.open(data_file, "rb") as my_file:
+            my_file.seek(header["offset"])
+            raw = my_file.read(int(np.prod(dim)) * dtype.itemsize)
+        data = np.frombuffer(raw, dtype=dtype).reshape(stored_shape)
+    else:
+        data = np.memmap(
+            data_file,
+            dtype=get_numpy_dtype(header["datatype"]),
+            mode=mode,
+            offset=header["offset"],
+            shape=tuple(stored_shape),
+        )
+    data = _order_axes(data, header)
+    if "scaling" in header and header["scaling"] != [0.0, 1.0]:
+        offset, scale = header["scaling"]
+        data = offset + scale * data
+    return header, data
+
+
+def _format_header(header, dim, datatype, offset):
+    """Get header text of a MIF image stored with layout +0,+1,..."""
+    ndim = len(dim)
+    vox = (list(header.get("vox", [])) + [1.0] * ndim)[:ndim]
+    lines = [
+        "mrtrix image",
+        "dim: " + ",".join(str(size) for size in dim),
+        "vox: " + ",".join(f"{size:g}" for size in vox),
+        "layout: " + ",".join(f"+{axis}" for axis in range(ndim)),
+        "datatype: " + datatype,
+    ]
+    for row in header["transform"]:
+        lines.append("transform: " + ",".join(f"{item:.10g}" for item in row))
+    for key, values in header.get("keyvals", {}).items():
+        for value in values:
+            lines.append(f"{key}: {value}")
+    lines.append(f"file: . {offset}")
+    lines.append("END")
+    return "\n".join(lines) + "\n"
+
+
+def create_mif(out_file, header, dim, dtype):
+    """
+    Create a MIF image (layout +0,+1,...) and memory-map its data
+
+    :param header: header of a reference image (vox, transform and
+                   keyvals are copied, see read_mif_header)
+    :param dim: dimensions of the new image (a list)
+    :param dtype: numpy dtype (bool is stored as UInt8)
+    :returns: data (writable array indexed by image axes)
+    """
+    dtype = np.dtype(dtype)
+    datatype = NUMPY_DATATYPES[dtype.str.lstrip("<>|=")]
+    if dtype == bool:
+        dtype = np.dtype("u1")
+    # Offset depends on header length: iterate until it is stable
+    offset = 0
+    while True:
+        text = _format_header(header, dim, datatype, offset)
+        new_offset = -(-len(text.encode()) // HEADER_ALIGNMENT)
+        new_offset *= HEADER_ALIGNMENT
+        if new_offset == offset:
+            break
+        offset = new_offset
+    nb_bytes = int(np.prod(dim)) * dtype.itemsize
+    with open(out_file, "wb") as my_file:
+        my_file.write(text.encode().ljust(offset, b"\n"))
+        my_file.truncate(offset + nb_bytes)
+    # Layout +0,+1,... is Fortran order
+    return np.memmap(
+        out_file, dtype=dtype.newbyteorder("<"), mode="r+", offset=offset,
+        shape=tuple(dim), order="F",
+    )
+
+
+def save_mif(out_file, data, header, dtype=None):
+    """
+    Save array as MIF image, written by slabs along the last axis
+
+    :param header: header of a reference image (see create_mif)
+    """
+    dtype = np.dtype(dtype or data.dtype)
+    out_data = create_mif(out_file, header, list(data.shape), dtype)
+    slab = max(1, out_data.shape[-1] // 8)
+    for start in range(0, out_data.shape[-1], slab):
+        out_data[..., start:start + slab] = data[..., start:start + slab]
+    out_data.flush()
+    del out_data
+    return out_file
+
+
+def get_voxel_to_scanner(header):
+    """
+    Get 4 x 4 matrix from voxel indices to scanner coordinates (mm)
+    (MIF transform is given from image coordinates in mm)
+    """
+    matrix = np.eye(4)
+    matrix[:3, :] = np.array(header["transform"])
+    vox = np.array((list(header["vox"]) + [1.0, 1.0, 1.0])[:3])
+    matrix[:3, :3] = matrix[:3, :3] * vox
+    return matrix
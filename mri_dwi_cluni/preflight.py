@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-flight checks done before any expensive processing:
+    - check_executables
+    - check_mrtrix_version
+    - check_dwi_sidecar
+    - check_gradient_table
+    - estimate_resources
+    - check_resources
+    - run_preflight
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+
+from useful import execute_command, get_nifti_header_info
+
+# Executables needed for each part of the processing
+CONVERSION_EXECUTABLES = ["unzip", "dcm2bids", "dcm2niix"]
+DWI_EXECUTABLES = [
+    "mrconvert",
+    "mrinfo",
+    "dwidenoise",
+    "mrdegibbs",
+    "dwiextract",
+    "mrmath",
+    "mrcat",
+    "dwifslpreproc",
+    "eddy",
+    "dwibiascorrect",
+    "N4BiasFieldCorrection",
+    "dwi2response",
+    "dwi2fod",
+    "sh2peaks",
+]
+PEPOLAR_EXECUTABLES = ["topup", "applytopup"]
+WHOLE_BRAIN_EXECUTABLES = ["dwi2mask", "mtnormalise", "TractSeg", "Tracking"]
+PARTIAL_BRAIN_EXECUTABLES = ["mrgrid", "mrthreshold", "mrfilter", "tckgen"]
+ANAT_EXECUTABLES = [
+    "5ttgen",
+    "bet",
+    "fast",
+    "run_first_all",
+    "fslroi",
+    "flirt",
+    "transformconvert",
+    "mrtransform",
+    "5tt2gmwmi",
+]
+# FSL eddy can be installed under several names
+EXECUTABLES_ALTERNATIVES = {"eddy": ["eddy", "eddy_openmp", "eddy_cpu"]}
+
+MRTRIX_MIN_VERSION = (3, 0, 2)
+
+# Rough resource estimates, expressed as a number of copies
+# of the DWI in float32: intermediate images kept in the preprocessing
+# directory plus MRtrix / FSL temporary directories, and peak memory of eddy
+DISK_DWI_COPIES = 12
+MEMORY_DWI_COPIES = 4
+PHASE_ENCODING_DIRECTIONS = ["i", "i-", "j", "j-", "k", "k-"]
+
+
+def check_executables(executables):
+    """
+    Check that executables can be found in the PATH
+
+    :param executables: executables names (a list)
+    :returns: missing executables (a list)
+    """
+    missing = []
+    for executable in executables:
+        names = EXECUTABLES_ALTERNATIVES.get(executable, [executable])
+        if not any(shutil.which(name) for name in names):
+            missing.append(executable)
+    return missing
+
+
+def check_mrtrix_version():
+    """Check MRtrix version against MRTRIX_MIN_VERSION"""
+    cmd = ["mrinfo", "-version"]
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        msg = f"Can not get MRtrix version (exit code {result})"
+        return 0, msg
+    match = re.search(r"(\d+)\.(\d+)\.(\d+)", sdtoutl.decode("utf-8"))
+    if not match:
+        msg = "Can not read MRtrix version"
+        return 0, msg
+    version = tuple(int(number) for number in match.groups())
+    if version < MRTRIX_MIN_VERSION:
+        min_version = ".".join(str(number) for number in MRTRIX_MIN_VERSION)
+        msg = f"MRtrix>={min_version} needed (found {match.group(0)})"
+        return 0, msg
+    msg = f"MRtrix version {match.group(0)}"
+    return 1, msg
+
+
+def check_dwi_sidecar(in_json, in_pepolar_json=None):
+    """
+    Check the fields of the DWI json needed for the
+    motion distortion correction
+    """
+    errors = []
+    with open(in_json, encoding="utf-8") as my_json:
+        data = json.load(my_json)
+    readout_time = data.get(
+        "TotalReadoutTime", data.get("EstimatedTotalReadoutTime")
+    )
+    if readout_time is None:
+        errors.append(
+            f"TotalReadoutTime or EstimatedTotalReadoutTime missing "
+            f"in {in_json}"
+        )
+    elif not isinstance(readout_time, (int, float)) or readout_time <= 0:
+        errors.append(f"Invalid readout time ({readout_time}) in {in_json}")
+    pe_dir = data.get("PhaseEncodingDirection")
+    if pe_dir not in PHASE_ENCODING_DIRECTIONS:
+        errors.append(
+            f"PhaseEncodingDirection missing or invalid ({pe_dir}) "
+            f"in {in_json}"
+        )
+
+    if in_pepolar_json and pe_dir in PHASE_ENCODING_DIRECTIONS:
+        with open(in_pepolar_json, encoding="utf-8") as my_json:
+            data_pepolar = json.load(my_json)
+        pe_dir_pepolar = data_pepolar.get("PhaseEncodingDirection")
+        if pe_dir_pepolar is None:
+            errors.append(
+                f"PhaseEncodingDirection missing in {in_pepolar_json}"
+            )
+        elif pe_dir_pepolar == pe_dir:
+            errors.append(
+                "Pepolar image has the same phase encoding direction "
+                f"({pe_dir}) than the DWI"
+            )
+    if errors:
+        return 0, "\n".join(errors)
+    msg = f"Sidecar {in_json} ok"
+    return 1, msg
+
+
+def check_gradient_table(in_nifti):
+    """
+    Check that bval / bvec files exist and are consistent with
+    the number of volumes of the NIfTI image
+    """
+    bval = in_nifti.replace("nii.gz", "bval")
+    bvec = in_nifti.replace("nii.gz", "bvec")
+    for grad_file in [bval, bvec]:
+        if not os.path.exists(grad_file):
+            msg = f"Gradient file {grad_file} not found"
+            return 0, msg
+    try:
+        with open(bval, encoding="utf-8") as my_file:
+            bvalues = [float(value) for value in my_file.read().split()]
+        with open(bvec, encoding="utf-8") as my_file:
+            bvectors = [
+                [float(value) for value in line.split()]
+                for line in my_file.read().splitlines()
+                if line.strip()
+            ]
+    except ValueError:
+        msg = f"Gradient files of {in_nifti} can not be read"
+        return 0, msg
+
+    if len(bvectors) != 3:
+        msg = f"{bvec} should have 3 rows (found {len(bvectors)})"
+        return 0, msg
+    nb_directions = {len(row) for row in bvectors}
+    if nb_directions != {len(bvalues)}:
+        msg = (
+            f"Number of b-values ({len(bvalues)}) and b-vectors "
+            f"({sorted(nb_directions)}) differ for {in_nifti}"
+        )
+        return 0, msg
+    dim = get_nifti_header_info(in_nifti)["dim"]
+    nb_volumes = dim[3] if len(dim) > 3 else 1
+    if nb_volumes != len(bvalues):
+        msg = (
+            f"Number of volumes ({nb_volumes}) and gradient directions "
+            f"({len(bvalues)}) differ for {in_nifti}"
+        )
+        return 0, msg
+    msg = f"Gradient table of {in_nifti} ok"
+    return 1, msg
+
+
+def estimate_resources(in_dwi_nifti):
+    """
+    Estimate disk space and memory (in bytes) needed to
+    process the DWI from its header
+    """
+    info = get_nifti_header_info(in_dwi_nifti)
+    nb_values = 1
+    for size in info["dim"]:
+        nb_values *= size
+    # MRtrix writes intermediate images as float32
+    dwi_bytes = nb_values * max(info["bitpix"] // 8, 4)
+    estimate = {
+        "nb_values": nb_values,
+        "nb_volumes": info["dim"][3] if len(info["dim"]) > 3 else 1,
+        "dwi_bytes": dwi_bytes,
+        "disk_bytes": DISK_DWI_COPIES * dwi_bytes,
+        "memory_bytes": MEMORY_DWI_COPIES * dwi_bytes,
+    }
+    return estimate
+
+
+def get_available_memory():
+    """Get available memory in bytes (None if unknown)"""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as my_file:
+            for line in my_file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def check_resources(estimate, directories):
+    """
+    Check free disk space of the directories and available
+    memory against the estimate
+    """
+    errors = []
+    for directory in directories:
+        free = shutil.disk_usage(directory).free
+        if free < estimate["disk_bytes"]:
+            errors.append(
+                f"Not enough disk space in {directory} "
+                f"({free / 1e9:.1f} GB free, "
+                f"{estimate['disk_bytes'] / 1e9:.1f} GB needed)"
+            )
+    memory = get_available_memory()
+    if memory is not None and memory < estimate["memory_bytes"]:
+        errors.append(
+            f"Not enough memory ({memory / 1e9:.1f} GB available, "
+            f"{estimate['memory_bytes'] / 1e9:.1f} GB needed)"
+        )
+    if errors:
+        return 0, "\n".join(errors)
+    msg = "Disk space and memory ok"
+    return 1, msg
+
+
+def run_preflight(
+    in_dwi_nifti,
+    directories,
+    in_pepolar_nifti=None,
+    with_anat=False,
+    partial_brain=False,
+):
+    """
+    Run all the pre-flight checks and stop at the
+    first failing one
+
+    :param in_dwi_nifti: DWI (a string) or DWI runs (a list)
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    mylog.info("Launch pre-flight checks")
+
+    executables = list(DWI_EXECUTABLES)
+    if in_pepolar_nifti:
+        executables += PEPOLAR_EXECUTABLES
+    if partial_brain:
+        executables += PARTIAL_BRAIN_EXECUTABLES
+    else:
+        executables += WHOLE_BRAIN_EXECUTABLES
+        if with_anat:
+            executables += ANAT_EXECUTABLES
+    missing = check_executables(executables)
+    if missing:
+        msg = f"Executables not found: {', '.join(missing)}"
+        return 0, msg, info
+
+    result, msg = check_mrtrix_version()
+    if result == 0:
+        return 0, msg, info
+    mylog.info(msg)
+
+    if isinstance(in_dwi_nifti, str):
+        in_dwi_nifti = [in_dwi_nifti]
+    in_pepolar_json = None
+    if in_pepolar_nifti:
+        in_pepolar_json = in_pepolar_nifti.replace("nii.gz", "json")
+    for in_dwi_run in in_dwi_nifti:
+        result, msg = check_dwi_sidecar(
+            in_dwi_run.replace("nii.gz", "json"), in_pepolar_json
+        )
+        if result == 0:
+            return 0, msg, info
+
+        result, msg = check_gradient_table(in_dwi_run)
+        if result == 0:
+            return 0, msg, info
+    # Pepolar could be a reverse DWI with all shells
+    if in_pepolar_nifti and os.path.exists(
+        in_pepolar_nifti.replace("nii.gz", "bvec")
+    ):
+        result, msg = check_gradient_table(in_pepolar_nifti)
+        if result == 0:
+            return 0, msg, info
+
+    # Runs are concatenated: estimate on the sum of the runs
+    estimate = {}
+    for in_dwi_run in in_dwi_nifti:
+        for key, value in estimate_resources(in_dwi_run).items():
+            estimate[key] = estimate.get(key, 0) + value
+    result, msg = check_resources(estimate, directories)
+    if result == 0:
+        return 0, msg, info
+    info["estimate"] = estimate
+
+    msg = "Pre-flight checks done"
+    mylog.info(msg)
+    return 1, msg, info
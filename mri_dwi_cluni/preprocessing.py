@@ -2,15 +2,30 @@
 """
 Functions for preprocessing DWI data:
     - get_dwifslpreproc_command
+    - run_denoise_degibbs
+    - run_denoise_degibbs_runs
     - run_preproc_dwi
     - run_preproc_anat
+    - run_coreg_to_diff
+    - run_coreg_to_diff_batch
 
 """
 
 import logging
 import os
+import re
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from anat_cache import get_cached_anat, get_image_hash, store_anat_cache
+from brain_mask import run_partial_brain_mask, run_partial_brain_mask_mrtrix
+from publish import publish_file
+from retry import execute_command_retry
+from scratch import get_scratch_directory, use_scratch_directory
+from slab import (get_degibbs_axes, get_slice_axis,
+                  run_denoise_degibbs_slabs)
+from stages import get_job_info, use_job_info
 from useful import (check_file_ext, convert_mif_to_nifti,
                     convert_nifti_to_mif, execute_command,
                     get_shell)
@@ -59,35 +74,133 @@ def get_dwifslpreproc_command(
     return command
 
 
-def run_preproc_dwi(
-    in_dwi, pe_dir, readout_time, rpe=None, shell=True, in_pepolar=None,
-    partial_brain=False
-):
+def run_denoise_degibbs(in_dwi, nb_threads=None, slabs=None):
     """
-    Run preproc for whole brain diffusion using MRtrix command
+    Denoise and unring one DWI run
+
+    :param in_dwi: DWI in MIF format
+    :param nb_threads: number of threads used by MRtrix commands
+                       (None to let MRtrix choose)
+    :param slabs: settings of the processing by slabs (see slab.py),
+                  None to process the whole DWI at once
     """
+    if slabs is not None:
+        return run_denoise_degibbs_slabs(in_dwi, nb_threads, slabs)
     info = {}
-    mylog = logging.getLogger("custom_logger")
-    mylog.info("Launch preprocessing DWI")
-    # Get files name
     dir_name = os.path.dirname(in_dwi)
     valid_bool, in_ext, file_name = check_file_ext(in_dwi, {"MIF": "mif"})
+    threads_option = ["-nthreads", str(nb_threads)] if nb_threads else []
 
     # Denoise
     dwi_denoise = os.path.join(dir_name, file_name + "_denoise.mif")
-    cmd = ["dwidenoise", in_dwi, dwi_denoise]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    cmd = ["dwidenoise", in_dwi, dwi_denoise] + threads_option
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
-        msg = f"Can not lunch mrdegibbs (exit code {result})"
+        msg = f"Can not lunch dwidenoise (exit code {result})"
         return 0, msg, info
 
-    # DeGibbs / Unringing
+    # DeGibbs / Unringing (in-plane axes of the acquisition, as by slabs)
     dwi_degibbs = dwi_denoise.replace("_denoise.mif", "_denoise_degibbs.mif")
-    cmd = ["mrdegibbs", dwi_denoise, dwi_degibbs]
+    cmd = [
+        "mrdegibbs", dwi_denoise, dwi_degibbs,
+        "-axes", get_degibbs_axes(get_slice_axis(in_dwi)),
+    ] + threads_option
     result, stderrl, sdtoutl = execute_command(cmd)
     if result != 0:
         msg = f"Can not lunch mrdegibbs (exit code {result})"
         return 0, msg, info
+    info = {"dwi_degibbs": dwi_degibbs}
+    msg = f"Denoise and unringing of {in_dwi} done"
+    return 1, msg, info
+
+
+def run_denoise_degibbs_runs(in_dwi_list, slabs=None):
+    """
+    Denoise and unring several DWI runs in parallel (denoising must be
+    done before the concatenation) and concatenate them
+
+    :param in_dwi_list: DWI runs in MIF format (a list)
+    :param slabs: settings of the processing by slabs (see slab.py)
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    # Share the threads between the runs
+    nb_threads = max(1, (os.cpu_count() or 1) // len(in_dwi_list))
+    scratch_directory = get_scratch_directory()
+    job_info = get_job_info()
+
+    def run_one(in_dwi):
+        start = time.time()
+        with use_scratch_directory(scratch_directory), use_job_info(job_info):
+            result, msg, info = run_denoise_degibbs(in_dwi, nb_threads, slabs)
+        mylog.info(
+            "Denoise / unringing of %s done in %.1f s (result %s)",
+            os.path.basename(in_dwi), time.time() - start, result,
+        )
+        return result, msg, info
+
+    with ThreadPoolExecutor(max_workers=len(in_dwi_list)) as executor:
+        results = list(executor.map(run_one, in_dwi_list))
+    for result, msg, run_info in results:
+        if result == 0:
+            return 0, msg, info
+    dwi_degibbs_list = [run_info["dwi_degibbs"] for _, _, run_info in results]
+
+    # Concatenate the runs (gradient tables are concatenated by mrcat)
+    dir_name = os.path.dirname(in_dwi_list[0])
+    valid_bool, in_ext, file_name = check_file_ext(
+        in_dwi_list[0], {"MIF": "mif"}
+    )
+    concat_name = re.sub(r"_run-[0-9]+", "", file_name)
+    if concat_name == file_name:
+        concat_name = file_name + "_concat"
+    dwi_degibbs = os.path.join(dir_name, concat_name + "_denoise_degibbs.mif")
+    start = time.time()
+    cmd = ["mrcat"] + dwi_degibbs_list + [dwi_degibbs, "-axis", "3"]
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        msg = f"Can not launch mrcat (exit code {result})"
+        return 0, msg, info
+    mylog.info(
+        "Concatenation of %s runs done in %.1f s",
+        len(in_dwi_list), time.time() - start,
+    )
+    info = {"dwi_degibbs": dwi_degibbs}
+    msg = "Denoise and unringing of all the runs done"
+    return 1, msg, info
+
+
+def run_preproc_dwi(
+    in_dwi, pe_dir, readout_time, rpe=None, shell=True, in_pepolar=None,
+    partial_brain=False, mask_engine="numpy", slabs=None
+):
+    """
+    Run preproc for whole brain diffusion using MRtrix command
+
+    :param in_dwi: DWI in MIF format (a string) or DWI runs (a list),
+                   runs are denoised in parallel and concatenated
+                   before motion distortion correction
+    :param mask_engine: partial brain mask computed in-process ("numpy")
+                        or with MRtrix commands ("mrtrix")
+    :param slabs: settings of the denoising / unringing by slabs
+                  (see slab.py), None to process the whole DWI at once
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    mylog.info("Launch preprocessing DWI")
+
+    # Denoise and DeGibbs / Unringing
+    if isinstance(in_dwi, list):
+        result, msg, info = run_denoise_degibbs_runs(in_dwi, slabs)
+        # First run is used for b0 pair
+        in_dwi = in_dwi[0]
+    else:
+        result, msg, info = run_denoise_degibbs(in_dwi, slabs=slabs)
+    if result == 0:
+        return 0, msg, info
+    dwi_degibbs = info["dwi_degibbs"]
+    # Get files name
+    dir_name = os.path.dirname(in_dwi)
 
     # Create b0 pair for motion distortion correction
     if in_pepolar:
@@ -169,7 +282,7 @@ def run_preproc_dwi(
                 rpe=rpe,
                 shell=shell,
             )
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
         if result != 0:
             msg = f"Can not launch dwifslpreproc (exit code {result})"
             return 0, msg, info
@@ -177,7 +290,7 @@ def run_preproc_dwi(
     # Bias correction
     dwi_unbias = os.path.join(dir_name, dwi_out.replace(".mif", "_unbias.mif"))
     cmd = ["dwibiascorrect", "ants", dwi_out, dwi_unbias]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
         msg = f"Can not launch bias correction (exit code {result})"
         return 0, msg
@@ -197,29 +310,16 @@ def run_preproc_dwi(
     if partial_brain:
         # Binary mask of the brain for partial brain
         # because for optic nerve dwi2mask not ok
-        dwi_unbias_mean = dwi_unbias.replace(".mif", "_mean.mif")
-        cmd = ["mrmath", dwi_unbias, "mean", "-axis", "3", dwi_unbias_mean]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = "Can not launch mrmath (exit code {result})"
-            return 0, msg
-        dwi_unbias_mean_thres = dwi_unbias.replace(".mif", "_mean_thres.mif")
-        cmd = ["mrthreshold", dwi_unbias_mean, "-abs", "2", dwi_unbias_mean_thres]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = "Can not launch mrthreshold (exit code {result})"
-            return 0, msg
-        dwi_unbias_mean_thres_filt = dwi_unbias.replace(".mif", "_mean_thres_filt.mif")
-        cmd = ["mrfilter", dwi_unbias_mean_thres, "median", dwi_unbias_mean_thres_filt]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = "Can not launch mrfilter (exit code {result})"
-            return 0, msg
-        cmd = ["mrfilter", dwi_unbias_mean_thres_filt, "median", dwi_mask]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = "Can not launch mrfilter (exit code {result})"
-            return 0, msg
+        if mask_engine == "numpy":
+            result, msg, info = run_partial_brain_mask(dwi_unbias, dwi_mask)
+            if result == 0:
+                mylog.warning("%s, use MRtrix commands", msg)
+        if mask_engine != "numpy" or result == 0:
+            result, msg, info = run_partial_brain_mask_mrtrix(
+                dwi_unbias, dwi_mask
+            )
+        if result == 0:
+            return 0, msg, info
     else:
         cmd = ["dwi2mask", dwi_unbias, dwi_mask]
         result, stderrl, sdtoutl = execute_command(cmd)
@@ -233,9 +333,13 @@ def run_preproc_dwi(
     return 1, msg, info
 
 
-def run_preproc_anat(in_anat, in_dwi):
+def run_preproc_anat(in_anat, in_dwi, cache_directory=None):
     """
     Coregister anat to DWI
+
+    :param cache_directory: subject anatomical cache (see anat_cache.py),
+                            5ttgen outputs are reused if the anat has
+                            already been processed (None: no cache)
     """
     info = {}
     out_directory = os.path.dirname(in_anat)
@@ -259,17 +363,34 @@ def run_preproc_anat(in_anat, in_dwi):
     )
     # Creating tissue boundaries
     tissue_type = in_anat.replace(".nii.gz", "_5tt.nii.gz")
-    cmd = ["5ttgen", "fsl", in_anat, tissue_type]
-    result, stderrl, sdtoutl = execute_command(cmd)
-    if result != 0:
-        msg = f"Can not lunch 5ttgen (exit code {result})"
-        return 0, msg, info
     grey_matter = tissue_type.replace(".nii.gz", "_gm.nii.gz")
-    cmd = ["fslroi", tissue_type, grey_matter, "0", "1"]
-    result, stderrl, sdtoutl = execute_command(cmd)
-    if result != 0:
-        msg = f"Can not lunch fslroi (exit code {result})"
-        return 0, msg, info
+    cached = None
+    if cache_directory:
+        image_hash = get_image_hash(in_anat)
+        cached = get_cached_anat(cache_directory, image_hash)
+    if cached:
+        mylog.info("5ttgen outputs found in anat cache (%s)", image_hash)
+        publish_file(cached["tissue_type"], tissue_type)
+        publish_file(cached["grey_matter"], grey_matter)
+    else:
+        cmd = ["5ttgen", "fsl", in_anat, tissue_type]
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"Can not lunch 5ttgen (exit code {result})"
+            return 0, msg, info
+        cmd = ["fslroi", tissue_type, grey_matter, "0", "1"]
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"Can not lunch fslroi (exit code {result})"
+            return 0, msg, info
+        if cache_directory:
+            store_anat_cache(
+                cache_directory,
+                image_hash,
+                in_anat,
+                {"tissue_type": tissue_type, "grey_matter": grey_matter},
+            )
+            mylog.info("5ttgen outputs stored in anat cache (%s)", image_hash)
     # Coregistration with DWI
     transfo_mat = os.path.join(out_directory, "diff2struct_fsl.mat")
     cmd = [
@@ -376,6 +497,8 @@ def run_coreg_to_diff(in_seq, in_anat, diff2struct):
     out_directory = os.path.dirname(in_seq_coreg_t1_nii)
     result, msg, in_seq_coreg_t1 = convert_nifti_to_mif(
         in_seq_coreg_t1_nii, out_directory, diff=False)
+    if result == 0:
+        return 0, msg, info
     # Coreg to DWI
     in_seq_coreg_dwi = in_seq.replace("." + ext, "_coreg_dwi.mif")
     cmd = [
@@ -392,4 +515,68 @@ def run_coreg_to_diff(in_seq, in_anat, diff2struct):
         return 0, msg, info
     msg = "Coregistration done"
     info["in_seq_coreg"] = in_seq_coreg_dwi
-    return result, msg, info
+    return 1, msg, info
+
+
+def run_coreg_to_diff_batch(in_seq_list, in_anat, diff2struct, nb_threads=None):
+    """
+    Coregister several sequences to DWI at the same time
+    (flirt is single-threaded). All the sequences are processed
+    even if one of them fails.
+
+    :param in_seq_list: sequences in NIfTI format (a list)
+    :param in_anat: anatomical image used for diff2struct (NIfTI)
+    :param diff2struct: mrtrix transform matrix DWI to anat
+    :param nb_threads: maximum number of sequences processed
+                       at the same time (default: number of CPUs)
+    :returns:
+        - result: 1 if all the sequences are coregistered, else 0
+        - msg: message (with the errors)
+        - info: dictionary in_seq: {"result", "msg", "in_seq_coreg"}
+    """
+    info = {}
+    if not in_seq_list:
+        return 1, "No sequence to coregister", info
+    mylog = logging.getLogger("custom_logger")
+    mylog.info("Launch coregistration of %s sequences", len(in_seq_list))
+    nb_workers = min(len(in_seq_list), nb_threads or os.cpu_count() or 1)
+    scratch_directory = get_scratch_directory()
+    job_info = get_job_info()
+
+    def run_one(in_seq):
+        try:
+            with use_scratch_directory(scratch_directory), use_job_info(
+                job_info
+            ):
+                result, msg, seq_info = run_coreg_to_diff(
+                    in_seq, in_anat, diff2struct
+                )
+        except Exception as e:
+            result, msg, seq_info = 0, str(e), {}
+        return in_seq, result, msg, seq_info
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        for in_seq, result, msg, seq_info in executor.map(
+            run_one, in_seq_list
+        ):
+            info[in_seq] = {
+                "result": result,
+                "msg": msg,
+                "in_seq_coreg": seq_info.get("in_seq_coreg"),
+            }
+            if result == 0:
+                mylog.error(
+                    "Coregistration of %s failed: %s",
+                    os.path.basename(in_seq), msg,
+                )
+    errors = [
+        f"{os.path.basename(in_seq)}: {seq_info['msg']}"
+        for in_seq, seq_info in info.items()
+        if seq_info["result"] == 0
+    ]
+    if errors:
+        msg = "Coregistration failed for " + "; ".join(errors)
+        return 0, msg, info
+    msg = "Coregistration done"
+    mylog.info(msg)
+    return 1, msg, info
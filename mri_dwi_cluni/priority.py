@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""
+Priority of the jobs running on a node (ex: urgent clinical case
+processed during a research batch):
+    - get_priority_rank
+    - get_popen_options
+    - get_command_env
+    - register_command
+    - unregister_command
+    - terminate_commands
+    - PriorityScheduler
+    - PriorityListener
+    - add_priority_scheduling
+
+The jobs of the node and their priority are written in a ledger
+file (locked with fcntl, like the admission control ledger). When
+a job of a higher priority is running on the node:
+    - the commands started by the lower priority jobs get a fraction
+      of the threads (MRtrix, ITK and OpenMP threads)
+    - the stages of the lower priority jobs are deferred at the stage
+      boundaries ("defer" preemption, default)
+    - with the "pause" preemption, the running commands of the lower
+      priority jobs are also paused (SIGSTOP on their process group)
+      and resumed (SIGCONT) when no higher priority job is running.
+      Each process pauses and resumes its own commands: they are
+      resumed even if the higher priority job is killed. While their
+      commands are paused, the admission control reservations of
+      the jobs are marked paused: a stage of a higher priority job
+      waiting only for paused jobs is started anyway (see
+      admission.py).
+
+The waiting times (queue, deferred stages, paused commands) are given
+to the metrics by priority class (see metrics.py).
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from stages import STAGE_LISTENERS, get_job_info
+
+# Priority classes, from the highest priority
+PRIORITIES = ["urgent", "normal", "low"]
+DEFAULT_PRIORITY = "normal"
+PREEMPTIONS = ["none", "defer", "pause"]
+# Environment variables limiting the threads of the commands
+THREADS_ENV = [
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "MRTRIX_NTHREADS",
+]
+
+_SCHEDULER = None
+_COMMANDS = {}
+_COMMANDS_LOCK = threading.Lock()
+
+
+def get_priority_rank(priority):
+    """Rank of a priority class (0: highest priority)"""
+    if priority not in PRIORITIES:
+        priority = DEFAULT_PRIORITY
+    return PRIORITIES.index(priority)
+
+
+@contextmanager
+def _file_lock(lock_file):
+    """Exclusive lock on a file (shared between processes)"""
+    with open(lock_file, "a", encoding="utf-8") as my_lock:
+        fcntl.flock(my_lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(my_lock, fcntl.LOCK_UN)
+
+
+def _is_process_alive(pid):
+    """Check if a process of the node is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_popen_options():
+    """
+    Options of the commands (see useful.execute_command): own process
+    group when they can be paused
+    """
+    if _SCHEDULER is None or _SCHEDULER.preemption != "pause":
+        return {}
+    return {"start_new_session": True}
+
+
+def get_command_env():
+    """
+    Thread limits of a command of the current thread (empty if no
+    higher priority job is running on the node)
+    """
+    if _SCHEDULER is None:
+        return {}
+    rank = get_priority_rank(get_job_info().get("priority"))
+    if rank <= _SCHEDULER.get_running_rank():
+        return {}
+    nb_threads = max(
+        1, int((os.cpu_count() or 1) * _SCHEDULER.low_thread_fraction)
+    )
+    return {name: str(nb_threads) for name in THREADS_ENV}
+
+
+def register_command(process):
+    """Register a running command of the current thread"""
+    if _SCHEDULER is None:
+        return
+    job_info = get_job_info()
+    with _COMMANDS_LOCK:
+        _COMMANDS[process.pid] = {
+            "rank": get_priority_rank(job_info.get("priority")),
+            "job": job_info.get("job", str(os.getpid())),
+            "thread": threading.get_ident(),
+            "paused_since": None,
+            "paused_s": 0.0,
+        }
+    _SCHEDULER.start_monitor()
+
+
+def unregister_command(process):
+    """
+    Unregister a finished command, its paused time is added
+    to the stage running in the thread
+    """
+    with _COMMANDS_LOCK:
+        command = _COMMANDS.pop(process.pid, None)
+    if command is None or _SCHEDULER is None:
+        return
+    _SCHEDULER.add_paused_time(command["thread"], command["paused_s"])
+
+
+def terminate_commands():
+    """
+    Terminate the running commands (in their own process group with
+    the "pause" preemption), ex: task aborted by a shared queue worker.
+    Called from a signal handler: the lock is not taken
+    """
+    for pid in list(_COMMANDS):
+        for signum in [signal.SIGTERM, signal.SIGCONT]:
+            try:
+                os.killpg(pid, signum)
+            except OSError:
+                pass
+
+
+def _resume_all():
+    """Resume all the paused commands (end of the process)"""
+    with _COMMANDS_LOCK:
+        for pid, command in _COMMANDS.items():
+            if command["paused_since"] is not None:
+                try:
+                    os.killpg(pid, signal.SIGCONT)
+                except OSError:
+                    pass
+
+
+class PriorityScheduler:
+    """
+    Priorities of the jobs running on this node, shared by the
+    processes through a ledger file
+    """
+
+    def __init__(self, ledger_directory, preemption="defer",
+                 poll_interval=10, low_thread_fraction=0.25):
+        """
+        :param ledger_directory: directory of the ledger file
+                                 (one ledger by node)
+        :param preemption: "none" (threads only), "defer" (stages of
+                           the lower priority jobs deferred) or
+                           "pause" (commands also paused)
+        :param poll_interval: seconds between two checks of the ledger
+        :param low_thread_fraction: fraction of the CPUs given to the
+                                    commands of the lower priority jobs
+        """
+        self.ledger_file = os.path.join(
+            ledger_directory, f"priority_{socket.gethostname()}.json"
+        )
+        self.preemption = preemption
+        self.poll_interval = poll_interval
+        self.low_thread_fraction = low_thread_fraction
+        # Admission control ledger of the node (reservations of the
+        # paused jobs are marked), imported here: admission.py imports
+        # useful.py, which imports this module
+        from admission import AdmissionController
+
+        self.admission = AdmissionController(ledger_directory)
+        self._paused = {}
+        self._paused_jobs = set()
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    def _read_ledger(self):
+        """Read jobs of the node and remove the ones of dead processes"""
+        if not os.path.exists(self.ledger_file):
+            return []
+        try:
+            with open(self.ledger_file, encoding="utf-8") as my_json:
+                jobs = json.load(my_json)
+        except (OSError, ValueError):
+            return []
+        return [job for job in jobs if _is_process_alive(job["pid"])]
+
+    def _write_ledger(self, jobs):
+        """Write jobs of the node"""
+        tmp_file = f"{self.ledger_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as my_json:
+            json.dump(jobs, my_json, indent=4)
+        os.replace(tmp_file, self.ledger_file)
+
+    def register_job(self, job, priority):
+        """Add a job of the current process to the ledger"""
+        with _file_lock(self.ledger_file + ".lock"):
+            jobs = [
+                other for other in self._read_ledger()
+                if (other["pid"], other["job"]) != (os.getpid(), job)
+            ]
+            jobs.append({
+                "pid": os.getpid(),
+                "job": job,
+                "priority": priority,
+                "rank": get_priority_rank(priority),
+                "time": time.time(),
+            })
+            self._write_ledger(jobs)
+
+    def unregister_job(self, job):
+        """Remove a job of the current process from the ledger"""
+        with _file_lock(self.ledger_file + ".lock"):
+            self._write_ledger([
+                other for other in self._read_ledger()
+                if (other["pid"], other["job"]) != (os.getpid(), job)
+            ])
+
+    def get_running_rank(self):
+        """
+        Rank of the highest priority job running on the node
+        (lowest rank, len(PRIORITIES) if no job)
+        """
+        with _file_lock(self.ledger_file + ".lock"):
+            jobs = self._read_ledger()
+        return min([job["rank"] for job in jobs] + [len(PRIORITIES)])
+
+    def wait_turn(self, job, stage, rank):
+        """
+        Wait until no higher priority job is running on the node
+        (stage boundary of a lower priority job)
+
+        :returns: waiting time (seconds)
+        """
+        if self.preemption == "none":
+            return 0.0
+        mylog = logging.getLogger("custom_logger")
+        start = time.time()
+        logged = False
+        while self.get_running_rank() < rank:
+            if not logged:
+                mylog.info(
+                    "Stage %s of %s deferred: higher priority job running",
+                    stage, job,
+                )
+                logged = True
+            time.sleep(self.poll_interval)
+        waited = time.time() - start
+        if logged:
+            mylog.info("Stage %s of %s resumed after %.0f s",
+                       stage, job, waited)
+        return waited
+
+    def add_paused_time(self, thread, paused_s):
+        """Add paused time of a command to its thread"""
+        with self._lock:
+            self._paused[thread] = self._paused.get(thread, 0.0) + paused_s
+
+    def pop_paused_time(self):
+        """Get (and reset) paused time of the current thread"""
+        with self._lock:
+            return self._paused.pop(threading.get_ident(), 0.0)
+
+    def start_monitor(self):
+        """Start the thread pausing / resuming the commands"""
+        if self.preemption != "pause":
+            return
+        with self._lock:
+            if self._monitor is None:
+                self._monitor = threading.Thread(
+                    target=self._run_monitor, daemon=True
+                )
+                self._monitor.start()
+
+    def _run_monitor(self):
+        """Pause / resume the commands of this process"""
+        mylog = logging.getLogger("custom_logger")
+        while True:
+            time.sleep(self.poll_interval)
+            running_rank = self.get_running_rank()
+            now = time.time()
+            changed = False
+            with _COMMANDS_LOCK:
+                for pid, command in _COMMANDS.items():
+                    paused = command["paused_since"] is not None
+                    preempted = command["rank"] > running_rank
+                    if preempted == paused:
+                        continue
+                    try:
+                        os.killpg(
+                            pid, signal.SIGSTOP if preempted
+                            else signal.SIGCONT
+                        )
+                    except OSError:
+                        continue
+                    changed = True
+                    if preempted:
+                        command["paused_since"] = now
+                        mylog.info("Command %s paused: higher priority "
+                                   "job running", pid)
+                    else:
+                        command["paused_s"] += now - command["paused_since"]
+                        command["paused_since"] = None
+                        mylog.info("Command %s resumed", pid)
+                paused_jobs = {
+                    command["job"] for command in _COMMANDS.values()
+                    if command["paused_since"] is not None
+                }
+            if changed or paused_jobs != self._paused_jobs:
+                # A stage waiting only for the paused jobs is admitted
+                self.admission.set_paused(os.getpid(), paused_jobs)
+                self._paused_jobs = paused_jobs
+
+
+class PriorityListener:
+    """
+    Stage listener (see stages.py) registering the jobs in the
+    ledger and deferring the stages of the lower priority jobs.
+    It is the first listener (the stage is deferred before the
+    reservation of its resources) and gives the waiting times to
+    the next listeners: queue_wait_s (session start: time since the
+    submission of the job), deferred_s (start of the other stages)
+    and paused_s (end of a stage)
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def __call__(self, event, stage_info):
+        if event == "file":
+            return
+        stage = stage_info["stage"]
+        job = stage_info.get("job", str(os.getpid()))
+        priority = stage_info.get("priority", DEFAULT_PRIORITY)
+        stage_info["priority"] = priority
+        if stage == "session":
+            if event == "start":
+                if stage_info.get("submitted") is not None:
+                    stage_info["queue_wait_s"] = max(
+                        0.0, time.time() - stage_info["submitted"]
+                    )
+                self.scheduler.register_job(job, priority)
+            else:
+                self.scheduler.unregister_job(job)
+            return
+        if event == "start":
+            stage_info["deferred_s"] = self.scheduler.wait_turn(
+                job, stage, get_priority_rank(priority)
+            )
+        else:
+            stage_info["paused_s"] = self.scheduler.pop_paused_time()
+
+
+def add_priority_scheduling(config):
+    """
+    Add priority scheduling to the stages of the current process
+    (from "Priority" field of the configuration file: Preemption,
+    PollInterval, LowThreadFraction)
+    """
+    global _SCHEDULER
+    settings = config.get("Priority", {})
+    _SCHEDULER = PriorityScheduler(
+        config["WorkingDirectory"],
+        preemption=settings.get("Preemption", "defer"),
+        poll_interval=settings.get("PollInterval", 10),
+        low_thread_fraction=settings.get("LowThreadFraction", 0.25),
+    )
+    listener = PriorityListener(_SCHEDULER)
+    # First listener: deferred before the admission control
+    STAGE_LISTENERS.insert(0, listener)
+    return listener
+
+
+atexit.register(_resume_all)
@@ -6,13 +6,27 @@ Functions to get FOD from DWI data:
 import logging
 import os
 
-from useful import execute_command, get_shell
+from adaptive_tracking import (TRACKING_INCREMENT, TRACKING_MAX_STREAMLINES,
+                               TRACKING_MIN_STREAMLINES, TRACKING_TOLERANCE,
+                               run_adaptive_tckgen)
+from retry import execute_command_retry
+from useful import get_shell
 
 
-def run_processing_fod(in_dwi, brain_mask, partial_brain=False):
+def run_processing_fod(in_dwi, brain_mask, partial_brain=False,
+                       responses=None, tracking=None):
     """
     Get response function estimation and estimate Fiber
     Orientation Distributions (FOD) using MRTrix command
+
+    :param responses: response functions to use directly in dwi2fod
+                      (dictionary tissue: file, ex: average of the
+                      response library), dwi2response is then skipped
+                      if all the tissues needed are given
+    :param tracking: adaptive tracking of the partial brain (dictionary
+                     with the optional Increment, Tolerance,
+                     MinStreamlines and MaxStreamlines, see
+                     adaptive_tracking.py), None: 5000000 streamlines
     """
     info = {}
     dir_name = os.path.dirname(in_dwi)
@@ -24,24 +38,33 @@ def run_processing_fod(in_dwi, brain_mask, partial_brain=False):
     shell = [bval for bval in shell if float(bval) < 5 and bval != ""]
     if len(shell) > 1:
         # DWI response
-        wm = os.path.join(dir_name, "response_wm.txt")
-        gm = os.path.join(dir_name, "response_gm.txt")
-        csf = os.path.join(dir_name, "response_csf.txt")
-        voxels = os.path.join(dir_name, "response_voxels.mif")
-        cmd = [
-            "dwi2response",
-            "dhollander",
-            in_dwi,
-            wm,
-            gm,
-            csf,
-            "-voxels",
-            voxels,
-        ]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"Can not launch dwi2response (exit code {result})"
-            return 0, msg, info
+        if responses and all(
+            tissue in responses for tissue in ["wm", "gm", "csf"]
+        ):
+            wm, gm, csf = responses["wm"], responses["gm"], responses["csf"]
+            mylog.info("dwi2response skipped, responses given")
+            responses_estimated = False
+        else:
+            wm = os.path.join(dir_name, "response_wm.txt")
+            gm = os.path.join(dir_name, "response_gm.txt")
+            csf = os.path.join(dir_name, "response_csf.txt")
+            voxels = os.path.join(dir_name, "response_voxels.mif")
+            cmd = [
+                "dwi2response",
+                "dhollander",
+                in_dwi,
+                wm,
+                gm,
+                csf,
+                "-voxels",
+                voxels,
+            ]
+            result, stderrl, sdtoutl = execute_command_retry(cmd)
+            if result != 0:
+                msg = f"Can not launch dwi2response (exit code {result})"
+                return 0, msg, info
+            responses_estimated = True
+        used_responses = {"wm": wm, "gm": gm, "csf": csf}
         # FOD
         wm_fod = os.path.join(dir_name, "wmfod.mif")
         gm_fod = os.path.join(dir_name, "gmfod.mif")
@@ -59,7 +82,7 @@ def run_processing_fod(in_dwi, brain_mask, partial_brain=False):
             csf,
             csf_fod,
         ]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
         if result != 0:
             msg = f"Can not launch FOD (exit code {result})"
             return 0, msg, info
@@ -79,23 +102,30 @@ def run_processing_fod(in_dwi, brain_mask, partial_brain=False):
             "-mask",
             brain_mask,
         ]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
         if result != 0:
             msg = f"Can not launch normalise (exit code {result})"
             return 0, msg, info
         wm_fod = wm_fod_norm
     else:
         # DWI response
-        wm = os.path.join(dir_name, "response_wm.txt")
-        cmd = ["dwi2response", "tournier", in_dwi, wm]
-        result, stderrl, sdtoutl = execute_command(cmd)
-        if result != 0:
-            msg = f"Can not launch dwi2response (exit code {result})"
-            return 0, msg, info
+        if responses and "wm" in responses:
+            wm = responses["wm"]
+            mylog.info("dwi2response skipped, responses given")
+            responses_estimated = False
+        else:
+            wm = os.path.join(dir_name, "response_wm.txt")
+            cmd = ["dwi2response", "tournier", in_dwi, wm]
+            result, stderrl, sdtoutl = execute_command_retry(cmd)
+            if result != 0:
+                msg = f"Can not launch dwi2response (exit code {result})"
+                return 0, msg, info
+            responses_estimated = True
+        used_responses = {"wm": wm}
         # FOD
         wm_fod = os.path.join(dir_name, "wmfod.mif")
         cmd = ["dwi2fod", "csd", in_dwi, "-mask", brain_mask, wm, wm_fod]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
         if result != 0:
             msg = f"Can not launch FOD (exit code {result})"
             return 0, msg, info
@@ -103,22 +133,46 @@ def run_processing_fod(in_dwi, brain_mask, partial_brain=False):
     # Extract peaks
     peaks = os.path.join(dir_name, "peaks.mif")
     cmd = ["sh2peaks", wm_fod, peaks]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
         msg = f"Can not launch sh2peaks (exit code {result})"
         return 0, msg, info
-    info = {"peaks": peaks}
+    info = {
+        "peaks": peaks,
+        "responses": used_responses,
+        "responses_estimated": responses_estimated,
+    }
     msg = "FOD estimation done"
 
      # Tckgen
-    if partial_brain:
+    if partial_brain and tracking is not None:
+        result, msg_tracking, tracking_info = run_adaptive_tckgen(
+            wm_fod,
+            brain_mask,
+            dir_name,
+            increment=tracking.get("Increment", TRACKING_INCREMENT),
+            tolerance=tracking.get("Tolerance", TRACKING_TOLERANCE),
+            min_streamlines=tracking.get(
+                "MinStreamlines", TRACKING_MIN_STREAMLINES
+            ),
+            max_streamlines=tracking.get(
+                "MaxStreamlines", TRACKING_MAX_STREAMLINES
+            ),
+        )
+        if result == 0:
+            return 0, msg_tracking, info
+        msg += " + adaptive tckgen done"
+        info["tracto"] = tracking_info["tracto"]
+        info["tracking"] = tracking_info
+    elif partial_brain:
         msg += " + tckgen done"
         tracto = os.path.join(dir_name, "tracto_5000000.tck")
         cmd = ["tckgen", wm_fod, "-seed_dynamic", wm_fod, "-mask", brain_mask,
         tracto, "-select", "5000000", "-minlength", "20"]
-        result, stderrl, sdtoutl = execute_command(cmd)
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
         if result != 0:
             msg = f"Can not launch tckgen (exit code {result})"
             return 0, msg, info
+        info["tracto"] = tracto
     mylog.info(msg)
     return 1, msg, info
@@ -6,15 +6,22 @@ Functions to used TracSeg software:
 """
 import logging
 
-from useful import check_file_ext, execute_command
+from retry import execute_command_retry
+from useful import check_file_ext
 
 EXT_NIFTI = {"NIFTI_GZ": "nii.gz", "NIFTI": "nii"}
+# Number of bundles tracked by TractSeg when no subset is given
+TRACTSEG_NB_BUNDLES = 72
 
 
-def run_tractseg(peaks):
+def run_tractseg(peaks, bundles=None, uncertainty=False):
     """
     Run all the command from TractSeg sofwrae.
     Peaks image should be in NIfTI format
+
+    :param bundles: bundles tracked (a list, ex: ["CST_left",
+                    "CST_right"]), None: all the bundles
+    :param uncertainty: compute the uncertainty maps (a boolean)
     """
     mylog = logging.getLogger("custom_logger")
     mylog.info("Launch processing FOD")
@@ -25,30 +32,35 @@ def run_tractseg(peaks):
         return 0, msg
 
     cmd = ["TractSeg", "-i", peaks, "--output_type", "tract_segmentation"]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
         msg = f"Can not run TractSeg tract_segmentation (exit code {result})"
         return 0, msg
     cmd = ["TractSeg", "-i", peaks, "--output_type", "endings_segmentation"]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
         msg = f"Can not run TractSeg endings_segmentation (exit code {result})"
         return 0, msg
     cmd = ["TractSeg", "-i", peaks, "--output_type", "TOM"]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
         msg = f"Can not run TractSeg TOM (exit code {result})"
         return 0, msg
+    # Segmentations and TOM are predicted for all the bundles at
+    # once, the tracking is done bundle by bundle
     cmd = ["Tracking", "-i", peaks, "--tracking_format", "tck"]
-    result, stderrl, sdtoutl = execute_command(cmd)
+    if bundles:
+        cmd += ["--bundles", ",".join(bundles)]
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
     if result != 0:
         msg = f"Can not run TractSeg Tracking (exit code {result})"
         return 0, msg
-    cmd = ["TractSeg", "-i", peaks, "--uncertainty"]
-    result, stderrl, sdtoutl = execute_command(cmd)
-    if result != 0:
-        msg = f"Can not run TractSeg uncertainty (exit code {result})"
-        return 0, msg
+    if uncertainty:
+        cmd = ["TractSeg", "-i", peaks, "--uncertainty"]
+        result, stderrl, sdtoutl = execute_command_retry(cmd)
+        if result != 0:
+            msg = f"Can not run TractSeg uncertainty (exit code {result})"
+            return 0, msg
     msg = "Run TracSeg done"
     mylog.info(msg)
     return 1, msg
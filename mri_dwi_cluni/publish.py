@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Publication of files (results in the analysis directory, inputs in
+the preprocessing directory, cache entries) without copying the data
+when the source and the destination are on the same filesystem:
+    - reflink_file
+    - publish_file
+    - publish_tree
+
+Methods tried in order:
+    - rename (only if the source is not needed anymore, move=True)
+    - reflink (copy-on-write clone, ex: btrfs, xfs)
+    - hardlink (the files are never modified in place by the
+      processing: MRtrix removes an existing output before writing)
+    - copy (different filesystems)
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+# ioctl request of Linux cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+# Errors meaning that a method is not possible for these files
+FALLBACK_ERRORS = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.EMLINK,
+    errno.ENOSYS,
+}
+
+
+def reflink_file(in_file, out_file):
+    """Clone a file (copy-on-write), raises OSError if not possible"""
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflink not supported")
+    with open(in_file, "rb") as src, open(out_file, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(in_file, out_file)
+
+
+def _publish_tmp(in_file, tmp_file):
+    """
+    Create tmp_file from in_file with the first possible
+    method (reflink, hardlink, copy)
+
+    :returns: method and number of bytes copied
+    """
+    try:
+        reflink_file(in_file, tmp_file)
+        return "reflink", 0
+    except OSError as error:
+        if error.errno not in FALLBACK_ERRORS:
+            raise
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    try:
+        os.link(in_file, tmp_file)
+        return "hardlink", 0
+    except OSError as error:
+        if error.errno not in FALLBACK_ERRORS:
+            raise
+    shutil.copy(in_file, tmp_file)
+    return "copy", os.path.getsize(tmp_file)
+
+
+def publish_file(in_file, out_file, move=False, verbose=True):
+    """
+    Publish a file (same destination as shutil.copy: out_file
+    can be a directory, an existing file is replaced atomically)
+
+    :param move: the source is not needed anymore (a boolean)
+    :param verbose: write the method in the log (a boolean)
+    :returns: info: dictionary with out_file, method (rename,
+              reflink, hardlink or copy) and bytes_copied
+    """
+    if os.path.isdir(out_file):
+        out_file = os.path.join(out_file, os.path.basename(in_file))
+    method = None
+    bytes_copied = 0
+    if move:
+        try:
+            os.replace(in_file, out_file)
+            method = "rename"
+        except OSError as error:
+            if error.errno not in FALLBACK_ERRORS:
+                raise
+    if method is None:
+        fd, tmp_file = tempfile.mkstemp(
+            prefix=".publish_", dir=os.path.dirname(os.path.abspath(out_file))
+        )
+        os.close(fd)
+        os.remove(tmp_file)
+        try:
+            method, bytes_copied = _publish_tmp(in_file, tmp_file)
+            os.replace(tmp_file, out_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        if move:
+            os.remove(in_file)
+    if verbose:
+        mylog = logging.getLogger("custom_logger")
+        mylog.info(
+            "Published %s (%s, %d bytes copied)",
+            out_file, method, bytes_copied,
+        )
+    return {"out_file": out_file, "method": method,
+            "bytes_copied": bytes_copied}
+
+
+def publish_tree(in_directory, out_directory, move=False):
+    """
+    Publish a directory (out_directory should not exist),
+    renamed as a whole if move is True and it is possible
+
+    :returns: info: dictionary with out_directory, methods
+              (number of files by method) and bytes_copied
+    """
+    info = {"out_directory": out_directory, "methods": {}, "bytes_copied": 0}
+    if move:
+        try:
+            os.rename(in_directory, out_directory)
+            info["methods"]["rename"] = 1
+            mylog = logging.getLogger("custom_logger")
+            mylog.info("Published %s (rename)", out_directory)
+            return info
+        except OSError as error:
+            if error.errno not in FALLBACK_ERRORS:
+                raise
+    for root, directories, files in os.walk(in_directory):
+        out_root = os.path.join(
+            out_directory, os.path.relpath(root, in_directory)
+        )
+        os.makedirs(out_root, exist_ok=True)
+        for file_name in files:
+            file_info = publish_file(
+                os.path.join(root, file_name),
+                os.path.join(out_root, file_name),
+                move=move,
+                verbose=False,
+            )
+            methods = info["methods"]
+            methods[file_info["method"]] = (
+                methods.get(file_info["method"], 0) + 1
+            )
+            info["bytes_copied"] += file_info["bytes_copied"]
+    if move:
+        shutil.rmtree(in_directory)
+    mylog = logging.getLogger("custom_logger")
+    mylog.info(
+        "Published %s (%s, %d bytes copied)",
+        out_directory,
+        ", ".join(f"{nb} {method}" for method, nb in info["methods"].items()),
+        info["bytes_copied"],
+    )
+    return info
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Quality control report of a session without display (headless
+nodes): PNG snapshots of the mid-slices of the memory-mapped images
+(only the slices are read), track overlays and a static HTML page:
+    - write_png
+    - get_mid_slices
+    - render_image_snapshot
+    - render_peaks_snapshot
+    - render_tracks_snapshot
+    - write_html_report
+    - start_qc_snapshots
+    - run_qc_report
+
+Report layout:
+    derivatives/sub-*/ses-*/qc/index.html
+    derivatives/sub-*/ses-*/qc/*.png
+"""
+
+import html
+import logging
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mrtrix_io import get_voxel_to_scanner, load_mif
+from tck_io import iter_streamlines
+
+VIEWS = ["axial", "coronal", "sagittal"]
+# Snapshots are enlarged to about this size (pixels)
+SNAPSHOT_SIZE = 256
+MAX_STREAMLINES = 2000
+# Bundles of TractSeg drawn on the tracks snapshot
+QC_BUNDLES = ["CST_left", "CST_right"]
+MASK_COLOR = (255, 0, 0)
+TRACK_COLORS = [(255, 64, 64), (64, 128, 255), (64, 255, 64), (255, 255, 0)]
+# Snapshots are rendered during the end of the processing
+_QC_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+
+def write_png(out_file, rgb):
+    """
+    Write an RGB image as PNG (8 bits, no filter)
+
+    :param rgb: array (rows x columns x 3, uint8)
+    """
+    rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+    height, width = rgb.shape[:2]
+    # Filter type 0 before each row
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(chunk_type, data):
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+        )
+
+    with open(out_file, "wb") as my_file:
+        my_file.write(b"\x89PNG\r\n\x1a\n")
+        my_file.write(chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        ))
+        my_file.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        my_file.write(chunk(b"IEND", b""))
+    return out_file
+
+
+def _orient(slice_2d):
+    """Rows from top to bottom (anterior / superior at the top)"""
+    return np.asarray(slice_2d).T[::-1]
+
+
+def get_mid_slices(data, volume=0, indices=None):
+    """
+    Get the mid-slices of an image (only these slices are read
+    from a memory-mapped image)
+
+    :param volume: volume of a 4D image
+    :param indices: slice index by view (default: middle)
+    :returns: dictionary view: 2D array oriented for display
+    """
+    if data.ndim > 3:
+        data = data[..., volume]
+    shape = data.shape[:3]
+    indices = indices or {
+        view: shape[2 - i] // 2 for i, view in enumerate(VIEWS)
+    }
+    return {
+        "axial": _orient(data[:, :, indices["axial"]]),
+        "coronal": _orient(data[:, indices["coronal"], :]),
+        "sagittal": _orient(data[indices["sagittal"], :, :]),
+    }
+
+
+def _to_rgb(slice_2d):
+    """Grey levels between the 1st and 99th percentiles"""
+    slice_2d = np.nan_to_num(np.asarray(slice_2d, dtype=np.float32))
+    lower, upper = np.percentile(slice_2d, [1, 99])
+    scaled = np.clip((slice_2d - lower) / max(upper - lower, 1e-6), 0, 1)
+    return np.repeat((scaled * 255).astype(np.uint8)[..., None], 3, axis=2)
+
+
+def _add_contour(rgb, mask_2d, color=MASK_COLOR):
+    """Draw the contour of a mask on an RGB slice"""
+    mask_2d = np.asarray(mask_2d) > 0
+    inner = mask_2d.copy()
+    inner[1:, :] &= mask_2d[:-1, :]
+    inner[:-1, :] &= mask_2d[1:, :]
+    inner[:, 1:] &= mask_2d[:, :-1]
+    inner[:, :-1] &= mask_2d[:, 1:]
+    rgb[mask_2d & ~inner] = color
+    return rgb
+
+
+def _get_zoom(slices):
+    """Integer zoom factor of the snapshots"""
+    size = max(max(slice_2d.shape[:2]) for slice_2d in slices.values())
+    return max(1, SNAPSHOT_SIZE // max(size, 1))
+
+
+def _save_mosaic(out_file, rgb_slices, zoom):
+    """Save the views side by side"""
+    height = max(rgb.shape[0] for rgb in rgb_slices) * zoom
+    tiles = []
+    for rgb in rgb_slices:
+        rgb = np.repeat(np.repeat(rgb, zoom, axis=0), zoom, axis=1)
+        tile = np.zeros((height, rgb.shape[1] + 4, 3), dtype=np.uint8)
+        tile[:rgb.shape[0], :rgb.shape[1]] = rgb
+        tiles.append(tile)
+    return write_png(out_file, np.concatenate(tiles, axis=1))
+
+
+def _resample_mask_slices(mask_data, mask_header, header, indices):
+    """
+    Mid-slices of a mask in the grid of another image (nearest
+    neighbour, through scanner coordinates)
+    """
+    shape = header["dim"][:3]
+    to_mask = np.linalg.inv(get_voxel_to_scanner(mask_header)) @ (
+        get_voxel_to_scanner(header)
+    )
+    mask_data = np.asarray(mask_data) > 0
+    grids = {
+        "axial": np.meshgrid(
+            np.arange(shape[0]), np.arange(shape[1]), [indices["axial"]],
+            indexing="ij",
+        ),
+        "coronal": np.meshgrid(
+            np.arange(shape[0]), [indices["coronal"]], np.arange(shape[2]),
+            indexing="ij",
+        ),
+        "sagittal": np.meshgrid(
+            [indices["sagittal"]], np.arange(shape[1]), np.arange(shape[2]),
+            indexing="ij",
+        ),
+    }
+    slices = {}
+    for view, grid in grids.items():
+        voxels = np.stack([axis.ravel() for axis in grid] + [
+            np.ones(grid[0].size)
+        ])
+        mask_voxels = np.rint(to_mask @ voxels)[:3].astype(int)
+        inside = np.all(
+            (mask_voxels >= 0)
+            & (mask_voxels < np.array(mask_data.shape[:3])[:, None]),
+            axis=0,
+        )
+        values = np.zeros(grid[0].size, dtype=bool)
+        values[inside] = mask_data[tuple(mask_voxels[:, inside])]
+        slices[view] = _orient(np.squeeze(values.reshape(grid[0].shape)))
+    return slices
+
+
+def render_image_snapshot(in_image, out_png, in_mask=None, volume=0):
+    """
+    Render mid-slices of an image (MIF), with the contour of
+    a mask (MIF, any grid)
+
+    :returns: info about the image (dim, vox)
+    """
+    header, data = load_mif(in_image)
+    shape = header["dim"][:3]
+    indices = {view: shape[2 - i] // 2 for i, view in enumerate(VIEWS)}
+    slices = get_mid_slices(data, volume, indices)
+    rgb_slices = {view: _to_rgb(slice_2d) for view, slice_2d in slices.items()}
+    info = {"dim": header["dim"], "vox": header["vox"]}
+    if in_mask:
+        mask_header, mask_data = load_mif(in_mask)
+        if mask_header["dim"][:3] == shape and (
+            mask_header["transform"] == header["transform"]
+        ):
+            mask_slices = get_mid_slices(mask_data, 0, indices)
+        else:
+            mask_slices = _resample_mask_slices(
+                mask_data, mask_header, header, indices
+            )
+        for view in VIEWS:
+            _add_contour(rgb_slices[view], mask_slices[view])
+        info["mask_voxels"] = int((np.asarray(mask_data) > 0).sum())
+    _save_mosaic(
+        out_png, [rgb_slices[view] for view in VIEWS], _get_zoom(slices)
+    )
+    return info
+
+
+def render_peaks_snapshot(in_peaks, out_png):
+    """
+    Render mid-slices of the first peak (sh2peaks output) in
+    direction-encoded colours (red: x, green: y, blue: z)
+    """
+    header, data = load_mif(in_peaks)
+    peak_slices = [get_mid_slices(data, volume) for volume in range(3)]
+    rgb_slices = []
+    for view in VIEWS:
+        direction = np.abs(np.nan_to_num(np.stack(
+            [peak_slices[volume][view] for volume in range(3)], axis=2
+        ).astype(np.float32)))
+        norm = np.linalg.norm(direction, axis=2, keepdims=True)
+        rgb = direction / np.maximum(norm, 1e-6)
+        # Brightness from the peak amplitude
+        amplitude = norm / max(np.percentile(norm, 99), 1e-6)
+        rgb_slices.append(
+            (np.clip(rgb * amplitude, 0, 1) * 255).astype(np.uint8)
+        )
+    _save_mosaic(out_png, rgb_slices, _get_zoom(peak_slices[0]))
+    return {"dim": header["dim"], "vox": header["vox"]}
+
+
+def render_tracks_snapshot(
+    in_background, tck_files, out_png, max_streamlines=MAX_STREAMLINES
+):
+    """
+    Render tracks projected on the mid-slices of a background
+    image (only the first max_streamlines of each file are read)
+
+    :param tck_files: tck files (a list, one colour by file)
+    :returns: info: dictionary tck file: number of streamlines drawn
+    """
+    header, data = load_mif(in_background)
+    shape = header["dim"][:3]
+    slices = get_mid_slices(data)
+    zoom = _get_zoom(slices)
+    rgb_slices = {
+        view: np.repeat(np.repeat(_to_rgb(slice_2d) // 2, zoom, axis=0),
+                        zoom, axis=1)
+        for view, slice_2d in slices.items()
+    }
+    to_voxel = np.linalg.inv(get_voxel_to_scanner(header))
+    # (column axis, row axis) of each view in voxel coordinates
+    view_axes = {"axial": (0, 1), "coronal": (0, 2), "sagittal": (1, 2)}
+    info = {}
+    for i, tck_file in enumerate(tck_files):
+        color = TRACK_COLORS[i % len(TRACK_COLORS)]
+        nb_streamlines = 0
+        for streamline in iter_streamlines(tck_file, max_streamlines):
+            nb_streamlines += 1
+            points = np.asarray(streamline, dtype=np.float64)
+            voxels = (to_voxel[:3, :3] @ points.T).T + to_voxel[:3, 3]
+            for view, (col_axis, row_axis) in view_axes.items():
+                cols = np.rint(voxels[:, col_axis] * zoom).astype(int)
+                rows = np.rint(
+                    (shape[row_axis] - 1 - voxels[:, row_axis]) * zoom
+                ).astype(int)
+                rgb = rgb_slices[view]
+                inside = (
+                    (rows >= 0) & (rows < rgb.shape[0])
+                    & (cols >= 0) & (cols < rgb.shape[1])
+                )
+                rgb[rows[inside], cols[inside]] = color
+        info[tck_file] = nb_streamlines
+    _save_mosaic(out_png, [rgb_slices[view] for view in VIEWS], 1)
+    return info
+
+
+def write_html_report(out_html, title, sections):
+    """
+    Write the static HTML report
+
+    :param sections: list of dictionaries with title, png (file
+                     name in the report directory) and text
+    """
+    lines = [
+        "<!DOCTYPE html>",
+        "<html><head><meta charset='utf-8'>",
+        f"<title>{html.escape(title)}</title>",
+        "<style>body{font-family:sans-serif;background:#222;color:#eee}"
+        "img{max-width:100%;image-rendering:pixelated}</style>",
+        "</head><body>",
+        f"<h1>{html.escape(title)}</h1>",
+    ]
+    for section in sections:
+        lines.append(f"<h2>{html.escape(section['title'])}</h2>")
+        if section.get("text"):
+            lines.append(f"<p>{html.escape(section['text'])}</p>")
+        if section.get("png"):
+            lines.append(
+                f"<img src='{html.escape(section['png'])}' "
+                f"alt='{html.escape(section['title'])}'>"
+            )
+    lines.append("</body></html>")
+    with open(out_html, "w", encoding="utf-8") as my_file:
+        my_file.write("\n".join(lines) + "\n")
+    return out_html
+
+
+def _format_info(info):
+    """Short description of an image"""
+    dim = "x".join(str(size) for size in info["dim"])
+    vox = "x".join(f"{size:g}" for size in info["vox"][:3])
+    text = f"Dimensions {dim}, voxel size {vox} mm"
+    if "mask_voxels" in info:
+        text += f", {info['mask_voxels']} voxels in the brain mask"
+    return text
+
+
+def _render_snapshots(qc_directory, images):
+    """Render the snapshots of the images (see start_qc_snapshots)"""
+    os.makedirs(qc_directory, exist_ok=True)
+    sections = []
+    snapshots = [
+        ("dwi", "DWI (b0) and brain mask", "brain_mask"),
+        ("t1", "T1 coregistered to DWI and brain mask", "brain_mask"),
+    ]
+    for name, title, mask_name in snapshots:
+        if not images.get(name):
+            continue
+        png = f"{name}.png"
+        info = render_image_snapshot(
+            images[name], os.path.join(qc_directory, png),
+            images.get(mask_name),
+        )
+        sections.append({"title": title, "png": png, "text": _format_info(info)})
+    if images.get("peaks"):
+        info = render_peaks_snapshot(
+            images["peaks"], os.path.join(qc_directory, "peaks.png")
+        )
+        sections.append({
+            "title": "First FOD peak (red: x, green: y, blue: z)",
+            "png": "peaks.png",
+            "text": _format_info(info),
+        })
+    return sections
+
+
+def _run_snapshots(qc_directory, images):
+    """Render the snapshots, returns result, msg and sections"""
+    try:
+        sections = _render_snapshots(qc_directory, images)
+    except (OSError, ValueError, KeyError, IndexError) as error:
+        return 0, f"Can not render QC snapshots ({error})", []
+    return 1, "QC snapshots done", sections
+
+
+def start_qc_snapshots(qc_directory, images):
+    """
+    Render the snapshots of the images in a background thread
+
+    :param images: dictionary with the MIF images: dwi, brain_mask,
+                   peaks and t1 (missing or None are skipped)
+    :returns: future (future.result() gives result, msg and sections)
+    """
+    return _QC_EXECUTOR.submit(_run_snapshots, qc_directory, images)
+
+
+def run_qc_report(qc_directory, title, snapshots, background=None,
+                  tck_files=None):
+    """
+    Write the QC report with the snapshots and the tracks
+
+    :param snapshots: result of start_qc_snapshots (a future)
+    :param background: image used for the tracks (MIF)
+    :param tck_files: tracks drawn on the background (a list)
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    result, msg, sections = snapshots.result()
+    if result == 0:
+        mylog.warning(msg)
+    tck_files = [
+        tck_file for tck_file in tck_files or [] if os.path.exists(tck_file)
+    ]
+    if background and tck_files:
+        try:
+            tracks_info = render_tracks_snapshot(
+                background, tck_files, os.path.join(qc_directory, "tracks.png")
+            )
+            text = ", ".join(
+                f"{os.path.basename(tck_file)}: {nb} streamlines drawn"
+                for tck_file, nb in tracks_info.items()
+            )
+            sections.append(
+                {"title": "Tracks", "png": "tracks.png", "text": text}
+            )
+        except (OSError, ValueError, KeyError, IndexError) as error:
+            mylog.warning("Can not render tracks (%s)", error)
+    if not sections:
+        msg = "No QC snapshot"
+        return 0, msg, info
+    os.makedirs(qc_directory, exist_ok=True)
+    info["report"] = write_html_report(
+        os.path.join(qc_directory, "index.html"), title, sections
+    )
+    msg = f"QC report written in {info['report']}"
+    mylog.info(msg)
+    return 1, msg, info
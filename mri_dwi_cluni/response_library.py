@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Library of response functions by acquisition protocol, used to
+build a site / protocol average response and to skip dwi2response
+for the subjects scanned with a known protocol:
+    - get_acquisition_fingerprint
+    - add_subject_responses
+    - build_average_response
+    - get_library_response
+
+Library layout:
+    <library>/<fingerprint>/fingerprint.json
+    <library>/<fingerprint>/subjects/<subject>/response_<tissue>.txt
+    <library>/<fingerprint>/average/response_<tissue>.txt
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from useful import execute_command
+
+# Sidecar fields defining a protocol
+FINGERPRINT_FIELDS = [
+    "Manufacturer",
+    "ManufacturersModelName",
+    "MagneticFieldStrength",
+    "EchoTime",
+    "RepetitionTime",
+]
+# b-values are rounded (scanners give slightly different values)
+BVALUE_ROUNDING = 50
+TISSUES = ["wm", "gm", "csf"]
+
+
+def get_acquisition_fingerprint(in_json, in_bval_list):
+    """
+    Get fingerprint of the DWI protocol from the BIDS sidecar
+    (scanner, TE / TR) and the gradient table (number of
+    directions by shell)
+
+    :param in_json: DWI json (first run)
+    :param in_bval_list: bval files of all the DWI runs (a list)
+    :returns:
+        - fingerprint: short hash (a string)
+        - description: fields used for the hash (a dictionary)
+    """
+    with open(in_json, encoding="utf-8") as my_json:
+        data = json.load(my_json)
+    description = {}
+    for field in FINGERPRINT_FIELDS:
+        value = data.get(field)
+        if isinstance(value, float):
+            value = round(value, 4)
+        description[field] = value
+    shells = {}
+    for in_bval in in_bval_list:
+        with open(in_bval, encoding="utf-8") as my_file:
+            for value in my_file.read().split():
+                bvalue = int(
+                    round(float(value) / BVALUE_ROUNDING) * BVALUE_ROUNDING
+                )
+                shells[str(bvalue)] = shells.get(str(bvalue), 0) + 1
+    description["Shells"] = dict(sorted(shells.items(), key=lambda x: int(x[0])))
+    fingerprint = hashlib.sha1(
+        json.dumps(description, sort_keys=True).encode()
+    ).hexdigest()[:16]
+    return fingerprint, description
+
+
+def _get_protocol_directory(library_directory, fingerprint, description=None):
+    """Get (and create) the directory of a protocol"""
+    protocol_directory = os.path.join(library_directory, fingerprint)
+    if description is not None and not os.path.exists(protocol_directory):
+        os.makedirs(protocol_directory, exist_ok=True)
+        with open(
+            os.path.join(protocol_directory, "fingerprint.json"),
+            "w",
+            encoding="utf-8",
+        ) as my_json:
+            json.dump(description, my_json, indent=4)
+    return protocol_directory
+
+
+def add_subject_responses(
+    library_directory, fingerprint, description, subject_id, responses
+):
+    """
+    Add the responses estimated for a subject to the library
+
+    :param responses: dictionary tissue: response file
+    """
+    protocol_directory = _get_protocol_directory(
+        library_directory, fingerprint, description
+    )
+    subject_directory = os.path.join(
+        protocol_directory, "subjects", subject_id
+    )
+    os.makedirs(subject_directory, exist_ok=True)
+    for tissue, response in responses.items():
+        shutil.copy(
+            response,
+            os.path.join(subject_directory, f"response_{tissue}.txt"),
+        )
+    msg = f"Responses of {subject_id} added to library ({fingerprint})"
+    return 1, msg
+
+
+def build_average_response(library_directory, fingerprint, min_subjects=1):
+    """
+    Build the average responses of a protocol with responsemean
+    (from all the subjects of the library)
+
+    :returns: result, msg and info (dictionary tissue: average response)
+    """
+    info = {}
+    protocol_directory = _get_protocol_directory(
+        library_directory, fingerprint
+    )
+    subjects_directory = os.path.join(protocol_directory, "subjects")
+    if not os.path.exists(subjects_directory):
+        msg = f"No subject in library for {fingerprint}"
+        return 0, msg, info
+    subjects = sorted(os.listdir(subjects_directory))
+    if len(subjects) < min_subjects:
+        msg = (
+            f"Only {len(subjects)} subjects in library for {fingerprint} "
+            f"({min_subjects} needed for the average)"
+        )
+        return 0, msg, info
+
+    average_directory = os.path.join(protocol_directory, "average")
+    os.makedirs(average_directory, exist_ok=True)
+    for tissue in TISSUES:
+        responses = [
+            os.path.join(subjects_directory, subject, f"response_{tissue}.txt")
+            for subject in subjects
+        ]
+        responses = [response for response in responses
+                     if os.path.exists(response)]
+        if len(responses) < len(subjects):
+            # Tissue not estimated for all the subjects (ex: single shell)
+            continue
+        average = os.path.join(average_directory, f"response_{tissue}.txt")
+        cmd = ["responsemean"] + responses + [average, "-force"]
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"Can not launch responsemean (exit code {result})"
+            return 0, msg, info
+        info[tissue] = average
+    with open(
+        os.path.join(average_directory, "subjects.json"), "w", encoding="utf-8"
+    ) as my_json:
+        json.dump(subjects, my_json, indent=4)
+    msg = f"Average response built from {len(subjects)} subjects"
+    return 1, msg, info
+
+
+def get_library_response(library_directory, fingerprint):
+    """
+    Get the average responses of a protocol
+
+    :returns: dictionary tissue: average response for the tissues
+              available (None if there is no average response)
+    """
+    mylog = logging.getLogger("custom_logger")
+    average_directory = os.path.join(library_directory, fingerprint, "average")
+    responses = {}
+    for tissue in TISSUES:
+        response = os.path.join(average_directory, f"response_{tissue}.txt")
+        if os.path.exists(response):
+            responses[tissue] = response
+    if "wm" not in responses:
+        mylog.info("No average response in library for %s", fingerprint)
+        return None
+    mylog.info(
+        "Average response of the library found for %s (%s)",
+        fingerprint, ", ".join(responses),
+    )
+    return responses
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Retry of the processing steps killed by the system (OOM killer,
+signal) or failing for a transient reason:
+    - update_retry_rules
+    - is_transient_failure
+    - get_retry_command
+    - execute_command_retry
+"""
+
+import logging
+import os
+import re
+import time
+
+from useful import execute_command
+
+# Retry rules by executable:
+# - max_retries: number of retries after the first failure
+# - backoff: waiting time (in seconds) before the first retry,
+#   multiplied by backoff_factor at each new retry
+# - thread_option: option used to reduce the number of threads
+# - force_option: option needed to overwrite the outputs
+#   partially written by the failed attempt
+MRTRIX_RULE = {
+    "max_retries": 2,
+    "backoff": 30,
+    "backoff_factor": 2,
+    "thread_option": "-nthreads",
+    "force_option": "-force",
+}
+TRACTSEG_RULE = {
+    "max_retries": 2,
+    "backoff": 60,
+    "backoff_factor": 2,
+    "thread_option": "--nr_cpus",
+    "force_option": None,
+}
+RETRY_RULES = {
+    "dwidenoise": dict(MRTRIX_RULE),
+    "dwifslpreproc": dict(MRTRIX_RULE, max_retries=1),
+    "dwibiascorrect": dict(MRTRIX_RULE),
+    "dwi2response": dict(MRTRIX_RULE),
+    "dwi2fod": dict(MRTRIX_RULE),
+    "mtnormalise": dict(MRTRIX_RULE),
+    "sh2peaks": dict(MRTRIX_RULE),
+    "tckgen": dict(MRTRIX_RULE),
+    "TractSeg": dict(TRACTSEG_RULE),
+    "Tracking": dict(TRACTSEG_RULE),
+}
+
+# Exit codes of a process killed by SIGKILL / SIGABRT / SIGSEGV
+# when it is reported by a shell or a wrapper script
+SIGNAL_EXIT_CODES = [137, 134, 139]
+TRANSIENT_ERRORS = re.compile(
+    r"Killed|signal 9|SIGKILL|bad_alloc|MemoryError|out of memory"
+    r"|Cannot allocate memory|Resource temporarily unavailable",
+    re.IGNORECASE,
+)
+# Environment variables limiting the threads of
+# ANTs, FSL and numerical libraries used by the scripts
+THREADS_ENV = [
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "MRTRIX_NTHREADS",
+]
+
+
+def update_retry_rules(rules):
+    """
+    Update the retry rules (ex: from "RetryRules"
+    field of the configuration file)
+
+    :param rules: dictionary executable: rule, the keys not
+                  given in a rule keep their default value
+    """
+    for executable, rule in rules.items():
+        default = RETRY_RULES.get(executable, dict(MRTRIX_RULE))
+        RETRY_RULES[executable] = dict(default, **rule)
+
+
+def is_transient_failure(result, stderrl):
+    """
+    Check if a command failed because it has been killed
+    (by a signal or the OOM killer) or for a transient reason
+    """
+    if result == 0:
+        return False
+    if result < 0 or result in SIGNAL_EXIT_CODES:
+        return True
+    if stderrl and TRANSIENT_ERRORS.search(stderrl.decode(errors="ignore")):
+        return True
+    return False
+
+
+def get_retry_command(command, rule, nb_threads):
+    """
+    Get command for a new attempt with a limited
+    number of threads
+    """
+    retry_command = list(command)
+    thread_option = rule.get("thread_option")
+    if thread_option:
+        if thread_option in retry_command:
+            index = retry_command.index(thread_option)
+            retry_command[index + 1] = str(nb_threads)
+        else:
+            retry_command += [thread_option, str(nb_threads)]
+    force_option = rule.get("force_option")
+    if force_option and force_option not in retry_command:
+        retry_command.append(force_option)
+    env = {name: str(nb_threads) for name in THREADS_ENV}
+    return retry_command, env
+
+
+def execute_command_retry(command, env=None):
+    """
+    Execute command and retry it with fewer threads
+    after a backoff if it is killed or fails for a
+    transient reason. Only this command is executed again,
+    the outputs of the previous steps are kept.
+    """
+    mylog = logging.getLogger("custom_logger")
+    rule = RETRY_RULES.get(os.path.basename(command[0]))
+    result, stderrl, sdtoutl = execute_command(command, env=env)
+    if rule is None:
+        return result, stderrl, sdtoutl
+
+    nb_threads = os.cpu_count() or 1
+    thread_option = rule.get("thread_option")
+    if thread_option in command:
+        nb_threads = int(command[command.index(thread_option) + 1])
+    backoff = rule["backoff"]
+    for attempt in range(1, rule["max_retries"] + 1):
+        if not is_transient_failure(result, stderrl):
+            break
+        nb_threads = max(1, nb_threads // 2)
+        mylog.warning(
+            "%s failed (exit code %s), retry %s/%s in %s s with %s threads",
+            command[0],
+            result,
+            attempt,
+            rule["max_retries"],
+            backoff,
+            nb_threads,
+        )
+        time.sleep(backoff)
+        backoff *= rule["backoff_factor"]
+        retry_command, retry_env = get_retry_command(
+            command, rule, nb_threads
+        )
+        if env:
+            retry_env.update(env)
+        result, stderrl, sdtoutl = execute_command(
+            retry_command, env=retry_env
+        )
+        if result == 0:
+            mylog.info("%s succeeded at retry %s", command[0], attempt)
+    return result, stderrl, sdtoutl
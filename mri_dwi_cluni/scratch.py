@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Scratch directories of the jobs and stages (temporary files of
+the MRtrix scripts and of the other commands), used instead of
+changing the working directory of the process:
+    - get_scratch_root
+    - get_scratch_directory
+    - use_scratch_directory
+    - add_scratch_option
+    - job_scratch
+    - ScratchListener
+
+Each job gets a scratch directory and each stage of the job its
+own scratch directory, in the root configured for the stage
+("ScratchRoots" field of the configuration file, ex: tmpfs for the
+small stages, local NVMe for the others; WorkingDirectory by
+default). The scratch directory of the current thread is given to
+the commands (see useful.execute_command) as working directory,
+TMPDIR and -scratch option of the MRtrix scripts. It is removed at
+the end of the stage if the stage succeeded, and kept otherwise.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from stages import STAGE_LISTENERS, add_stage_listener
+
+# MRtrix python scripts creating a scratch directory
+MRTRIX_SCRATCH_SCRIPTS = [
+    "5ttgen",
+    "dwi2response",
+    "dwibiascorrect",
+    "dwicat",
+    "dwifslpreproc",
+    "responsemean",
+]
+_SCRATCH = threading.local()
+
+
+def get_scratch_root(roots, stage=None):
+    """
+    Get scratch root of a stage
+
+    :param roots: dictionary stage name (or "default"): root
+                  directory or list of root directories (the
+                  one with the most free space is used)
+    """
+    root = roots.get(stage, roots.get("default"))
+    if isinstance(root, list):
+        root = max(root, key=lambda path: shutil.disk_usage(path).free)
+    return root
+
+
+def get_scratch_directory():
+    """Get scratch directory of the current thread (None if no job)"""
+    stack = getattr(_SCRATCH, "stack", [])
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def use_scratch_directory(directory):
+    """
+    Use a scratch directory in the current thread (ex: in the
+    worker threads of a stage, with the scratch of the stage)
+    """
+    if not hasattr(_SCRATCH, "stack"):
+        _SCRATCH.stack = []
+    _SCRATCH.stack.append(directory)
+    try:
+        yield directory
+    finally:
+        _SCRATCH.stack.pop()
+
+
+def add_scratch_option(command, scratch_directory):
+    """Add -scratch option to a MRtrix script command (a list)"""
+    executable = os.path.basename(command[0])
+    if executable in MRTRIX_SCRATCH_SCRIPTS and "-scratch" not in command:
+        return list(command) + ["-scratch", scratch_directory]
+    return command
+
+
+@contextmanager
+def job_scratch(config, job_name):
+    """
+    Scratch directory of a job run in the current thread, the
+    result of the job should be set in the yielded dictionary
+    (the scratch directory is removed if it is 1):
+
+        with job_scratch(config, "sub-01_ses-01") as scratch:
+            result, msg = run_white_matter_bundle(...)
+            scratch["result"] = result
+    """
+    if _LISTENER not in STAGE_LISTENERS:
+        add_stage_listener(_LISTENER)
+    roots = {"default": config["WorkingDirectory"]}
+    roots.update(config.get("ScratchRoots", {}))
+    root = get_scratch_root(roots)
+    os.makedirs(root, exist_ok=True)
+    job_directory = tempfile.mkdtemp(prefix=f"{job_name}_", dir=root)
+    previous = (getattr(_SCRATCH, "roots", None), getattr(_SCRATCH, "job", None))
+    _SCRATCH.roots = roots
+    _SCRATCH.job = job_name
+    status = {"result": 0, "directory": job_directory}
+    try:
+        with use_scratch_directory(job_directory):
+            yield status
+    finally:
+        _SCRATCH.roots, _SCRATCH.job = previous
+        _remove_scratch(job_directory, status["result"])
+
+
+def _remove_scratch(directory, result):
+    """Remove a scratch directory if result is 1, keep it otherwise"""
+    if result == 1:
+        shutil.rmtree(directory, ignore_errors=True)
+    elif os.path.exists(directory):
+        mylog = logging.getLogger("custom_logger")
+        mylog.warning("Scratch directory kept: %s", directory)
+
+
+class ScratchListener:
+    """
+    Stage listener (see stages.py) creating the scratch directory
+    of each stage of a job (see job_scratch) at its start and
+    removing it at its end
+    """
+
+    def __call__(self, event, stage_info):
+        roots = getattr(_SCRATCH, "roots", None)
+        if roots is None or event == "file":
+            return
+        stage = stage_info["stage"]
+        if event == "start":
+            root = get_scratch_root(roots, stage)
+            os.makedirs(root, exist_ok=True)
+            directory = tempfile.mkdtemp(
+                prefix=f"{_SCRATCH.job}_{stage}_", dir=root
+            )
+            _SCRATCH.stack.append(directory)
+        elif len(_SCRATCH.stack) > 1:
+            # The job scratch directory is the first of the stack
+            directory = _SCRATCH.stack.pop()
+            _remove_scratch(directory, stage_info.get("result"))
+
+
+_LISTENER = ScratchListener()
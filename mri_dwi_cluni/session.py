@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+Functions to prepare and process a session from a zipped
+DICOM directory (used by the GUI and the batch mode):
+    - read_config
+    - set_tractseg_options
+    - unzip_dicom
+    - archive_dicom
+    - start_archive_dicom
+    - clean_dcm2bids_tmp
+    - get_analysis_directories
+    - is_session_processed
+    - create_analysis_directories
+    - add_log_handlers
+    - remove_log_handlers
+    - process_dicom_zip
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from archival import mark_session_active, run_freeze_derivatives
+from bids_conversion import convert_series_to_bids, convert_to_bids
+from main_white_matter_bundle import run_white_matter_bundle
+from preflight import CONVERSION_EXECUTABLES, check_executables
+from publish import publish_file
+from retry import update_retry_rules
+from scratch import job_scratch
+from stages import run_stage, update_job_info
+from useful import check_file_ext, execute_command
+
+LOG_FORMAT = "%(asctime)s:%(levelname)s:%(message)s"
+# Archives of the DICOM run in background, overlapping the processing
+_ARCHIVE_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+
+def read_config(config_file):
+    """Read configuration file"""
+    with open(config_file, encoding="utf-8") as my_json:
+        config = json.load(my_json)
+    update_retry_rules(config.get("RetryRules", {}))
+    return config
+
+
+def set_tractseg_options(config, bundles=None, uncertainty=False):
+    """
+    Override the TractSeg options of the configuration (command line
+    of the batch mode)
+
+    :param bundles: bundles tracked (a list), None: TractSegBundles
+                    of the configuration
+    :param uncertainty: compute the uncertainty maps if True
+    """
+    if bundles:
+        config["TractSegBundles"] = list(bundles)
+    if uncertainty:
+        config["TractSegUncertainty"] = True
+    return config
+
+
+def unzip_dicom(zip_file, working_directory):
+    """
+    Unzip DICOM directory in a temporary folder
+    of the working directory
+    """
+    info = {}
+    valid_bool, in_ext, file_name = check_file_ext(zip_file, {"ZIP": "zip"})
+    if not valid_bool:
+        msg = "DICOM directory is not a zip folder"
+        return 0, msg, info
+
+    if not os.path.exists(working_directory):
+        os.makedirs(working_directory)
+    working_directory_tmp = tempfile.mkdtemp(
+        prefix="tmp_", dir=working_directory
+    )
+    cmd = ["unzip", zip_file, "-d", working_directory_tmp]
+    result, stderrl, sdtoutl = execute_command(cmd)
+    dicom_directory = os.path.join(working_directory_tmp, file_name)
+    if result != 0 or not os.path.exists(dicom_directory):
+        shutil.rmtree(working_directory_tmp)
+        msg = f"Can not unzip {zip_file} (exit code {result})"
+        return 0, msg, info
+    info = {
+        "dicom_directory": dicom_directory,
+        "working_directory_tmp": working_directory_tmp,
+    }
+    msg = "Unzip done"
+    return 1, msg, info
+
+
+class _HashingWriter:
+    """File object computing the sha256 of the bytes written"""
+
+    def __init__(self, my_file):
+        self.my_file = my_file
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.my_file.write(data)
+
+    def flush(self):
+        self.my_file.flush()
+
+
+def _write_checksum(archive_file, checksum):
+    """Write checksum file of an archive (sha256sum format)"""
+    with open(archive_file + ".sha256", "w", encoding="utf-8") as my_file:
+        my_file.write(f"{checksum}  {os.path.basename(archive_file)}\n")
+
+
+def archive_dicom(
+    zip_file, out_directory, patient_name, sess_name, mode="tar"
+):
+    """
+    Archive the zipped DICOM directory in sourcedata, without
+    extracting it:
+        - mode "tar": zip members are streamed into DICOM.tar.gz
+          (DICOM/ directory as in the zip top directory)
+        - mode "zip": the zip is published as DICOM.zip
+    A sha256 checksum of the archive is written next to it.
+    """
+    sourcedata_directory = os.path.join(
+        out_directory,
+        "sourcedata",
+        "sub-" + patient_name + "_ses-" + sess_name,
+    )
+    if os.path.exists(sourcedata_directory):
+        msg = "DICOM already in sourcedata"
+        return 1, msg
+    os.makedirs(sourcedata_directory)
+    if mode == "zip":
+        archive_file = os.path.join(sourcedata_directory, "DICOM.zip")
+        publish_file(zip_file, archive_file)
+        zip_hash = hashlib.sha256()
+        with open(archive_file, "rb") as my_file:
+            for block in iter(lambda: my_file.read(1024 * 1024), b""):
+                zip_hash.update(block)
+        _write_checksum(archive_file, zip_hash.hexdigest())
+        msg = "DICOM zip copied in sourcedata"
+        return 1, msg
+
+    archive_file = os.path.join(sourcedata_directory, "DICOM.tar.gz")
+    tmp_file = archive_file + ".part"
+    top_directory = check_file_ext(zip_file, {"ZIP": "zip"})[2] + "/"
+    try:
+        with zipfile.ZipFile(zip_file) as my_zip, open(
+            tmp_file, "wb"
+        ) as my_file:
+            writer = _HashingWriter(my_file)
+            with gzip.GzipFile(
+                fileobj=writer, mode="wb", compresslevel=6
+            ) as my_gzip, tarfile.open(fileobj=my_gzip, mode="w|") as my_tar:
+                for member in my_zip.infolist():
+                    name = member.filename
+                    if name.startswith(top_directory):
+                        name = name[len(top_directory):]
+                    tar_info = tarfile.TarInfo(
+                        ("DICOM/" + name).rstrip("/")
+                    )
+                    tar_info.mtime = time.mktime(member.date_time + (0, 0, -1))
+                    if member.is_dir():
+                        tar_info.type = tarfile.DIRTYPE
+                        tar_info.mode = 0o755
+                        my_tar.addfile(tar_info)
+                        continue
+                    tar_info.size = member.file_size
+                    tar_info.mode = 0o644
+                    with my_zip.open(member) as member_file:
+                        my_tar.addfile(tar_info, member_file)
+        os.replace(tmp_file, archive_file)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as error:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        msg = f"Can not archive {zip_file} in sourcedata ({error})"
+        return 0, msg
+    _write_checksum(archive_file, writer.hash.hexdigest())
+    msg = "DICOM archived in sourcedata"
+    return 1, msg
+
+
+def start_archive_dicom(
+    zip_file, out_directory, patient_name, sess_name, mode="tar"
+):
+    """
+    Archive the zipped DICOM directory in a background thread
+    (see archive_dicom)
+
+    :returns: future (future.result() gives result and msg)
+    """
+    return _ARCHIVE_EXECUTOR.submit(
+        archive_dicom, zip_file, out_directory, patient_name, sess_name, mode
+    )
+
+
+def clean_dcm2bids_tmp(out_directory, patient_name, sess_name):
+    """
+    Remove dcm2bids temporary folder of the session
+    (and tmp_dcm2bids if no other session is being converted)
+    """
+    tmp_directory = os.path.join(out_directory, "tmp_dcm2bids")
+    session_tmp_directory = os.path.join(
+        tmp_directory, "sub-" + patient_name + "_ses-" + sess_name
+    )
+    if os.path.exists(session_tmp_directory):
+        shutil.rmtree(session_tmp_directory)
+    if os.path.exists(tmp_directory):
+        others = [
+            name for name in os.listdir(tmp_directory)
+            if name.startswith("sub-")
+        ]
+        if not others:
+            shutil.rmtree(tmp_directory)
+
+
+def get_analysis_directories(out_directory, patient_name, sess_name):
+    """Get analysis and preprocessing directories"""
+    analysis_directory = os.path.join(
+        out_directory,
+        "derivatives",
+        "sub-" + patient_name,
+        "ses-" + sess_name,
+    )
+    preproc_directory = os.path.join(analysis_directory, "preprocessing")
+    return analysis_directory, preproc_directory
+
+
+def is_session_processed(preproc_directory):
+    """Check if subject / session already processed"""
+    return (
+        os.path.exists(preproc_directory)
+        and len(os.listdir(preproc_directory)) > 1
+    )
+
+
+def create_analysis_directories(analysis_directory, preproc_directory):
+    """Create analysis directories"""
+    if not os.path.exists(analysis_directory):
+        os.makedirs(analysis_directory)
+    if not os.path.exists(preproc_directory):
+        os.mkdir(preproc_directory)
+
+
+def add_log_handlers(analysis_directory):
+    """
+    Add file (in analysis directory) and terminal
+    handlers to the custom logger
+    """
+    now = datetime.now()
+    log_file = os.path.join(
+        analysis_directory,
+        now.strftime("%Y%m%d") + "_processing.log",
+    )
+    mylog = logging.getLogger("custom_logger")
+    mylog.setLevel(logging.INFO)
+    handler = logging.FileHandler(log_file)
+    handler.setLevel(logging.INFO)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt="%H:%M:%S"))
+    mylog.addHandler(handler)
+    # Print also into terminal
+    handler_print = logging.StreamHandler()
+    handler_print.setLevel(logging.INFO)
+    handler_print.setFormatter(
+        logging.Formatter(LOG_FORMAT, datefmt="%H:%M:%S")
+    )
+    mylog.addHandler(handler_print)
+    return [handler, handler_print]
+
+
+def remove_log_handlers(handlers):
+    """Remove handlers from the custom logger"""
+    mylog = logging.getLogger("custom_logger")
+    for handler in handlers:
+        mylog.removeHandler(handler)
+        handler.close()
+
+
+def process_dicom_zip(zip_file, config, partial_brain=False, overwrite=False):
+    """
+    Convert, archive and process a zipped DICOM directory
+    without user interaction (all the stages are run in
+    a "session" stage)
+
+    :param zip_file: zipped DICOM directory
+    :param config: configuration (a dictionary, see read_config)
+    :param partial_brain: partial brain processing (a boolean)
+    :param overwrite: if True, remove the previous analysis of the session,
+                      otherwise the session is skipped (a boolean)
+    """
+    job_name = os.path.basename(zip_file).replace(".zip", "")
+    update_job_info(zip_bytes=os.path.getsize(zip_file))
+    with job_scratch(config, job_name) as scratch:
+        with run_stage(
+            "session", zip_bytes=os.path.getsize(zip_file)
+        ) as stage:
+            result, msg = _process_dicom_zip(
+                zip_file, config, partial_brain, overwrite
+            )
+            stage["result"] = result
+        scratch["result"] = result
+    return result, msg
+
+
+def _process_dicom_zip(zip_file, config, partial_brain, overwrite):
+    """Convert, archive and process a zipped DICOM directory"""
+    out_directory = config["OutputDirectory"]
+    working_directory = config["WorkingDirectory"]
+
+    missing = check_executables(CONVERSION_EXECUTABLES)
+    if missing:
+        msg = f"Executables not found: {', '.join(missing)}"
+        return 0, msg
+
+    # Unzip, BIDS conversion and archive
+    with run_stage(
+        "conversion", zip_bytes=os.path.getsize(zip_file)
+    ) as stage:
+        result, msg, info = unzip_dicom(zip_file, working_directory)
+        if result == 0:
+            stage["result"] = 0
+            return 0, msg
+        dicom_directory = info["dicom_directory"]
+        working_directory_tmp = info["working_directory_tmp"]
+        print("\n----------CONVERSION----------")
+        if config.get("SpeculativeStart", False):
+            # Diffusion series first, the others during the processing
+            result, msg, info = convert_series_to_bids(
+                dicom_directory, config["BidsConfigFile"], out_directory,
+                remove_directory=working_directory_tmp,
+                nb_processes=config.get("ConversionProcesses"),
+            )
+        else:
+            result, msg, info = convert_to_bids(
+                dicom_directory, config["BidsConfigFile"], out_directory,
+                nb_processes=config.get("ConversionProcesses"),
+            )
+            shutil.rmtree(working_directory_tmp)
+        if result == 0:
+            stage["result"] = 0
+            return 0, msg
+        patient_name = info["sub_name"]
+        sess_name = info["sess_name"]
+        anat_conversion = info.get("pending")
+
+    # Archive of the zip in sourcedata during the processing
+    archive = start_archive_dicom(
+        zip_file, out_directory, patient_name, sess_name,
+        config.get("DicomArchive", "tar"),
+    )
+    try:
+        result, msg = _process_session(
+            config, patient_name, sess_name, partial_brain, overwrite,
+            anat_conversion,
+        )
+    finally:
+        archive_result, archive_msg = archive.result()
+        if anat_conversion is not None:
+            conversion_result, conversion_msg = anat_conversion.result()
+    if anat_conversion is not None and conversion_result == 0 and result == 1:
+        return 0, conversion_msg
+    if archive_result == 0 and result == 1:
+        return 0, archive_msg
+    return result, msg
+
+
+def _process_session(config, patient_name, sess_name, partial_brain, overwrite,
+                     anat_conversion=None):
+    """
+    Process a session converted in BIDS
+
+    :param anat_conversion: future of the conversion of the anatomical
+                            series still running (see
+                            run_white_matter_bundle)
+    """
+    out_directory = config["OutputDirectory"]
+    analysis_directory, preproc_directory = get_analysis_directories(
+        out_directory, patient_name, sess_name
+    )
+    if is_session_processed(preproc_directory):
+        if not overwrite:
+            msg = (
+                f"Data already processed for sub-{patient_name} "
+                f"ses-{sess_name}, skipped"
+            )
+            return 0, msg
+        # Remove old data
+        shutil.rmtree(analysis_directory)
+    create_analysis_directories(analysis_directory, preproc_directory)
+    update_job_info(
+        patient_name=patient_name,
+        sess_name=sess_name,
+        analysis_directory=analysis_directory,
+        archival="Archival" in config,
+    )
+
+    handlers = add_log_handlers(analysis_directory)
+    mylog = logging.getLogger("custom_logger")
+    start = time.time()
+    mylog.info("Started at %s", datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+    # Images of the session not frozen by the archival of other
+    # sessions during the processing
+    with mark_session_active(analysis_directory):
+        try:
+            result, msg = run_white_matter_bundle(
+                out_directory, patient_name, sess_name, partial_brain, config,
+                anat_conversion,
+            )
+            if result == 0:
+                mylog.error(msg)
+            else:
+                clean_dcm2bids_tmp(out_directory, patient_name, sess_name)
+                total_time = (time.time() - start) / 60
+                mylog.info("Processing done in %f minutes", total_time)
+                if "Archival" in config:
+                    # Freeze the derivatives of the previous sessions
+                    with run_stage("archival") as stage:
+                        archival_result, archival_msg, info = (
+                            run_freeze_derivatives(
+                                out_directory, config,
+                                exclude=[analysis_directory],
+                            )
+                        )
+                        stage["result"] = archival_result
+                    if archival_result == 0:
+                        mylog.warning(archival_msg)
+                    else:
+                        mylog.info(archival_msg)
+        finally:
+            remove_log_handlers(handlers)
+    return result, msg
@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+"""
+Executor distributing tasks (sessions or commands) to worker
+processes running on several nodes sharing a filesystem
+(ex: NFS mount), without scheduler:
+    - init_queue
+    - submit_task
+    - claim_task
+    - run_task
+    - complete_task
+    - requeue_stale_tasks
+    - get_task_status
+    - wait_for_tasks
+    - run_worker
+
+Queue directory layout:
+    pending/<task_id>.json                 tasks waiting for a worker
+    claimed/<task_id>__<worker_id>.json    tasks being processed
+    done/<task_id>.json                    completion markers
+    failed/<task_id>.json                  failure markers
+    eta/<task_id>.json                     remaining time of the
+                                           sessions (see eta.py)
+    runtime_history.json                   stage durations of the
+                                           sessions of all the nodes
+    STOP                                   workers exit when it exists
+
+Files are always written in tmp/ and published with os.rename, which
+is atomic on the shared filesystem: a task is claimed by the only
+worker that succeeds in renaming it from pending/ to claimed/.
+The claimed file holds a claim token and a heartbeat timestamp
+written by the worker during the task, so a task of a dead worker
+can be put back in pending/. A task is run in a child process of the
+worker: if its claimed file disappears (task requeued), the child
+process and its commands are killed, and the completion is only
+published by the worker holding the claim token.
+
+Usage (on each node, as many workers as wanted):
+
+    python ./mri_dwi_cluni/shared_executor.py /shared/queue --processes 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from multiprocessing import Pipe, Process
+
+from priority import DEFAULT_PRIORITY, get_priority_rank, terminate_commands
+from useful import execute_command
+
+QUEUE_SUBDIRECTORIES = ["tmp", "pending", "claimed", "done", "failed"]
+HEARTBEAT_INTERVAL = 30
+STALE_TIMEOUT = 600
+
+# Heartbeats seen by requeue_stale_tasks (claimed file name:
+# heartbeat written by the worker, local time when it changed)
+_HEARTBEATS = {}
+
+
+def init_queue(queue_directory):
+    """Create queue directories"""
+    for name in QUEUE_SUBDIRECTORIES:
+        os.makedirs(os.path.join(queue_directory, name), exist_ok=True)
+
+
+def _write_json_atomic(queue_directory, data, out_file):
+    """Write json in tmp/ and rename it into out_file"""
+    tmp_file = os.path.join(
+        queue_directory, "tmp", uuid.uuid4().hex + ".json"
+    )
+    with open(tmp_file, "w", encoding="utf-8") as my_json:
+        json.dump(data, my_json, indent=4)
+        my_json.flush()
+        os.fsync(my_json.fileno())
+    os.rename(tmp_file, out_file)
+
+
+def submit_task(queue_directory, task, depends_on=None):
+    """
+    Add a task to the queue
+
+    :param queue_directory: shared queue directory
+    :param task: task (a dictionary) with a "kind":
+                 - "command": "command" (a list) run with execute_command
+                 - "session": "zip_file", "config_file", "partial_brain"
+                   and "overwrite" given to process_dicom_zip,
+                   "bundles" and "uncertainty" (TractSeg options,
+                   see session.set_tractseg_options), "priority"
+                   (priority class, see priority.py)
+    :param depends_on: ids of the tasks that must be done before
+    :returns: task id (a string)
+    """
+    init_queue(queue_directory)
+    task = dict(task)
+    task.setdefault("id", time.strftime("%Y%m%d%H%M%S_") + uuid.uuid4().hex)
+    task["depends_on"] = list(depends_on or [])
+    task["submitted"] = time.time()
+    _write_json_atomic(
+        queue_directory,
+        task,
+        os.path.join(queue_directory, "pending", task["id"] + ".json"),
+    )
+    return task["id"]
+
+
+def get_task_status(queue_directory, task_id):
+    """Get task status: pending, claimed, done, failed or unknown"""
+    for status in ["done", "failed", "pending"]:
+        if os.path.exists(
+            os.path.join(queue_directory, status, task_id + ".json")
+        ):
+            return status
+    claimed = os.listdir(os.path.join(queue_directory, "claimed"))
+    if any(name.startswith(task_id + "__") for name in claimed):
+        return "claimed"
+    return "unknown"
+
+
+def _read_json(json_file):
+    """Read json file (None if it has been moved by another worker)"""
+    try:
+        with open(json_file, encoding="utf-8") as my_json:
+            return json.load(my_json)
+    except FileNotFoundError:
+        return None
+
+
+def claim_task(queue_directory, worker_id):
+    """
+    Claim the oldest pending task of the highest priority whose
+    dependencies are done
+
+    :returns: task (a dictionary) and claimed file, or None, None
+    """
+    pending_directory = os.path.join(queue_directory, "pending")
+    pending = []
+    for name in sorted(os.listdir(pending_directory)):
+        if not name.endswith(".json"):
+            continue
+        pending_file = os.path.join(pending_directory, name)
+        task = _read_json(pending_file)
+        if task is not None:
+            pending.append((pending_file, task))
+    # Ids start with the submission time: oldest first in each class
+    pending.sort(key=lambda item: get_priority_rank(item[1].get("priority")))
+    for pending_file, task in pending:
+        dependencies = [
+            get_task_status(queue_directory, task_id)
+            for task_id in task.get("depends_on", [])
+        ]
+        if "failed" in dependencies:
+            # Dependency failed: the task can not be run
+            claimed_file = _rename_claim(pending_file, queue_directory, task,
+                                         worker_id)
+            if claimed_file:
+                complete_task(
+                    queue_directory, task, claimed_file, 0,
+                    "Dependency failed", worker_id,
+                )
+            continue
+        if any(status != "done" for status in dependencies):
+            continue
+        claimed_file = _rename_claim(
+            pending_file, queue_directory, task, worker_id
+        )
+        if claimed_file:
+            return task, claimed_file
+    return None, None
+
+
+def _rename_claim(pending_file, queue_directory, task, worker_id):
+    """
+    Rename a pending task into claimed/ (None if already claimed)
+    and write the claim (worker, token, heartbeat) in the task
+    """
+    claimed_file = os.path.join(
+        queue_directory, "claimed", f"{task['id']}__{worker_id}.json"
+    )
+    try:
+        os.rename(pending_file, claimed_file)
+    except FileNotFoundError:
+        # On NFS a retried rename can fail whereas the first one
+        # succeeded: check if the claimed file is ours
+        if not os.path.exists(claimed_file):
+            return None
+    task["claim"] = {
+        "worker": worker_id,
+        "token": uuid.uuid4().hex,
+        "heartbeat": time.time(),
+    }
+    try:
+        _write_claim(claimed_file, task)
+    except FileNotFoundError:
+        return None
+    return claimed_file
+
+
+def _write_claim(claimed_file, task):
+    """
+    Rewrite a claimed file in place (never created again if it has
+    been requeued in the meantime)
+    """
+    with open(claimed_file, "r+", encoding="utf-8") as my_json:
+        json.dump(task, my_json, indent=4)
+        my_json.truncate()
+        my_json.flush()
+        os.fsync(my_json.fileno())
+
+
+def _beat_claim(claimed_file, token):
+    """
+    Write the heartbeat of a claim
+
+    :returns: False if the claim is lost (claimed file requeued or
+              claimed with another token)
+    """
+    try:
+        with open(claimed_file, "r+", encoding="utf-8") as my_json:
+            task = json.load(my_json)
+            if task.get("claim", {}).get("token") != token:
+                return False
+            task["claim"]["heartbeat"] = time.time()
+            my_json.seek(0)
+            json.dump(task, my_json, indent=4)
+            my_json.truncate()
+            my_json.flush()
+            os.fsync(my_json.fileno())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # Partially written: the claim is still ours
+        pass
+    return True
+
+
+def run_task(task, queue_directory=None):
+    """
+    Run a task, returns result (1 if ok) and message
+
+    :param queue_directory: queue of the task (the ETA of the
+                            sessions is written in it)
+    """
+    if task["kind"] == "command":
+        result, stderrl, sdtoutl = execute_command(task["command"])
+        if result != 0:
+            msg = f"Command {task['command'][0]} failed (exit code {result})"
+            return 0, msg
+        return 1, "Command done"
+    if task["kind"] == "session":
+        # Imported here: command workers do not need the
+        # processing dependencies
+        from admission import add_admission_control
+        from eta import add_eta
+        from metrics import add_metrics
+        from priority import add_priority_scheduling
+        from session import (process_dicom_zip, read_config,
+                             set_tractseg_options)
+        from stages import remove_stage_listener, set_job_info
+
+        config = read_config(task["config_file"])
+        set_tractseg_options(
+            config, task.get("bundles"), task.get("uncertainty", False)
+        )
+        set_job_info(
+            job=task["id"],
+            out_directory=config["OutputDirectory"],
+            priority=task.get("priority", DEFAULT_PRIORITY),
+            submitted=task.get("submitted"),
+        )
+        listeners = [
+            add_priority_scheduling(config),
+            add_admission_control(config),
+            add_metrics(config),
+        ]
+        if queue_directory:
+            listeners.append(add_eta(
+                config,
+                os.path.join(queue_directory, "eta"),
+                os.path.join(queue_directory, "runtime_history.json"),
+            ))
+        try:
+            return process_dicom_zip(
+                task["zip_file"],
+                config,
+                partial_brain=task.get("partial_brain", False),
+                overwrite=task.get("overwrite", False),
+            )
+        finally:
+            for listener in listeners:
+                remove_stage_listener(listener)
+    return 0, f"Unknown task kind {task['kind']}"
+
+
+def complete_task(queue_directory, task, claimed_file, result, msg, worker_id):
+    """
+    Publish completion (or failure) marker of a task, if the claim
+    of the worker is still valid
+
+    :returns: True if the marker is published, False if the claim
+              has been lost (task requeued)
+    """
+    mylog = logging.getLogger("custom_logger")
+    # Release the claim atomically: it fails if the task has been
+    # requeued, and the claimed file can not be requeued afterwards
+    release_file = os.path.join(
+        queue_directory, "tmp", uuid.uuid4().hex + ".json"
+    )
+    try:
+        os.rename(claimed_file, release_file)
+    except FileNotFoundError:
+        mylog.warning("Task %s not published: claim of %s lost",
+                      task["id"], worker_id)
+        return False
+    try:
+        claim = (_read_json(release_file) or {}).get("claim", {})
+    except ValueError:
+        claim = {}
+    if claim.get("token") != task.get("claim", {}).get("token"):
+        os.rename(release_file, claimed_file)
+        mylog.warning("Task %s not published: claimed with another token",
+                      task["id"])
+        return False
+    status = "done" if result == 1 else "failed"
+    marker = dict(task)
+    marker.pop("claim", None)
+    marker.update(
+        {
+            "result": result,
+            "msg": msg,
+            "worker": worker_id,
+            "completed": time.time(),
+        }
+    )
+    _write_json_atomic(
+        queue_directory,
+        marker,
+        os.path.join(queue_directory, status, task["id"] + ".json"),
+    )
+    os.remove(release_file)
+    return True
+
+
+def requeue_stale_tasks(queue_directory, stale_timeout=STALE_TIMEOUT):
+    """
+    Put back in pending/ the claimed tasks without heartbeat
+    since stale_timeout seconds (worker or node dead).
+    The heartbeat written by the worker in the claimed file is
+    compared between the calls: the clocks of the worker and of the
+    file server are never compared with the local clock (a claim is
+    requeued stale_timeout seconds after its heartbeat is first seen
+    unchanged by this process)
+    """
+    mylog = logging.getLogger("custom_logger")
+    claimed_directory = os.path.join(queue_directory, "claimed")
+    requeued = []
+    names = os.listdir(claimed_directory)
+    for name in list(_HEARTBEATS):
+        if name not in names:
+            del _HEARTBEATS[name]
+    for name in names:
+        claimed_file = os.path.join(claimed_directory, name)
+        try:
+            task = _read_json(claimed_file)
+        except ValueError:
+            # Heartbeat being written: the worker is alive
+            continue
+        if task is None:
+            continue
+        heartbeat = task.get("claim", {}).get("heartbeat")
+        now = time.monotonic()
+        if name not in _HEARTBEATS or _HEARTBEATS[name][0] != heartbeat:
+            _HEARTBEATS[name] = (heartbeat, now)
+        age = now - _HEARTBEATS[name][1]
+        if age < stale_timeout:
+            continue
+        task_id = name.split("__")[0]
+        try:
+            os.rename(
+                claimed_file,
+                os.path.join(queue_directory, "pending", task_id + ".json"),
+            )
+        except FileNotFoundError:
+            continue
+        del _HEARTBEATS[name]
+        mylog.warning("Task %s requeued (no heartbeat since %.0f s)",
+                      task_id, age)
+        requeued.append(task_id)
+    return requeued
+
+
+def wait_for_tasks(
+    queue_directory, task_ids, poll_interval=30, stale_timeout=STALE_TIMEOUT,
+    progress=None,
+):
+    """
+    Wait until all the tasks are done or failed
+    (and requeue stale tasks meanwhile)
+
+    :param progress: called with the markers of the completed tasks
+                     at each check (ex: print the ETA)
+    :returns: dictionary task_id: completion marker
+    """
+    markers = {}
+    while len(markers) < len(task_ids):
+        for task_id in task_ids:
+            if task_id in markers:
+                continue
+            for status in ["done", "failed"]:
+                marker = _read_json(
+                    os.path.join(queue_directory, status, task_id + ".json")
+                )
+                if marker is not None:
+                    markers[task_id] = marker
+        if len(markers) < len(task_ids):
+            requeue_stale_tasks(queue_directory, stale_timeout)
+            if progress is not None:
+                progress(markers)
+            time.sleep(poll_interval)
+    return markers
+
+
+def _heartbeat(claimed_file, token, stop_event, lost_event, interval):
+    """
+    Write the heartbeat of the claim until stop_event is set
+    (lost_event is set if the claim is lost)
+    """
+    while not stop_event.wait(interval):
+        if not _beat_claim(claimed_file, token):
+            lost_event.set()
+            return
+
+
+def _terminate_task(signum, frame):
+    """SIGTERM of a task process: kill the commands in their own group"""
+    terminate_commands()
+    os._exit(128 + signum)
+
+
+def _run_task_process(task, queue_directory, connection):
+    """
+    Run a task in a child process of the worker (own process group,
+    killed with its commands if the claim is lost)
+    """
+    os.setsid()
+    signal.signal(signal.SIGTERM, _terminate_task)
+    try:
+        result, msg = run_task(task, queue_directory)
+    except Exception as e:
+        result, msg = 0, str(e)
+    connection.send((result, msg))
+    connection.close()
+
+
+def _kill_task_process(process):
+    """Kill a task process and its commands"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        # Process group not created yet
+        process.terminate()
+    process.join()
+
+
+def run_worker(
+    queue_directory, poll_interval=10, idle_timeout=None, max_tasks=None,
+    heartbeat_interval=HEARTBEAT_INTERVAL,
+):
+    """
+    Claim and run tasks until the STOP file exists, no task has been
+    found for idle_timeout seconds or max_tasks tasks have been run.
+    A task whose claim is lost (requeued) is aborted and not counted
+
+    :returns: number of tasks run
+    """
+    init_queue(queue_directory)
+    worker_id = f"{socket.gethostname()}_{os.getpid()}"
+    print(f"Worker {worker_id} started on {queue_directory}")
+    nb_tasks = 0
+    idle_since = time.time()
+    while not os.path.exists(os.path.join(queue_directory, "STOP")):
+        if max_tasks is not None and nb_tasks >= max_tasks:
+            break
+        task, claimed_file = claim_task(queue_directory, worker_id)
+        if task is None:
+            if idle_timeout is not None and (
+                time.time() - idle_since > idle_timeout
+            ):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        print(f"Worker {worker_id} runs task {task['id']}")
+        receiver, sender = Pipe(duplex=False)
+        process = Process(
+            target=_run_task_process, args=(task, queue_directory, sender)
+        )
+        process.start()
+        sender.close()
+        stop_event = threading.Event()
+        lost_event = threading.Event()
+        heartbeat = threading.Thread(
+            target=_heartbeat,
+            args=(claimed_file, task["claim"]["token"], stop_event,
+                  lost_event, heartbeat_interval),
+            daemon=True,
+        )
+        heartbeat.start()
+        result, msg = None, None
+        try:
+            while not lost_event.is_set():
+                if receiver.poll(min(1.0, heartbeat_interval)):
+                    result, msg = receiver.recv()
+                    break
+                if not process.is_alive():
+                    break
+            if lost_event.is_set():
+                _kill_task_process(process)
+            else:
+                process.join()
+        except EOFError:
+            process.join()
+        finally:
+            stop_event.set()
+            heartbeat.join()
+            receiver.close()
+        idle_since = time.time()
+        if lost_event.is_set():
+            print(f"Worker {worker_id} aborted task {task['id']}: "
+                  "claim lost (task requeued)")
+            continue
+        if result is None:
+            result = 0
+            msg = f"Task process exited with code {process.exitcode}"
+        complete_task(
+            queue_directory, task, claimed_file, result, msg, worker_id
+        )
+        nb_tasks += 1
+    print(f"Worker {worker_id} stopped after {nb_tasks} tasks")
+    return nb_tasks
+
+
+def main(argv=None):
+    """Start worker processes on this node"""
+    parser = argparse.ArgumentParser(
+        description="Run tasks of a shared queue directory"
+    )
+    parser.add_argument("queue_directory", help="shared queue directory")
+    parser.add_argument(
+        "--processes", type=int, default=1,
+        help="number of worker processes started on this node",
+    )
+    parser.add_argument(
+        "--poll-interval", type=float, default=10,
+        help="seconds between two checks of the queue",
+    )
+    parser.add_argument(
+        "--idle-timeout", type=float, default=None,
+        help="stop after this number of seconds without task",
+    )
+    parser.add_argument(
+        "--max-tasks", type=int, default=None,
+        help="stop after this number of tasks (by process)",
+    )
+    args = parser.parse_args(argv)
+    queue_directory = os.path.realpath(args.queue_directory)
+    worker_args = (
+        queue_directory, args.poll_interval, args.idle_timeout,
+        args.max_tasks,
+    )
+    if args.processes == 1:
+        run_worker(*worker_args)
+        return 0
+    processes = [
+        Process(target=run_worker, args=worker_args)
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""
+Denoising and unringing of a DWI by slabs, to limit the memory of
+each dwidenoise / mrdegibbs process and run them in parallel:
+    - get_slice_axis
+    - get_degibbs_axes
+    - get_denoise_extent
+    - get_slabs
+    - get_slab_parallelism
+    - run_denoise_degibbs_slabs
+    - check_slab_equivalence
+
+The DWI is split along the slice axis (SliceEncodingDirection of the
+header, axis 2 if not given) into slabs overlapping by the half-width
+of the denoising kernel: dwidenoise estimates each voxel from the
+patch centered on it, so the core of each slab (slab without the
+overlap) is identical to the unsplit result. mrdegibbs works slice by
+slice: it is run on the cores only, with the in-plane axes given
+explicitly (-axes, as in run_denoise_degibbs of preprocessing.py).
+The cores are concatenated with mrcat (the first
+slab starts at slice 0, the header and the transform of the DWI are
+kept).
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mrtrix_io import create_mif, load_mif
+from preflight import get_available_memory
+from retry import execute_command_retry
+from scratch import get_scratch_directory, use_scratch_directory
+from stages import get_job_info, use_job_info
+from useful import check_file_ext, execute_command
+
+SLAB_NUMBER = 4
+# Fraction of the available memory used by the slabs processed at once
+SLAB_MEMORY_FRACTION = 0.5
+# Memory of a dwidenoise / mrdegibbs process, in copies of the slab
+# in float32 (input, output and patch matrices)
+MEMORY_SLAB_COPIES = 3
+# Minimum dwidenoise extent (MRtrix default for up to 125 volumes)
+MIN_DENOISE_EXTENT = 5
+# Image axis of the slice encoding directions (BIDS)
+SLICE_AXES = {"i": 0, "j": 1, "k": 2}
+# Maximum difference with the unsplit result (fraction of the
+# maximum of the image) accepted by check_slab_equivalence
+EQUIVALENCE_TOLERANCE = 1e-5
+
+
+def get_slice_axis(in_dwi):
+    """
+    Get slice axis of a DWI (SliceEncodingDirection of the header,
+    ex: "k" or "0,0,1", axis 2 if not given)
+    """
+    result, stderrl, sdtoutl = execute_command(
+        ["mrinfo", in_dwi, "-property", "SliceEncodingDirection"]
+    )
+    direction = sdtoutl.decode("utf-8").strip() if result == 0 else ""
+    if "," in direction:
+        values = [abs(float(value)) for value in direction.split(",")]
+        return values.index(max(values))
+    return SLICE_AXES.get(direction.rstrip("-"), 2)
+
+
+def get_degibbs_axes(slice_axis):
+    """Get in-plane axes of mrdegibbs (-axes option)"""
+    return ",".join(str(axis) for axis in range(3) if axis != slice_axis)
+
+
+def get_denoise_extent(nb_volumes):
+    """
+    Get dwidenoise extent (MRtrix default: smallest odd isotropic
+    patch with at least as many voxels as volumes, 5 minimum).
+    It is given explicitly to the slabs so that it does not depend
+    on the size of the slab
+    """
+    extent = MIN_DENOISE_EXTENT
+    while extent ** 3 < nb_volumes:
+        extent += 2
+    return extent
+
+
+def get_slabs(nb_slices, nb_slabs, overlap):
+    """
+    Split the slices into overlapping slabs
+
+    :param nb_slices: number of slices of the DWI (slice axis)
+    :param nb_slabs: number of slabs wanted (reduced so that each core
+                     has at least 2 * overlap + 1 slices)
+    :param overlap: number of slices added on each side of the cores
+    :returns: list of slabs, dictionaries with first / last slice
+              of the slab and of its core (indexes in the DWI)
+    """
+    nb_slabs = max(1, min(nb_slabs, nb_slices // (2 * overlap + 1)))
+    bounds = [round(index * nb_slices / nb_slabs)
+              for index in range(nb_slabs + 1)]
+    slabs = []
+    for index in range(nb_slabs):
+        core_first, core_last = bounds[index], bounds[index + 1] - 1
+        slabs.append({
+            "first": max(0, core_first - overlap),
+            "last": min(nb_slices - 1, core_last + overlap),
+            "core_first": core_first,
+            "core_last": core_last,
+        })
+    return slabs
+
+
+def get_slab_parallelism(slabs, slice_bytes, nb_threads=None,
+                         memory_fraction=SLAB_MEMORY_FRACTION):
+    """
+    Number of slabs processed at once (thread budget and memory
+    budget) and number of threads of each process
+
+    :param slice_bytes: size of one slice of the DWI in float32
+                        (all the volumes)
+    :param nb_threads: thread budget (None: number of CPUs)
+    """
+    nb_threads = nb_threads or os.cpu_count() or 1
+    nb_parallel = min(len(slabs), nb_threads)
+    memory = get_available_memory()
+    if memory is not None:
+        slab_bytes = MEMORY_SLAB_COPIES * slice_bytes * max(
+            slab["last"] - slab["first"] + 1 for slab in slabs
+        )
+        nb_parallel = min(
+            nb_parallel, int(memory * memory_fraction // slab_bytes)
+        )
+    nb_parallel = max(1, nb_parallel)
+    return nb_parallel, max(1, nb_threads // nb_parallel)
+
+
+def _get_size(in_file):
+    """Get image dimensions with mrinfo"""
+    result, stderrl, sdtoutl = execute_command(["mrinfo", in_file, "-size"])
+    if result != 0:
+        return None
+    return [int(size) for size in sdtoutl.decode("utf-8").split()]
+
+
+def _denoise_degibbs_slab(in_dwi, slab, slice_axis, extent, slab_directory,
+                          nb_threads):
+    """
+    Denoise a slab of the DWI and unring its core
+
+    :returns: result, message and unringed core (MIF file)
+    """
+    name = f"slab_{slab['core_first']:04d}"
+    threads_option = ["-nthreads", str(nb_threads)]
+    in_slab = os.path.join(slab_directory, name + ".mif")
+    cmd = [
+        "mrconvert", in_dwi, in_slab,
+        "-coord", str(slice_axis), f"{slab['first']}:{slab['last']}",
+    ] + threads_option
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        return 0, f"Can not extract {name} (exit code {result})", None
+    slab_denoise = os.path.join(slab_directory, name + "_denoise.mif")
+    cmd = [
+        "dwidenoise", in_slab, slab_denoise,
+        "-extent", ",".join([str(extent)] * 3),
+    ] + threads_option
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
+    if result != 0:
+        return 0, f"Can not lunch dwidenoise (exit code {result})", None
+    os.remove(in_slab)
+    # Core of the slab (indexes in the slab)
+    core_denoise = os.path.join(slab_directory, name + "_core.mif")
+    first = slab["core_first"] - slab["first"]
+    last = slab["core_last"] - slab["first"]
+    cmd = [
+        "mrconvert", slab_denoise, core_denoise,
+        "-coord", str(slice_axis), f"{first}:{last}",
+    ] + threads_option
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        return 0, f"Can not extract core of {name} (exit code {result})", None
+    os.remove(slab_denoise)
+    core_degibbs = os.path.join(slab_directory, name + "_core_degibbs.mif")
+    cmd = [
+        "mrdegibbs", core_denoise, core_degibbs,
+        "-axes", get_degibbs_axes(slice_axis),
+    ] + threads_option
+    result, stderrl, sdtoutl = execute_command(cmd)
+    if result != 0:
+        return 0, f"Can not lunch mrdegibbs (exit code {result})", None
+    os.remove(core_denoise)
+    return 1, f"{name} done", core_degibbs
+
+
+def run_denoise_degibbs_slabs(in_dwi, nb_threads=None, settings=None,
+                              out_dwi=None):
+    """
+    Denoise and unring one DWI run by slabs processed in parallel
+
+    :param in_dwi: DWI in MIF format
+    :param nb_threads: thread budget (None: number of CPUs)
+    :param settings: "SlabDenoise" field of the configuration file:
+                     Slabs (number of slabs), MemoryFraction (fraction
+                     of the available memory used by the slabs
+                     processed at once)
+    :param out_dwi: output DWI (default: <in_dwi>_denoise_degibbs.mif)
+    """
+    info = {}
+    mylog = logging.getLogger("custom_logger")
+    settings = settings or {}
+    dir_name = os.path.dirname(in_dwi)
+    valid_bool, in_ext, file_name = check_file_ext(in_dwi, {"MIF": "mif"})
+    if out_dwi is None:
+        out_dwi = os.path.join(dir_name, file_name + "_denoise_degibbs.mif")
+
+    size = _get_size(in_dwi)
+    if size is None or len(size) != 4:
+        msg = f"Can not get the 4D dimensions of {in_dwi}"
+        return 0, msg, info
+    slice_axis = get_slice_axis(in_dwi)
+    extent = get_denoise_extent(size[3])
+    slabs = get_slabs(size[slice_axis], settings.get("Slabs", SLAB_NUMBER),
+                      extent // 2)
+    nb_parallel, slab_threads = get_slab_parallelism(
+        slabs, 4 * size[0] * size[1] * size[2] * size[3] // size[slice_axis],
+        nb_threads, settings.get("MemoryFraction", SLAB_MEMORY_FRACTION),
+    )
+    mylog.info(
+        "Denoise / unringing of %s by %s slabs along axis %s (extent %s, "
+        "%s at once, %s threads each)", os.path.basename(in_dwi),
+        len(slabs), slice_axis, extent, nb_parallel, slab_threads,
+    )
+
+    scratch_directory = get_scratch_directory()
+    slab_directory = tempfile.mkdtemp(
+        prefix="tmp_slabs_", dir=scratch_directory or dir_name
+    )
+
+    job_info = get_job_info()
+
+    def run_one(slab):
+        with use_scratch_directory(scratch_directory), use_job_info(job_info):
+            return _denoise_degibbs_slab(
+                in_dwi, slab, slice_axis, extent, slab_directory,
+                slab_threads,
+            )
+
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=nb_parallel) as executor:
+            results = list(executor.map(run_one, slabs))
+        errors = [msg for result, msg, _ in results if result == 0]
+        if errors:
+            return 0, "; ".join(errors), info
+        # Stitch the cores (in the order of the slices)
+        cmd = ["mrcat"] + [core for _, _, core in results] + [
+            out_dwi, "-axis", str(slice_axis)
+        ]
+        result, stderrl, sdtoutl = execute_command(cmd)
+        if result != 0:
+            msg = f"Can not launch mrcat (exit code {result})"
+            return 0, msg, info
+    finally:
+        shutil.rmtree(slab_directory, ignore_errors=True)
+    mylog.info(
+        "Denoise / unringing of %s by slabs done in %.1f s",
+        os.path.basename(in_dwi), time.time() - start,
+    )
+    info = {"dwi_degibbs": out_dwi, "nb_slabs": len(slabs)}
+    msg = f"Denoise and unringing of {in_dwi} by {len(slabs)} slabs done"
+    return 1, msg, info
+
+
+def _create_synthetic_dwi(out_file, size, nb_volumes, slice_axis=2,
+                          seed=0):
+    """
+    Create a synthetic DWI: ellipsoid with a signal decreasing with
+    the b-value of the volumes and Rician noise
+    """
+    rng = np.random.default_rng(seed)
+    header = {
+        "vox": [2.0, 2.0, 2.0, 1.0],
+        "transform": [[1, 0, 0, -size[0]], [0, 1, 0, -size[1]],
+                      [0, 0, 1, -size[2]]],
+        "keyvals": {"SliceEncodingDirection": ["ijk"[slice_axis]]},
+    }
+    data = create_mif(out_file, header, list(size) + [nb_volumes],
+                      np.float32)
+    grid = np.mgrid[0:size[0], 0:size[1], 0:size[2]].astype(np.float32)
+    radius = sum(
+        ((grid[axis] - size[axis] / 2) / (0.4 * size[axis])) ** 2
+        for axis in range(3)
+    )
+    tissue = (radius < 1) * (1 + 0.3 * np.sin(grid[0] / 3))
+    bvalues = np.where(np.arange(nb_volumes) % 10 == 0, 0, 1000)
+    for volume in range(nb_volumes):
+        signal = 1000 * tissue * np.exp(-bvalues[volume] * 0.0008 * (
+            1 + 0.5 * np.cos(grid[1] / 5 + volume)
+        ))
+        noise = rng.normal(0, 30, (2,) + signal.shape)
+        data[..., volume] = np.hypot(signal + noise[0], noise[1])
+    data.flush()
+    del data
+
+
+def check_slab_equivalence(in_dwi=None, nb_slabs=SLAB_NUMBER,
+                           work_directory=None, size=(64, 64, 40),
+                           nb_volumes=33, slice_axis=2,
+                           tolerance=EQUIVALENCE_TOLERANCE):
+    """
+    Compare the denoising / unringing by slabs with the unsplit
+    pipeline (run_denoise_degibbs of preprocessing.py) on a DWI,
+    or on a synthetic DWI if none is given
+
+    :param slice_axis: slice axis of the synthetic DWI
+    :param tolerance: maximum difference accepted (fraction of the
+                      maximum of the unsplit result)
+    :returns: dictionary with the duration of each method (s), the
+              number of slabs, the maximum absolute difference and
+              equivalent (True if the difference is within tolerance)
+    """
+    # Imported here: preprocessing.py imports this module
+    from preprocessing import run_denoise_degibbs
+
+    tmp_directory = tempfile.mkdtemp(prefix="tmp_slab_check_",
+                                     dir=work_directory)
+    try:
+        # The unsplit pipeline writes its outputs next to the DWI
+        dwi = os.path.join(tmp_directory, "dwi.mif")
+        if in_dwi is None:
+            _create_synthetic_dwi(dwi, size, nb_volumes, slice_axis)
+        else:
+            os.symlink(os.path.abspath(in_dwi), dwi)
+        in_dwi = dwi
+        extent = get_denoise_extent(_get_size(in_dwi)[3])
+
+        # Unsplit reference (pipeline without slabs)
+        start = time.time()
+        result, msg, info = run_denoise_degibbs(in_dwi)
+        if result == 0:
+            raise RuntimeError(msg)
+        reference = info["dwi_degibbs"]
+        unsplit_s = time.time() - start
+
+        start = time.time()
+        out_dwi = os.path.join(tmp_directory, "dwi_slabs.mif")
+        result, msg, info = run_denoise_degibbs_slabs(
+            in_dwi, settings={"Slabs": nb_slabs}, out_dwi=out_dwi
+        )
+        if result == 0:
+            raise RuntimeError(msg)
+        slabs_s = time.time() - start
+
+        header_1, data_1 = load_mif(reference)
+        header_2, data_2 = load_mif(out_dwi)
+        if data_1.shape != data_2.shape:
+            raise RuntimeError(
+                f"Dimensions differ: {data_1.shape} / {data_2.shape}"
+            )
+        max_difference = 0.0
+        for index in range(data_1.shape[2]):
+            max_difference = max(max_difference, float(np.max(np.abs(
+                np.asarray(data_1[:, :, index], dtype=np.float64)
+                - np.asarray(data_2[:, :, index], dtype=np.float64)
+            ))))
+        max_value = float(np.max(np.abs(data_1)))
+        check = {
+            "nb_slabs": info["nb_slabs"],
+            "extent": extent,
+            "unsplit_s": unsplit_s,
+            "slabs_s": slabs_s,
+            "max_difference": max_difference,
+            "max_value": max_value,
+            "equivalent": max_difference <= tolerance * max_value,
+        }
+        del data_1, data_2
+    finally:
+        shutil.rmtree(tmp_directory)
+    mylog = logging.getLogger("custom_logger")
+    mylog.info(
+        "Slab check: unsplit %.2f s, %d slabs %.2f s, max difference %g "
+        "(equivalent: %s)", check["unsplit_s"], check["nb_slabs"],
+        check["slabs_s"], check["max_difference"], check["equivalent"],
+    )
+    return check
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the denoising / unringing by slabs with the "
+        "unsplit commands on a DWI, or on a synthetic DWI if none is given"
+    )
+    parser.add_argument("dwi", nargs="?", default=None,
+                        help="DWI in MIF format")
+    parser.add_argument("--slabs", type=int, default=SLAB_NUMBER)
+    parser.add_argument("--work-directory", default=None)
+    parser.add_argument("--slice-axis", type=int, default=2,
+                        help="slice axis of the synthetic DWI")
+    parser.add_argument("--tolerance", type=float,
+                        default=EQUIVALENCE_TOLERANCE,
+                        help="maximum difference (fraction of the maximum "
+                        "of the image)")
+    args = parser.parse_args()
+    check = check_slab_equivalence(
+        args.dwi, args.slabs, args.work_directory,
+        slice_axis=args.slice_axis, tolerance=args.tolerance,
+    )
+    print(check)
+    sys.exit(0 if check["equivalent"] else 1)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Stage boundaries of the processing (start / end of each
+step) used to plug monitoring and scheduling:
+    - add_stage_listener
+    - remove_stage_listener
+    - set_job_info
+    - update_job_info
+    - get_job_info
+    - use_job_info
+    - notify_file
+    - run_stage
+
+A stage listener is a callable listener(event, stage_info) with
+event "start", "end" or "file". stage_info contains the job
+information (see set_job_info), the stage name, and at the end of
+the stage its duration (in seconds) and result (1 if ok, 0
+otherwise). A "file" event announces a file created by a stage
+(path in stage_info["file"]), possibly after the end of the stage
+(ex: BIDS files converted in background).
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+STAGE_LISTENERS = []
+_JOB = threading.local()
+
+
+def add_stage_listener(listener):
+    """Add a listener called at each stage boundary"""
+    STAGE_LISTENERS.append(listener)
+
+
+def remove_stage_listener(listener):
+    """Remove a stage listener"""
+    if listener in STAGE_LISTENERS:
+        STAGE_LISTENERS.remove(listener)
+
+
+def set_job_info(**info):
+    """Set information of the job running in the current thread"""
+    _JOB.info = dict(info)
+
+
+def update_job_info(**info):
+    """Update information of the job running in the current thread"""
+    _JOB.info = dict(get_job_info(), **info)
+
+
+def get_job_info():
+    """Get information of the job running in the current thread"""
+    return dict(getattr(_JOB, "info", {}))
+
+
+@contextmanager
+def use_job_info(info):
+    """
+    Use the information of a job in the current thread (ex: in the
+    worker threads of a stage, with the job information of the
+    thread submitting the work, read by priority.py)
+    """
+    previous = getattr(_JOB, "info", None)
+    _JOB.info = dict(info)
+    try:
+        yield
+    finally:
+        if previous is None:
+            del _JOB.info
+        else:
+            _JOB.info = previous
+
+
+def _notify(event, stage_info):
+    """Call all the stage listeners"""
+    for listener in list(STAGE_LISTENERS):
+        listener(event, stage_info)
+
+
+def notify_file(stage, path):
+    """Announce a file created by a stage to the stage listeners"""
+    stage_info = get_job_info()
+    stage_info.update(stage=stage, file=path)
+    _notify("file", stage_info)
+
+
+@contextmanager
+def run_stage(name, **info):
+    """
+    Context manager around a processing stage, the result
+    of the stage should be set in the yielded dictionary (its
+    duration is set in it at the end of the stage):
+
+        with run_stage("fod") as stage:
+            result, msg, info = run_processing_fod(...)
+            stage["result"] = result
+    """
+    mylog = logging.getLogger("custom_logger")
+    stage_info = get_job_info()
+    stage_info.update(info)
+    stage_info["stage"] = name
+    status = {"result": 1}
+    _notify("start", dict(stage_info))
+    start = time.time()
+    try:
+        yield status
+    except Exception:
+        status["result"] = 0
+        raise
+    finally:
+        stage_info["duration"] = time.time() - start
+        stage_info["result"] = status["result"]
+        status["duration"] = stage_info["duration"]
+        mylog.info(
+            "Stage %s done in %.1f s (result %s)",
+            name,
+            stage_info["duration"],
+            status["result"],
+        )
+        _notify("end", dict(stage_info))
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Read / write MRtrix tracks (.tck) with numpy, memory-mapped:
+    - read_tck_header
+    - iter_streamlines
+    - get_streamline_offsets
+    - get_cumulated_lengths
+    - TckFile
+    - write_tck
+    - concatenate_tck
+    - get_tck_stats
+
+Data is a stream of float32 triplets (scanner coordinates in mm),
+streamlines are separated by a NaN triplet and the file ends with
+an Inf triplet. Points after the last separator (file being
+written) are ignored.
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from mrtrix_io import HEADER_ALIGNMENT, get_numpy_dtype
+
+# Number of points scanned / copied at once
+CHUNK_POINTS = 1024 * 1024
+# Width of the count field, rewritten when the file is complete
+COUNT_WIDTH = 10
+
+
+def read_tck_header(in_file):
+    """
+    Read header of a tck file
+
+    :returns: header: dictionary with datatype, offset, count
+              (None if not given) and keyvals (other fields)
+    """
+    header = {"keyvals": {}, "count": None}
+    with open(in_file, "rb") as my_file:
+        if my_file.readline().strip() != b"mrtrix tracks":
+            raise ValueError(f"{in_file} is not a tck file")
+        for line in my_file:
+            line = line.decode("utf-8", errors="replace").rstrip("\n")
+            if line.strip() == "END":
+                break
+            if ":" not in line:
+                continue
+            key, value = line.split(":", 1)
+            key, value = key.strip(), value.strip()
+            if key == "datatype":
+                header["datatype"] = value
+            elif key == "file":
+                header["offset"] = int(value.split()[1])
+            elif key == "count":
+                header["count"] = int(value)
+            else:
+                header["keyvals"].setdefault(key, []).append(value)
+    return header
+
+
+def _get_points(in_file, header):
+    """Memory-map the points of a tck file (n x 3 array)"""
+    points = np.memmap(
+        in_file,
+        dtype=get_numpy_dtype(header.get("datatype", "Float32LE")),
+        mode="r",
+        offset=header["offset"],
+    )
+    nb_points = len(points) // 3
+    return points[:nb_points * 3].reshape(nb_points, 3)
+
+
+def _iter_separators(points, chunk_points=CHUNK_POINTS):
+    """
+    Iterate over the indices of the separators (NaN triplets),
+    stops at the end of file (Inf triplet)
+    """
+    for chunk_start in range(0, len(points), chunk_points):
+        chunk = points[chunk_start:chunk_start + chunk_points, 0]
+        for separator in np.flatnonzero(~np.isfinite(chunk)):
+            separator += chunk_start
+            if np.isinf(points[separator, 0]):
+                return
+            yield separator
+
+
+def iter_streamlines(in_file, max_streamlines=None, chunk_points=CHUNK_POINTS):
+    """
+    Iterate over the streamlines of a tck file, the file is scanned
+    by chunks so that only the streamlines used are read (see
+    TckFile to access all the streamlines)
+
+    :param max_streamlines: stop after this number of streamlines
+    :returns: iterator of streamlines (n x 3 arrays, views
+              on the memory-mapped file)
+    """
+    header = read_tck_header(in_file)
+    points = _get_points(in_file, header)
+    start = 0
+    for nb_streamlines, separator in enumerate(
+        _iter_separators(points, chunk_points)
+    ):
+        if max_streamlines is not None and nb_streamlines >= max_streamlines:
+            return
+        yield points[start:separator]
+        start = separator + 1
+
+
+def get_streamline_offsets(points, chunk_points=CHUNK_POINTS):
+    """
+    Build the streamline index of memory-mapped points
+
+    :returns: starts, ends: index of the first point and of the
+              separator of each streamline (int64 arrays)
+    """
+    separators = []
+    for chunk_start in range(0, len(points), chunk_points):
+        chunk = points[chunk_start:chunk_start + chunk_points, 0]
+        chunk_separators = np.flatnonzero(~np.isfinite(chunk)) + chunk_start
+        end_of_file = np.isinf(points[chunk_separators, 0])
+        if end_of_file.any():
+            separators.append(chunk_separators[:np.argmax(end_of_file)])
+            break
+        separators.append(chunk_separators)
+    ends = np.concatenate(separators or [[]]).astype(np.int64)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    return starts[:len(ends)], ends
+
+
+def get_cumulated_lengths(points):
+    """
+    Get cumulated length along points of consecutive streamlines
+    with their separators (segments to or from a separator are NaN
+    and do not count)
+
+    :returns: cumulated length at each point (float64 array)
+    """
+    segments = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    segments[~np.isfinite(segments)] = 0
+    return np.concatenate([[0], np.cumsum(segments)])
+
+
+class TckFile:
+    """
+    Memory-mapped tck file, the streamline index is built at the
+    first access and the streamlines are read only when used:
+
+        tck = TckFile("CST_left.tck")
+        nb_streamlines = len(tck)
+        first = tck[0]
+        lengths = tck.get_lengths()
+    """
+
+    def __init__(self, in_file, chunk_points=CHUNK_POINTS):
+        self.in_file = in_file
+        self.header = read_tck_header(in_file)
+        self.points = _get_points(in_file, self.header)
+        self.chunk_points = chunk_points
+        self._offsets = None
+
+    @property
+    def offsets(self):
+        """Index of the streamlines (starts and ends arrays)"""
+        if self._offsets is None:
+            self._offsets = get_streamline_offsets(
+                self.points, self.chunk_points
+            )
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets[1])
+
+    def __getitem__(self, index):
+        starts, ends = self.offsets
+        return self.points[starts[index]:ends[index]]
+
+    def __iter__(self):
+        for start, end in zip(*self.offsets):
+            yield self.points[start:end]
+
+    def get_nb_points(self):
+        """Get number of points of each streamline"""
+        starts, ends = self.offsets
+        return ends - starts
+
+    def iter_blocks(self):
+        """
+        Iterate over blocks of consecutive streamlines of about
+        chunk_points points, read at once
+
+        :returns: iterator of (first, last, points, starts, ends):
+                  streamlines first to last - 1, their points with
+                  the separators (float64 array), and the index of
+                  their first point and of their separator in points
+        """
+        starts, ends = self.offsets
+        first = 0
+        while first < len(ends):
+            last = np.searchsorted(
+                ends, starts[first] + self.chunk_points, side="right"
+            )
+            last = max(int(last), first + 1)
+            points = np.asarray(
+                self.points[starts[first]:ends[last - 1] + 1],
+                dtype=np.float64,
+            )
+            yield (
+                first,
+                last,
+                points,
+                starts[first:last] - starts[first],
+                ends[first:last] - starts[first],
+            )
+            first = last
+
+    def get_lengths(self):
+        """Get length of each streamline (mm, float64 array)"""
+        lengths = np.zeros(len(self))
+        for first, last, points, starts, ends in self.iter_blocks():
+            cumulated = get_cumulated_lengths(points)
+            lengths[first:last] = (
+                cumulated[np.maximum(ends - 1, starts)] - cumulated[starts]
+            )
+        return lengths
+
+    def iter_raw_chunks(self):
+        """
+        Iterate over the points of all the streamlines, separators
+        included, by chunks (float32 little endian)
+        """
+        starts, ends = self.offsets
+        if not len(ends):
+            return
+        end = ends[-1] + 1
+        for chunk_start in range(starts[0], end, self.chunk_points):
+            chunk_end = min(end, chunk_start + self.chunk_points)
+            chunk = self.points[chunk_start:chunk_end]
+            yield np.asarray(chunk, dtype="<f4")
+
+
+class _TckWriter:
+    """
+    Write a tck file streamline by streamline, the count is
+    written in the header when the file is closed
+    """
+
+    def __init__(self, out_file, keyvals=None, chunk_points=CHUNK_POINTS):
+        self.out_file = out_file
+        self.chunk_points = chunk_points
+        self.count = 0
+        self._buffer = []
+        self._buffer_points = 0
+        lines = ["mrtrix tracks"]
+        for key, values in (keyvals or {}).items():
+            if key in ["count", "datatype", "file"]:
+                continue
+            for value in values if isinstance(values, list) else [values]:
+                lines.append(f"{key}: {value}")
+        lines.append("datatype: Float32LE")
+        # Offset depends on header length: iterate until it is stable
+        offset = 0
+        while True:
+            text = "\n".join(
+                lines
+                + [f"file: . {offset}", "count: " + "0" * COUNT_WIDTH, "END"]
+            ) + "\n"
+            new_offset = -(-len(text.encode()) // HEADER_ALIGNMENT)
+            new_offset *= HEADER_ALIGNMENT
+            if new_offset == offset:
+                break
+            offset = new_offset
+        self._count_position = (
+            text.encode().index(b"\ncount: ") + len("\ncount: ")
+        )
+        self._file = open(out_file, "wb")
+        self._file.write(text.encode().ljust(offset, b"\n"))
+
+    def write(self, streamline):
+        """Add a streamline (n x 3 array)"""
+        self._add(np.asarray(streamline, dtype="<f4").reshape(-1, 3))
+        self._add(np.full((1, 3), np.nan, dtype="<f4"))
+        self.count += 1
+
+    def write_raw(self, chunk, count):
+        """Add points with their separators (count streamlines)"""
+        self._add(np.asarray(chunk, dtype="<f4"))
+        self.count += count
+
+    def _add(self, points):
+        self._buffer.append(points)
+        self._buffer_points += len(points)
+        if self._buffer_points >= self.chunk_points:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            np.concatenate(self._buffer).tofile(self._file)
+        self._buffer = []
+        self._buffer_points = 0
+
+    def close(self):
+        """Write the end of file and the count"""
+        self._add(np.full((1, 3), np.inf, dtype="<f4"))
+        self._flush()
+        self._file.seek(self._count_position)
+        self._file.write(f"{self.count:0{COUNT_WIDTH}d}".encode())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self.out_file)
+
+
+def write_tck(out_file, streamlines, keyvals=None):
+    """
+    Write streamlines in a tck file (float32)
+
+    :param streamlines: iterable of n x 3 arrays (scanner coordinates)
+    :param keyvals: header fields (dictionary, ex: header["keyvals"]
+                    of the source tck file)
+    :returns: number of streamlines written
+    """
+    with _TckWriter(out_file, keyvals) as writer:
+        for streamline in streamlines:
+            writer.write(streamline)
+    return writer.count
+
+
+def concatenate_tck(in_files, out_file, chunk_points=CHUNK_POINTS):
+    """
+    Concatenate tck files, copied by chunks without parsing the
+    streamlines (the header fields of the first file are kept,
+    total_count is summed)
+
+    :returns: number of streamlines written
+    """
+    tck_files = [TckFile(in_file, chunk_points) for in_file in in_files]
+    keyvals = dict(tck_files[0].header["keyvals"]) if tck_files else {}
+    total_counts = [
+        tck.header["keyvals"].get("total_count") for tck in tck_files
+    ]
+    if total_counts and all(total_counts):
+        keyvals["total_count"] = [
+            str(sum(int(total[0]) for total in total_counts))
+        ]
+    else:
+        keyvals.pop("total_count", None)
+    with _TckWriter(out_file, keyvals, chunk_points) as writer:
+        for tck in tck_files:
+            count = len(tck)
+            for chunk in tck.iter_raw_chunks():
+                writer.write_raw(chunk, count)
+                count = 0
+    return writer.count
+
+
+def get_tck_stats(in_file):
+    """
+    Get statistics of a tck file
+
+    :returns: info: dictionary with count, header_count (count
+              field of the header), points, and min, mean, median
+              and max length (mm)
+    """
+    tck = TckFile(in_file)
+    lengths = tck.get_lengths()
+    info = {
+        "count": len(tck),
+        "header_count": tck.header["count"],
+        "points": int(tck.get_nb_points().sum()),
+    }
+    for name, function in [
+        ("min_length", np.min),
+        ("mean_length", np.mean),
+        ("median_length", np.median),
+        ("max_length", np.max),
+    ]:
+        info[name] = float(function(lengths)) if len(lengths) else None
+    return info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Statistics of tck files (count and lengths)"
+    )
+    parser.add_argument("tck", nargs="+", help="tck files")
+    args = parser.parse_args()
+    for tck_file in args.tck:
+        print(tck_file, get_tck_stats(tck_file))
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Tractometry: profiles of tensor metrics (FA, MD) along the
+TractSeg bundles:
+    - run_tensor_metrics
+    - resample_streamlines
+    - sample_trilinear
+    - run_bundle_profile
+    - run_tractometry
+    - benchmark_tractometry
+
+The streamlines of a bundle are read by blocks from the memory-mapped
+tck file (see tck_io.TckFile), resampled to a fixed number of points
+and oriented as the first streamline of the bundle. The metrics are
+sampled with trilinear interpolation in the memory-mapped maps and
+the mean and standard deviation at each point are written in a CSV
+file by bundle.
+"""
+
+import argparse
+import csv
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mrtrix_io import create_mif, get_voxel_to_scanner, load_mif
+from retry import execute_command_retry
+from stages import get_job_info, use_job_info
+from tck_io import TckFile, get_cumulated_lengths, write_tck
+
+NB_POINTS = 100
+# Metrics computed with tensor2metric (option: metric name)
+TENSOR_METRICS = {"-fa": "fa", "-adc": "md"}
+
+
+def run_tensor_metrics(in_dwi, brain_mask, out_directory):
+    """
+    Fit the diffusion tensor and compute the metric maps
+
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary metric name: map (MIF)
+    """
+    info = {}
+    os.makedirs(out_directory, exist_ok=True)
+    tensor = os.path.join(out_directory, "tensor.mif")
+    cmd = ["dwi2tensor", in_dwi, tensor, "-mask", brain_mask, "-force"]
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
+    if result != 0:
+        msg = f"Can not launch dwi2tensor (exit code {result})"
+        return 0, msg, info
+    cmd = ["tensor2metric", tensor, "-mask", brain_mask, "-force"]
+    for option, metric in TENSOR_METRICS.items():
+        info[metric] = os.path.join(out_directory, f"{metric}.mif")
+        cmd += [option, info[metric]]
+    result, stderrl, sdtoutl = execute_command_retry(cmd)
+    if result != 0:
+        msg = f"Can not launch tensor2metric (exit code {result})"
+        return 0, msg, {}
+    msg = "Tensor metrics done"
+    return 1, msg, info
+
+
+def resample_streamlines(points, starts, ends, nb_points=NB_POINTS):
+    """
+    Resample streamlines to points equally spaced along their
+    length, all the streamlines at once
+
+    :param points: points of consecutive streamlines with their
+                   separators (see tck_io.TckFile.iter_blocks)
+    :param starts: index of the first point of each streamline
+    :param ends: index of the separator of each streamline
+    :returns: resampled streamlines (n x nb_points x 3 array,
+              streamlines with less than 2 points are removed)
+    """
+    cumulated = get_cumulated_lengths(points)
+    keep = ends - starts >= 2
+    starts, ends = starts[keep], ends[keep]
+    lengths = cumulated[ends - 1] - cumulated[starts]
+    targets = (
+        cumulated[starts, None]
+        + lengths[:, None] * np.linspace(0, 1, nb_points)[None, :]
+    )
+    # Segment containing each target, inside its streamline
+    segments = np.searchsorted(cumulated, targets, side="right") - 1
+    segments = np.clip(segments, starts[:, None], (ends - 2)[:, None])
+    segment_lengths = cumulated[segments + 1] - cumulated[segments]
+    fractions = np.divide(
+        targets - cumulated[segments],
+        segment_lengths,
+        out=np.zeros_like(targets),
+        where=segment_lengths > 0,
+    )
+    fractions = np.clip(fractions, 0, 1)[..., None]
+    return (
+        points[segments] * (1 - fractions) + points[segments + 1] * fractions
+    )
+
+
+def _orient_streamlines(streamlines, reference):
+    """Flip the streamlines closer to the reversed reference"""
+    distance = (
+        np.linalg.norm(streamlines[:, 0] - reference[0], axis=1)
+        + np.linalg.norm(streamlines[:, -1] - reference[-1], axis=1)
+    )
+    flipped_distance = (
+        np.linalg.norm(streamlines[:, -1] - reference[0], axis=1)
+        + np.linalg.norm(streamlines[:, 0] - reference[-1], axis=1)
+    )
+    flip = flipped_distance < distance
+    streamlines[flip] = streamlines[flip, ::-1]
+    return streamlines
+
+
+def sample_trilinear(data, scanner_to_voxel, points):
+    """
+    Sample a 3D image at scanner coordinates (trilinear
+    interpolation), only the voxels needed are read
+
+    :param data: 3D array (memory-mapped image, see mrtrix_io.load_mif)
+    :param scanner_to_voxel: 4 x 4 matrix
+    :param points: array of coordinates (..., 3)
+    :returns: values (array of shape points.shape[:-1], NaN
+              outside the image)
+    """
+    voxels = points @ scanner_to_voxel[:3, :3].T + scanner_to_voxel[:3, 3]
+    voxels = voxels.reshape(-1, 3)
+    shape = np.array(data.shape[:3])
+    inside = np.all((voxels >= 0) & (voxels <= shape - 1), axis=1)
+    values = np.full(len(voxels), np.nan)
+    voxels = voxels[inside]
+    corners = np.minimum(np.floor(voxels).astype(np.int64), shape - 2)
+    corners = np.maximum(corners, 0)
+    # Weights of the lower and upper corners along each axis
+    weights = voxels - corners
+    weights = [(1 - weights[:, axis], weights[:, axis]) for axis in range(3)]
+    sampled = np.zeros(len(voxels))
+    for x, y, z in np.ndindex(2, 2, 2):
+        sampled += (
+            weights[0][x] * weights[1][y] * weights[2][z]
+            * data[corners[:, 0] + x, corners[:, 1] + y, corners[:, 2] + z]
+        )
+    values[inside] = sampled
+    return values.reshape(points.shape[:-1])
+
+
+def _load_metric_maps(metric_maps):
+    """Memory-map metric maps: dictionary name: (data, scanner_to_voxel)"""
+    maps = {}
+    for metric, in_file in metric_maps.items():
+        header, data = load_mif(in_file)
+        if data.ndim > 3:
+            data = data[..., 0]
+        maps[metric] = (data, np.linalg.inv(get_voxel_to_scanner(header)))
+    return maps
+
+
+def _write_profile(out_csv, profile, nb_streamlines):
+    """Write mean and standard deviation of the metrics at each point"""
+    columns = ["point", "nb_streamlines"]
+    for metric in profile:
+        columns += [f"{metric}_mean", f"{metric}_std"]
+    with open(out_csv, "w", newline="", encoding="utf-8") as my_file:
+        writer = csv.writer(my_file)
+        writer.writerow(columns)
+        for point in range(len(next(iter(profile.values()))["count"])):
+            row = [point, nb_streamlines]
+            for sums in profile.values():
+                count = sums["count"][point]
+                mean = sums["sum"][point] / count if count else np.nan
+                variance = (
+                    sums["sum2"][point] / count - mean**2 if count else np.nan
+                )
+                row += [f"{mean:.6g}", f"{np.sqrt(max(variance, 0)):.6g}"]
+            writer.writerow(row)
+
+
+def run_bundle_profile(in_tck, metric_maps, out_csv, nb_points=NB_POINTS):
+    """
+    Compute the profiles of the metrics along a bundle
+
+    :param metric_maps: dictionary metric name: map (MIF) or
+                        (data, scanner_to_voxel) as loaded once
+                        for all the bundles
+    :returns:
+        - result: 1 if ok, else 0
+        - msg: message
+        - info: dictionary with out_csv and nb_streamlines
+    """
+    info = {"out_csv": out_csv, "nb_streamlines": 0}
+    maps = _load_metric_maps(
+        {metric: in_map for metric, in_map in metric_maps.items()
+         if isinstance(in_map, str)}
+    )
+    maps.update(
+        {metric: in_map for metric, in_map in metric_maps.items()
+         if not isinstance(in_map, str)}
+    )
+    tck = TckFile(in_tck)
+    profile = {
+        metric: {key: np.zeros(nb_points) for key in ["sum", "sum2", "count"]}
+        for metric in maps
+    }
+    reference = None
+    for first, last, points, starts, ends in tck.iter_blocks():
+        streamlines = resample_streamlines(points, starts, ends, nb_points)
+        if not len(streamlines):
+            continue
+        if reference is None:
+            reference = streamlines[0].copy()
+        streamlines = _orient_streamlines(streamlines, reference)
+        info["nb_streamlines"] += len(streamlines)
+        for metric, (data, scanner_to_voxel) in maps.items():
+            values = sample_trilinear(data, scanner_to_voxel, streamlines)
+            valid = np.isfinite(values)
+            values = np.where(valid, values, 0)
+            profile[metric]["sum"] += values.sum(axis=0)
+            profile[metric]["sum2"] += (values**2).sum(axis=0)
+            profile[metric]["count"] += valid.sum(axis=0)
+    if info["nb_streamlines"] == 0:
+        # Bundle not found by TractSeg: no profile
+        info["out_csv"] = None
+        msg = f"No streamline in {os.path.basename(in_tck)}"
+        return 1, msg, info
+    _write_profile(out_csv, profile, info["nb_streamlines"])
+    msg = f"Profile of {os.path.basename(in_tck)} done"
+    return 1, msg, info
+
+
+def run_tractometry(
+    tck_files, metric_maps, out_directory, nb_points=NB_POINTS, nb_threads=None
+):
+    """
+    Compute the profiles of all the bundles at the same time (one
+    CSV file by bundle: <bundle>_profile.csv). All the bundles are
+    processed even if one of them fails.
+
+    :param tck_files: bundle tractograms (a list, the bundle name
+                      is the file name)
+    :param metric_maps: dictionary metric name: map (MIF)
+    :param nb_threads: maximum number of bundles processed at the
+                       same time (default: number of CPUs)
+    :returns:
+        - result: 1 if all the profiles are computed, else 0
+        - msg: message (with the errors)
+        - info: dictionary bundle: {"result", "msg", "out_csv",
+                "nb_streamlines"}
+    """
+    info = {}
+    if not tck_files:
+        return 0, "No bundle for tractometry", info
+    mylog = logging.getLogger("custom_logger")
+    mylog.info("Launch tractometry of %s bundles", len(tck_files))
+    os.makedirs(out_directory, exist_ok=True)
+    # Maps are memory-mapped once and shared by the threads
+    maps = _load_metric_maps(metric_maps)
+    nb_workers = min(len(tck_files), nb_threads or os.cpu_count() or 1)
+    job_info = get_job_info()
+
+    def run_one(in_tck):
+        bundle = os.path.basename(in_tck).split(".")[0]
+        out_csv = os.path.join(out_directory, f"{bundle}_profile.csv")
+        try:
+            with use_job_info(job_info):
+                result, msg, bundle_info = run_bundle_profile(
+                    in_tck, maps, out_csv, nb_points
+                )
+        except Exception as e:
+            result, msg, bundle_info = 0, str(e), {}
+        return bundle, result, msg, bundle_info
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        for bundle, result, msg, bundle_info in executor.map(
+            run_one, tck_files
+        ):
+            info[bundle] = {
+                "result": result,
+                "msg": msg,
+                "out_csv": bundle_info.get("out_csv"),
+                "nb_streamlines": bundle_info.get("nb_streamlines", 0),
+            }
+            if result == 0:
+                mylog.warning("Tractometry of %s failed: %s", bundle, msg)
+    errors = [
+        f"{bundle}: {bundle_info['msg']}"
+        for bundle, bundle_info in info.items()
+        if bundle_info["result"] == 0
+    ]
+    if errors:
+        msg = "Tractometry failed for " + "; ".join(errors)
+        return 0, msg, info
+    msg = "Tractometry done"
+    mylog.info(msg)
+    return 1, msg, info
+
+
+def _run_bundle_profile_loop(in_tck, maps, nb_points=NB_POINTS):
+    """
+    Reference profile computed streamline by streamline (as the
+    previous scripts), used by the benchmark
+
+    :returns: dictionary metric: mean at each point
+    """
+    profile = {metric: [] for metric in maps}
+    reference = None
+    for streamline in TckFile(in_tck):
+        if len(streamline) < 2:
+            continue
+        streamline = np.asarray(streamline, dtype=np.float64)
+        cumulated = np.concatenate([[0], np.cumsum(
+            np.linalg.norm(np.diff(streamline, axis=0), axis=1)
+        )])
+        targets = np.linspace(0, cumulated[-1], nb_points)
+        resampled = np.stack(
+            [np.interp(targets, cumulated, streamline[:, axis])
+             for axis in range(3)],
+            axis=1,
+        )
+        if reference is None:
+            reference = resampled.copy()
+        resampled = _orient_streamlines(resampled[None], reference)[0]
+        for metric, (data, scanner_to_voxel) in maps.items():
+            profile[metric].append(
+                sample_trilinear(data, scanner_to_voxel, resampled)
+            )
+    return {
+        metric: np.nanmean(values, axis=0)
+        for metric, values in profile.items()
+    }
+
+
+def benchmark_tractometry(
+    nb_streamlines=50000, work_directory=None, nb_points=NB_POINTS, seed=0
+):
+    """
+    Compare the vectorized profile and the streamline by streamline
+    profile on a synthetic bundle (arcs in a 100 mm cube, FA map
+    varying along x)
+
+    :returns: dictionary with the duration of each method (s),
+              the speedup and the maximum difference of the means
+    """
+    tmp_directory = tempfile.mkdtemp(prefix="tmp_tractometry_",
+                                     dir=work_directory)
+    try:
+        rng = np.random.default_rng(seed)
+        header = {
+            "vox": [1.0, 1.0, 1.0],
+            "transform": [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]],
+        }
+        in_fa = os.path.join(tmp_directory, "fa.mif")
+        fa_data = create_mif(in_fa, header, [100, 100, 100], np.float32)
+        grid = np.mgrid[0:100, 0:100, 0:100]
+        fa_data[:] = 0.2 + 0.6 * np.sin(grid[0] / 100 * np.pi) * (
+            1 - np.abs(grid[1] - 50) / 100
+        )
+        fa_data.flush()
+        del fa_data
+
+        def synthetic_streamlines():
+            for _ in range(nb_streamlines):
+                nb = rng.integers(40, 120)
+                angle = np.linspace(0, np.pi, nb)
+                radius = 40 + rng.normal(0, 3)
+                streamline = np.stack([
+                    50 + radius * np.cos(angle),
+                    50 + 0.6 * radius * np.sin(angle) - 20,
+                    50 + rng.normal(0, 5) + np.zeros(nb),
+                ], axis=1)
+                streamline += rng.normal(0, 0.3, streamline.shape)
+                yield streamline[::-1] if rng.random() < 0.5 else streamline
+
+        in_tck = os.path.join(tmp_directory, "bundle.tck")
+        write_tck(in_tck, synthetic_streamlines())
+        out_csv = os.path.join(tmp_directory, "bundle_profile.csv")
+        maps = _load_metric_maps({"fa": in_fa})
+        start = time.time()
+        result, msg, info = run_bundle_profile(
+            in_tck, maps, out_csv, nb_points
+        )
+        vectorized_s = time.time() - start
+        if result == 0:
+            raise RuntimeError(msg)
+        start = time.time()
+        reference = _run_bundle_profile_loop(in_tck, maps, nb_points)
+        loop_s = time.time() - start
+        with open(out_csv, encoding="utf-8") as my_file:
+            means = [float(row["fa_mean"]) for row in csv.DictReader(my_file)]
+        benchmark = {
+            "nb_streamlines": info["nb_streamlines"],
+            "vectorized_s": vectorized_s,
+            "loop_s": loop_s,
+            "speedup": loop_s / vectorized_s if vectorized_s else None,
+            "max_difference": float(
+                np.max(np.abs(np.array(means) - reference["fa"]))
+            ),
+        }
+    finally:
+        shutil.rmtree(tmp_directory)
+    mylog = logging.getLogger("custom_logger")
+    mylog.info(
+        "Tractometry benchmark: vectorized %.2f s, loop %.2f s",
+        benchmark["vectorized_s"], benchmark["loop_s"],
+    )
+    return benchmark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tractometry profiles of bundles, or benchmark on a "
+        "synthetic bundle if no tck file is given"
+    )
+    parser.add_argument("tck", nargs="*", help="bundle tck files (or a "
+                        "TOM_trackings directory)")
+    parser.add_argument("--map", action="append", default=[],
+                        metavar="NAME=FILE", help="metric map (MIF)")
+    parser.add_argument("--out-directory", default=".")
+    parser.add_argument("--nb-points", type=int, default=NB_POINTS)
+    parser.add_argument("--nb-streamlines", type=int, default=50000,
+                        help="size of the synthetic bundle")
+    args = parser.parse_args()
+    if args.tck:
+        tck_list = []
+        for path in args.tck:
+            if os.path.isdir(path):
+                tck_list += sorted(glob.glob(os.path.join(path, "*.tck")))
+            else:
+                tck_list.append(path)
+        print(run_tractometry(
+            tck_list,
+            dict(item.split("=", 1) for item in args.map),
+            args.out_directory,
+            args.nb_points,
+        )[1])
+    else:
+        print(benchmark_tractometry(args.nb_streamlines,
+                                    nb_points=args.nb_points))
@@ -7,15 +7,21 @@ Useful functions :
 - convert_mif_to_nifti
 - convert_nifti_to_mif
 - get_shell
+- get_nifti_header_info
 - find_dicom_tag_value
 - get_all_dicom_files
 """
 
+import gzip
 import os
+import struct
 import subprocess
 
 import pydicom
 from pydicom.tag import Tag
+from priority import (get_command_env, get_popen_options, register_command,
+                      unregister_command)
+from scratch import add_scratch_option, get_scratch_directory
 
 EXT_NIFTI = {"NIFTI_GZ": "nii.gz", "NIFTI": "nii"}
 EXT_MIF = {"MIF": "mif"}
@@ -51,9 +57,28 @@ def check_file_ext(in_file, ext_dic):
     return valid_bool, in_ext, file_name
 
 
-def execute_command(command):
-    """Execute command"""
+def execute_command(command, env=None, cwd=None):
+    """
+    Execute command (in the scratch directory of the current
+    job / stage if any, see scratch.py, with the thread limits
+    of its priority, see priority.py)
+
+    :param command: command to execute (a list)
+    :param env: environment variables added to the current
+                environment (a dictionary)
+    :param cwd: working directory of the command
+    """
+    scratch_directory = get_scratch_directory()
+    if scratch_directory:
+        command = add_scratch_option(command, scratch_directory)
+        env = dict({"TMPDIR": scratch_directory}, **(env or {}))
+        cwd = cwd or scratch_directory
+    priority_env = get_command_env()
+    if priority_env:
+        env = dict(priority_env, **(env or {}))
     print("\n", command)
+    if env:
+        env = dict(os.environ, **env)
     p = subprocess.Popen(
         command,
         shell=False,
@@ -62,11 +87,18 @@ def execute_command(command):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         close_fds=True,
+        env=env,
+        cwd=cwd,
+        **get_popen_options(),
     )
 
     print("--------->PID:", p.pid)
 
-    (sdtoutl, stderrl) = p.communicate()
+    register_command(p)
+    try:
+        (sdtoutl, stderrl) = p.communicate()
+    finally:
+        unregister_command(p)
     if str(sdtoutl) != "":
         print("sdtoutl: ", sdtoutl.decode())
     if str(stderrl) != "":
@@ -166,6 +198,40 @@ def get_shell(in_file):
     return 1, msg, shell
 
 
+def get_nifti_header_info(in_file):
+    """
+    Read dimensions and datatype from a NIfTI-1 header
+    (without loading the image)
+
+    :param in_file: NIfTI file (.nii or .nii.gz)
+    :returns: info: dictionary with the keys
+        - dim: image dimensions, ex: [96, 96, 60, 65] (a list)
+        - bitpix: number of bits per voxel (an integer)
+        - pixdim: voxel sizes (a list)
+    """
+    opener = gzip.open if in_file.endswith(".gz") else open
+    with opener(in_file, "rb") as my_file:
+        header = my_file.read(348)
+    if len(header) < 348:
+        raise ValueError(f"{in_file} is not a valid NIfTI-1 file")
+    # Use sizeof_hdr to find endianness
+    for endian in ["<", ">"]:
+        if struct.unpack(endian + "i", header[0:4])[0] == 348:
+            break
+    else:
+        raise ValueError(f"{in_file} is not a valid NIfTI-1 file")
+    dim = struct.unpack(endian + "8h", header[40:56])
+    bitpix = struct.unpack(endian + "h", header[72:74])[0]
+    pixdim = struct.unpack(endian + "8f", header[76:108])
+    ndim = dim[0]
+    info = {
+        "dim": list(dim[1:ndim + 1]),
+        "bitpix": bitpix,
+        "pixdim": list(pixdim[1:ndim + 1]),
+    }
+    return info
+
+
 def find_dicom_tag_value(input_dicom_dataset, tag):
     """
     Find DICOM tag value
@@ -218,8 +284,10 @@ def get_all_dicom_files(dicom_directory):
             continue
 
         try:
+            # Headers only: the pixel data is read by dcm2niix
             input_dicom = pydicom.read_file(
-                os.path.join(dicom_directory, file_name)
+                os.path.join(dicom_directory, file_name),
+                stop_before_pixels=True,
             )
         except Exception:
             print(f"File {file_name} not taken (coul not read DICOM).")
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Reservations of the paused jobs in the admission control
+(see admission.py)
+"""
+
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+import admission  # noqa
+
+GB = admission.GB
+
+
+def _controller(tmp_path, monkeypatch):
+    monkeypatch.setattr(admission, "get_total_memory", lambda: 10 * GB)
+    monkeypatch.setattr(admission, "get_available_memory", lambda: 10 * GB)
+    return admission.AdmissionController(str(tmp_path), poll_interval=0)
+
+
+def test_paused_reservations_counted(tmp_path, monkeypatch):
+    controller = _controller(tmp_path, monkeypatch)
+    controller.reserve("low_job", "denoise", 6 * GB, 0)
+    controller.set_paused(os.getpid(), ["low_job"])
+    reservations = controller._read_ledger()
+    assert reservations[0]["paused"]
+    ok, reason = controller._check_room(reservations, 6 * GB, 0, None)
+    assert not ok
+    assert "memory" in reason
+
+
+def test_stage_started_when_only_paused_jobs(tmp_path, monkeypatch):
+    controller = _controller(tmp_path, monkeypatch)
+    controller.reserve("low_job", "denoise", 6 * GB, 0)
+    controller.set_paused(os.getpid(), ["low_job"])
+    # Waiting only for the paused job, started anyway
+    controller.reserve("urgent_job", "denoise", 6 * GB, 0)
+    assert len(controller._read_ledger()) == 2
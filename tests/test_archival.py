@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Freeze and thaw of the derivatives of a session (see archival.py)
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+from archival import (find_frozen_candidates, freeze_session,  # noqa
+                      thaw_session)
+
+
+def test_thawed_session_not_frozen_again(tmp_path):
+    image = tmp_path / "dwi" / "dwi.mif"
+    image.parent.mkdir()
+    image.write_bytes(b"mrtrix image\n" * 1000)
+    old_time = time.time() - 60 * 86400
+    os.utime(image, (old_time, old_time))
+    assert find_frozen_candidates(str(tmp_path))[0] == [str(image)]
+
+    result, msg, info = freeze_session(str(tmp_path), threads=1)
+    assert result == 1
+    frozen = tmp_path / "dwi" / "dwi.mif.gz"
+    assert info["files"] == [str(frozen)]
+    assert abs(frozen.stat().st_mtime - old_time) < 1
+
+    result, msg, info = thaw_session(str(tmp_path), threads=1)
+    assert result == 1
+    assert image.read_bytes() == b"mrtrix image\n" * 1000
+    assert time.time() - image.stat().st_mtime < 60
+    assert find_frozen_candidates(str(tmp_path))[0] == []
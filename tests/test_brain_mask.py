@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Brain mask of the partial brain processing computed with numpy
+(see brain_mask.py)
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+from brain_mask import (compute_mean_image, median_filter_binary,  # noqa
+                        run_partial_brain_mask)
+from mrtrix_io import create_mif, load_mif  # noqa
+
+HEADER = {
+    "vox": [2.0, 2.0, 2.0, 1.0],
+    "transform": [[1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0]],
+    "keyvals": {},
+}
+
+
+def _median_reference(mask, extent=3):
+    """Median of the neighbours inside the image, voxel by voxel"""
+    radius = extent // 2
+    out = np.zeros(mask.shape, dtype=bool)
+    for index in np.ndindex(mask.shape):
+        box = tuple(
+            slice(max(0, position - radius), position + radius + 1)
+            for position in index
+        )
+        # Median of an even number of 0 / 1 values can be 0.5 (1 in a mask)
+        out[index] = np.median(mask[box]) > 0
+    return out
+
+
+def test_median_filter_binary():
+    rng = np.random.default_rng(0)
+    for shape in [(7, 6, 5), (1, 4, 9), (2, 2, 2)]:
+        for fraction in [0.2, 0.5, 0.8]:
+            mask = rng.random(shape) < fraction
+            assert np.array_equal(
+                median_filter_binary(mask), _median_reference(mask)
+            )
+
+
+def test_mean_image_by_slabs():
+    rng = np.random.default_rng(1)
+    data = rng.random((6, 5, 7, 4)).astype(np.float32)
+    # Slabs of 2 slices
+    mean = compute_mean_image(data, chunk_bytes=2 * 6 * 5 * 4 * 8)
+    assert mean.dtype == np.float32
+    assert np.allclose(mean, data.mean(axis=3), atol=1e-6)
+
+
+def test_partial_brain_mask(tmp_path):
+    rng = np.random.default_rng(2)
+    in_dwi = str(tmp_path / "dwi.mif")
+    values = rng.normal(2, 1.5, (10, 9, 8, 5)).astype(np.float32)
+    data = create_mif(in_dwi, HEADER, list(values.shape), np.float32)
+    data[...] = values
+    data.flush()
+    del data
+    out_mask = str(tmp_path / "mask.mif")
+    result, msg, info = run_partial_brain_mask(in_dwi, out_mask)
+    assert result == 1, msg
+    reference = values.mean(axis=3) >= 2
+    for _ in range(2):
+        reference = _median_reference(reference)
+    header, mask = load_mif(out_mask)
+    assert np.array_equal(np.asarray(mask) > 0, reference)
+    assert info["nb_voxels"] == int(reference.sum())
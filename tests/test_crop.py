@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Settings of the crop to the brain mask (see crop.py)
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+from crop import get_crop_settings  # noqa
+
+
+def test_crop_settings():
+    assert get_crop_settings({}) is None
+    assert get_crop_settings({"CropToMask": False}) is None
+    assert get_crop_settings({"CropToMask": True}) == {}
+    assert get_crop_settings({"CropToMask": {"Margin": 3}}) == {"Margin": 3}
+
+
+def test_invalid_crop_settings():
+    with pytest.raises(ValueError):
+        get_crop_settings({"CropToMask": "yes"})
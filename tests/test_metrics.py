@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Events of the stages written by the metrics (see metrics.py)
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+from metrics import MetricsListener, read_metrics_state  # noqa
+from stages import (add_stage_listener, notify_file,  # noqa
+                    remove_stage_listener, run_stage, set_job_info)
+
+
+def test_file_event_written(tmp_path):
+    listener = MetricsListener(str(tmp_path))
+    add_stage_listener(listener)
+    set_job_info(job="exam1", priority="normal")
+    try:
+        with run_stage("conversion"):
+            pass
+        # BIDS file converted in background, after the end of the stage
+        notify_file("conversion", "/bids/sub-01/ses-01/anat/T1w.nii.gz")
+    finally:
+        remove_stage_listener(listener)
+        set_job_info()
+    with open(listener.events_file, encoding="utf-8") as my_file:
+        events = [json.loads(line) for line in my_file]
+    assert [event["event"] for event in events] == ["start", "end", "file"]
+    assert events[2]["stage"] == "conversion"
+    assert events[2]["job"] == "exam1"
+    assert events[2]["file"] == "/bids/sub-01/ses-01/anat/T1w.nii.gz"
+    # File event: no stage run counted, no stage left running
+    state = read_metrics_state(listener.state_file)
+    assert sum(state["counters"]["stage_runs_total"].values()) == 1
+    assert set(state["gauges"]["stages_running"].values()) == {0}
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Priority of the commands started in the worker threads of a stage
+(see priority.py)
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+import preprocessing  # noqa
+import priority  # noqa
+import slab  # noqa
+from stages import set_job_info  # noqa
+
+
+@pytest.fixture
+def urgent_job(tmp_path):
+    """Urgent job registered on the node, running in this thread"""
+    scheduler = priority.PriorityScheduler(str(tmp_path))
+    priority._SCHEDULER = scheduler
+    scheduler.register_job("urgent_job", "urgent")
+    set_job_info(job="urgent_job", priority="urgent")
+    yield scheduler
+    scheduler.unregister_job("urgent_job")
+    priority._SCHEDULER = None
+    set_job_info()
+
+
+def test_low_priority_thread_limited(urgent_job):
+    set_job_info(job="low_job", priority="low")
+    assert priority.get_command_env()["MRTRIX_NTHREADS"]
+
+
+def test_runs_keep_job_priority(urgent_job, monkeypatch):
+    envs = []
+
+    def fake_denoise(in_dwi, nb_threads=None, slabs=None):
+        envs.append(priority.get_command_env())
+        return 1, "", {"dwi_degibbs": in_dwi}
+
+    monkeypatch.setattr(preprocessing, "run_denoise_degibbs", fake_denoise)
+    monkeypatch.setattr(preprocessing, "execute_command",
+                        lambda cmd: (0, b"", b""))
+    assert priority.get_command_env() == {}
+    result, msg, info = preprocessing.run_denoise_degibbs_runs(
+        ["/tmp/dwi_run-1.mif", "/tmp/dwi_run-2.mif"]
+    )
+    assert result == 1
+    assert envs == [{}, {}]
+
+
+def test_slabs_keep_job_priority(urgent_job, monkeypatch, tmp_path):
+    envs = []
+
+    def fake_slab(in_dwi, slab_range, *args):
+        envs.append(priority.get_command_env())
+        return 1, "", str(tmp_path / f"{slab_range['first']}.mif")
+
+    monkeypatch.setattr(slab, "_get_size", lambda in_file: [8, 8, 30, 6])
+    monkeypatch.setattr(slab, "get_slice_axis", lambda in_file: 2)
+    monkeypatch.setattr(slab, "_denoise_degibbs_slab", fake_slab)
+    monkeypatch.setattr(slab, "execute_command", lambda cmd: (0, b"", b""))
+    result, msg, info = slab.run_denoise_degibbs_slabs(
+        str(tmp_path / "dwi.mif"), nb_threads=4, settings={"Slabs": 3}
+    )
+    assert result == 1
+    assert envs == [{}, {}, {}]
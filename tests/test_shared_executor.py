@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Shared queue with several local worker processes (see
+shared_executor.py)
+"""
+
+import json
+import os
+import sys
+import time
+from multiprocessing import Process
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+from shared_executor import (get_task_status, requeue_stale_tasks,  # noqa
+                             run_worker, submit_task)
+
+WORKER_OPTIONS = {
+    "poll_interval": 0.1, "idle_timeout": 5, "heartbeat_interval": 0.2
+}
+
+
+def _start_worker(queue_directory):
+    worker = Process(
+        target=run_worker, args=(queue_directory,), kwargs=WORKER_OPTIONS
+    )
+    worker.start()
+    return worker
+
+
+def _wait_status(queue_directory, task_id, statuses, timeout=20):
+    start = time.time()
+    while time.time() - start < timeout:
+        status = get_task_status(queue_directory, task_id)
+        if status in statuses:
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"Task {task_id} still {status}")
+
+
+def test_two_workers_run_each_task_once(tmp_path):
+    queue_directory = str(tmp_path / "queue")
+    log_file = tmp_path / "runs.log"
+    task_ids = [
+        submit_task(queue_directory, {
+            "kind": "command",
+            "command": ["sh", "-c", f"echo {index} >> {log_file}; sleep 0.5"],
+        })
+        for index in range(6)
+    ]
+    workers = [_start_worker(queue_directory) for _ in range(2)]
+    for task_id in task_ids:
+        assert _wait_status(
+            queue_directory, task_id, ["done", "failed"]
+        ) == "done"
+    for worker in workers:
+        worker.join()
+    assert sorted(log_file.read_text().split()) == [str(i) for i in range(6)]
+    done_workers = set()
+    for task_id in task_ids:
+        with open(os.path.join(queue_directory, "done", task_id + ".json"),
+                  encoding="utf-8") as my_json:
+            done_workers.add(json.load(my_json)["worker"])
+    assert len(done_workers) == 2
+    assert os.listdir(os.path.join(queue_directory, "claimed")) == []
+
+
+def test_requeue_of_live_claim(tmp_path):
+    queue_directory = str(tmp_path / "queue")
+    log_file = tmp_path / "runs.log"
+    task_id = submit_task(queue_directory, {
+        "kind": "command",
+        "command": [
+            "sh", "-c",
+            f"echo start >> {log_file}; sleep 2; echo end >> {log_file}",
+        ],
+    })
+    first_worker = _start_worker(queue_directory)
+    _wait_status(queue_directory, task_id, ["claimed"])
+    while not log_file.exists():
+        time.sleep(0.05)
+    # Claim of a live worker requeued (ex: heartbeats delayed by NFS)
+    assert requeue_stale_tasks(queue_directory, stale_timeout=0) == [
+        task_id
+    ]
+    second_worker = _start_worker(queue_directory)
+    assert _wait_status(queue_directory, task_id, ["done", "failed"]) == "done"
+    first_worker.join()
+    second_worker.join()
+    # First run killed when its claim was lost, a single run completed
+    assert log_file.read_text().split() == ["start", "start", "end"]
+    assert not os.path.exists(
+        os.path.join(queue_directory, "failed", task_id + ".json")
+    )
+    assert os.listdir(os.path.join(queue_directory, "claimed")) == []
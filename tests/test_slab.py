@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Denoising and unringing of a DWI by slabs (see slab.py)
+"""
+
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+import slab  # noqa
+
+GB = 1024**3
+
+
+@pytest.mark.parametrize("nb_slices", [20, 40, 41, 77])
+@pytest.mark.parametrize("nb_slabs", [1, 3, 4, 7])
+@pytest.mark.parametrize("extent", [5, 7, 9])
+def test_slabs_tile_slices(nb_slices, nb_slabs, extent):
+    overlap = extent // 2
+    slabs = slab.get_slabs(nb_slices, nb_slabs, overlap)
+    assert 1 <= len(slabs) <= nb_slabs
+    # Cores tile every slice once, in order
+    cores = [
+        index for item in slabs
+        for index in range(item["core_first"], item["core_last"] + 1)
+    ]
+    assert cores == list(range(nb_slices))
+    for item in slabs:
+        assert item["core_last"] - item["core_first"] + 1 >= 2 * overlap + 1
+        # Overlap of at least the half-width of the kernel, except at
+        # the borders of the DWI
+        assert item["first"] == max(0, item["core_first"] - overlap)
+        assert item["last"] == min(nb_slices - 1, item["core_last"] + overlap)
+        assert item["core_first"] - item["first"] >= min(
+            overlap, item["core_first"]
+        )
+        assert item["last"] - item["core_last"] >= min(
+            overlap, nb_slices - 1 - item["core_last"]
+        )
+
+
+def test_slab_number_reduced_for_thin_dwi():
+    assert len(slab.get_slabs(10, 4, 2)) == 2
+    assert len(slab.get_slabs(3, 4, 2)) == 1
+
+
+def test_slab_parallelism_thread_budget(monkeypatch):
+    monkeypatch.setattr(slab, "get_available_memory", lambda: None)
+    slabs = slab.get_slabs(40, 4, 2)
+    assert slab.get_slab_parallelism(slabs, 1024, nb_threads=8) == (4, 2)
+    assert slab.get_slab_parallelism(slabs, 1024, nb_threads=2) == (2, 1)
+    assert slab.get_slab_parallelism(slabs, 1024, nb_threads=1) == (1, 1)
+
+
+def test_slab_parallelism_memory_budget(monkeypatch):
+    slabs = slab.get_slabs(40, 4, 2)
+    max_slices = max(item["last"] - item["first"] + 1 for item in slabs)
+    slab_bytes = slab.MEMORY_SLAB_COPIES * max_slices * GB
+    # Room for 2 slabs in the memory budget
+    monkeypatch.setattr(slab, "get_available_memory",
+                        lambda: 2 * slab_bytes / slab.SLAB_MEMORY_FRACTION)
+    assert slab.get_slab_parallelism(slabs, GB, nb_threads=8) == (2, 4)
+    # Not even one slab: processed one at a time anyway
+    monkeypatch.setattr(slab, "get_available_memory", lambda: GB)
+    assert slab.get_slab_parallelism(slabs, GB, nb_threads=8) == (1, 8)
+
+
+@pytest.mark.skipif(shutil.which("dwidenoise") is None,
+                    reason="MRtrix is not installed")
+@pytest.mark.parametrize("slice_axis", [0, 2])
+def test_slabs_equivalent_to_unsplit(tmp_path, slice_axis):
+    check = slab.check_slab_equivalence(
+        work_directory=str(tmp_path), size=(32, 32, 24), nb_volumes=15,
+        slice_axis=slice_axis,
+    )
+    assert check["nb_slabs"] > 1
+    assert check["equivalent"], check
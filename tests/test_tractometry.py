@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized tractometry profiles against the streamline by
+streamline profiles (see tractometry.py)
+"""
+
+import csv
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                    "mri_dwi_cluni")
+)
+
+from mrtrix_io import create_mif  # noqa
+from tck_io import write_tck  # noqa
+from tractometry import (_load_metric_maps, _run_bundle_profile_loop,  # noqa
+                         benchmark_tractometry, run_bundle_profile)
+
+# Profiles are written with 6 significant digits
+TOLERANCE = 1e-5
+
+
+def test_benchmark_profiles_equal():
+    benchmark = benchmark_tractometry(nb_streamlines=300, nb_points=50)
+    assert benchmark["nb_streamlines"] == 300
+    assert benchmark["max_difference"] < TOLERANCE
+
+
+def test_profiles_equal_two_metrics(tmp_path):
+    rng = np.random.default_rng(1)
+    # 2 mm voxels, translated and rotated grid
+    angle = 0.3
+    header = {
+        "vox": [2.0, 2.0, 2.0],
+        "transform": [
+            [2 * np.cos(angle), -2 * np.sin(angle), 0, -10],
+            [2 * np.sin(angle), 2 * np.cos(angle), 0, 5],
+            [0, 0, 2, -3],
+        ],
+    }
+    maps = {}
+    for metric in ["fa", "md"]:
+        in_map = str(tmp_path / f"{metric}.mif")
+        data = create_mif(in_map, header, [20, 18, 16], np.float32)
+        data[:] = rng.random((20, 18, 16))
+        data.flush()
+        del data
+        maps[metric] = in_map
+    streamlines = []
+    for _ in range(40):
+        nb = int(rng.integers(2, 30))
+        start = rng.uniform(0, 15, 3)
+        steps = rng.normal(0.8, 0.5, (nb, 3))
+        streamlines.append(start + np.cumsum(steps, axis=0))
+    in_tck = str(tmp_path / "bundle.tck")
+    write_tck(in_tck, iter(streamlines))
+    out_csv = str(tmp_path / "bundle_profile.csv")
+    result, msg, info = run_bundle_profile(in_tck, maps, out_csv, 20)
+    assert result == 1, msg
+    assert info["nb_streamlines"] == 40
+    reference = _run_bundle_profile_loop(in_tck, _load_metric_maps(maps), 20)
+    with open(out_csv, encoding="utf-8") as my_file:
+        rows = list(csv.DictReader(my_file))
+    for metric in maps:
+        means = np.array([float(row[f"{metric}_mean"]) for row in rows])
+        assert np.array_equal(np.isnan(means), np.isnan(reference[metric]))
+        difference = np.abs(means - reference[metric])
+        assert np.nanmax(difference) < TOLERANCE